@@ -0,0 +1,107 @@
+from typing import Any, Dict, List, Optional, Tuple
+
+from vthass.api import HomeAssistant
+from vthass.capabilities import getProfile
+from vthass.config import Page
+from vthass.emulator import EmulatedTerminal
+from vthass.render import Renderer
+from vthass.scheduler import PollScheduler
+from vthass.trace import ReplayClock
+from vthass.writer import WriterTerminal
+
+
+class FakeHomeAssistant(HomeAssistant):
+    # Serves states out of a dictionary of entity ID to name, state and units, fetched on
+    # the main loop so that every poll lands on the frame that asked for it.
+    BACKGROUND_FETCH = False
+
+    def __init__(self, states: Dict[str, Tuple[str, str, Optional[str]]]) -> None:
+        super().__init__("http://127.0.0.1:9/", "token")
+        self.states = states
+        self.calls: List[Tuple[str, Any]] = []
+        self.failing = False
+
+    def __entry(self, entity_id: str) -> Dict[str, Any]:
+        name, state, units = self.states[entity_id]
+        attributes: Dict[str, Any] = {"friendly_name": name}
+        if units is not None:
+            attributes["unit_of_measurement"] = units
+        return {"entity_id": entity_id, "state": state, "attributes": attributes}
+
+    def _request(self, method: str, path: str, body: Optional[Dict[str, Any]] = None) -> Any:
+        if self.failing:
+            raise Exception("Home Assistant is down")
+        if method == "POST":
+            self.calls.append((path, body))
+            return []
+        if path == "api/states":
+            return [self.__entry(e) for e in self.states]
+        if path.startswith("api/history/"):
+            return []
+        entity_id = path.split("/", 2)[2]
+        return self.__entry(entity_id) if entity_id in self.states else None
+
+
+class Dashboard:
+    # A renderer drawing onto an emulated terminal, on a clock that only moves when told.
+    def __init__(
+        self,
+        pages: List[Page],
+        states: Dict[str, Tuple[str, str, Optional[str]]],
+        profile: str = "vt100",
+        terminal: Optional[EmulatedTerminal] = None,
+        queued: bool = False,
+    ) -> None:
+        # With queued set, drawing goes through a writer thread the way it does on a serial
+        # terminal, and nothing waits for it to catch up unless asked to.
+        self.clock = ReplayClock()
+        self.hass = FakeHomeAssistant(states)
+        self.terminal = terminal or EmulatedTerminal()
+        self.writer = WriterTerminal(self.terminal, self.terminal.baud) if queued else None
+        self.renderer = Renderer(
+            "Dash",
+            pages,
+            False,
+            self.hass,
+            self.writer or self.terminal,
+            getProfile(profile),
+            PollScheduler(1.0, 30.0, self.clock),
+        )
+
+    def settle(self, seconds: float = 1.0) -> bytes:
+        # Lets time pass, polls and draws, returning what that sent.
+        before = len(self.terminal.output)
+        self.clock.now += seconds
+        self.renderer.refresh()
+        self.renderer.draw()
+        if self.writer is not None:
+            self.writer.flush()
+        return bytes(self.terminal.output[before:])
+
+    def type(self, keys: List[bytes]) -> Tuple[List[Any], bytes]:
+        # Types a batch of keys and draws, returning any actions and what was sent.
+        before = len(self.terminal.output)
+        actions = self.renderer.processInputs(keys)
+        self.renderer.draw()
+        if self.writer is not None:
+            self.writer.flush()
+        return actions, bytes(self.terminal.output[before:])
+
+    @property
+    def screen(self) -> str:
+        return self.terminal.dump()
+
+    @property
+    def inputLine(self) -> str:
+        return self.terminal.line(self.terminal.rows).rstrip()
+
+
+def keys(text: str) -> List[bytes]:
+    return [bytes([c]) for c in text.encode("ascii")]
+
+
+def switches(count: int) -> Dict[str, Tuple[str, str, Optional[str]]]:
+    return {
+        f"switch.s{i}": (f"Switch {i}", "on" if i % 2 == 0 else "off", None)
+        for i in range(count)
+    }
@@ -0,0 +1,106 @@
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import pytest
+import requests
+
+from vthass.api import CircuitBreaker, Entity, HomeAssistant, MultiHomeAssistant, ServiceCalls
+
+from .fakes import FakeHomeAssistant
+
+
+def multi() -> MultiHomeAssistant:
+    return MultiHomeAssistant(
+        {
+            "": FakeHomeAssistant({"switch.s0": ("Switch 0", "on", None)}),
+            "barn": FakeHomeAssistant({"switch.s1": ("Switch 1", "off", None)}),
+        }
+    )
+
+
+def test_multi_fetches_from_every_instance() -> None:
+    hass = multi()
+    entities = hass.getStates(["switch.s0", "barn:switch.s1"])
+    assert entities is not None
+    assert sorted(e.entity_id for e in entities) == ["barn:switch.s1", "switch.s0"]
+    assert all(e.api is hass for e in entities)
+    hass.close()
+
+
+def test_closing_lets_go_of_threads() -> None:
+    before = threading.active_count()
+    hass = multi()
+    hass.getStates(["switch.s0", "barn:switch.s1"])
+    hass.getHistory(["switch.s0", "barn:switch.s1"])
+    hass.close()
+
+    # Whatever is asked afterwards fails instead of starting threads back up.
+    assert hass.getStates(["switch.s0"]) is None
+    assert hass.callService("switch", "turn_on", ["switch.s0"]) is None
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread() and thread.name.startswith("ThreadPoolExecutor"):
+            thread.join(1.0)
+    assert threading.active_count() <= before
+
+
+class SlowHomeAssistant(FakeHomeAssistant):
+    # Service calls don't get an answer until the gate opens.
+    BACKGROUND_FETCH = True
+
+    def __init__(self) -> None:
+        super().__init__({"switch.s0": ("Switch 0", "off", None)})
+        self.gate = threading.Event()
+
+    def _request(self, method: str, path: str, body: Optional[Dict[str, Any]] = None) -> Any:
+        if method == "POST":
+            self.gate.wait()
+        return super()._request(method, path, body)
+
+
+def test_service_calls_happen_in_the_background() -> None:
+    hass = SlowHomeAssistant()
+    calls = ServiceCalls(hass)
+    calls.call("switch", "turn_on", ["switch.s0"])
+    assert calls.collect() == []
+
+    hass.gate.set()
+    results: List[Optional[List[Entity]]] = []
+    deadline = time.monotonic() + 5.0
+    while not results and time.monotonic() < deadline:
+        results = calls.collect()
+        time.sleep(0.01)
+
+    # Home Assistant didn't say what changed, so it got asked afterwards.
+    assert len(results) == 1 and results[0] is not None
+    assert [e.entity_id for e in results[0]] == ["switch.s0"]
+    assert hass.calls == [("api/services/switch/turn_on", {"entity_id": ["switch.s0"]})]
+
+
+@pytest.mark.parametrize("status,trips", [(401, False), (400, False), (500, True), (503, True)])
+def test_only_server_errors_trip_the_breaker(
+    monkeypatch: pytest.MonkeyPatch, status: int, trips: bool
+) -> None:
+    def answer(*args: Any, **kwargs: Any) -> requests.Response:
+        response = requests.Response()
+        response.status_code = status
+        return response
+
+    monkeypatch.setattr(requests, "get", answer)
+    hass = HomeAssistant("http://127.0.0.1:9/", "token")
+    for _ in range(hass.breaker.threshold):
+        with pytest.raises(requests.HTTPError):
+            hass._request("GET", "api/states")
+    assert (hass.breaker.state == CircuitBreaker.OPEN) == trips
+
+
+def test_missing_service_is_a_failure(monkeypatch: pytest.MonkeyPatch) -> None:
+    def answer(*args: Any, **kwargs: Any) -> requests.Response:
+        response = requests.Response()
+        response.status_code = 404
+        return response
+
+    monkeypatch.setattr(requests, "post", answer)
+    hass = HomeAssistant("http://127.0.0.1:9/", "token")
+    assert hass.callService("switch", "turn_sideways", ["switch.s0"]) is None
+    assert hass.breaker.state == CircuitBreaker.CLOSED
@@ -0,0 +1,85 @@
+import json
+from pathlib import Path
+from typing import Optional
+
+import pytest
+
+from vthass.capabilities import MAX_AGE, cachedProfile, getProfile, identify, profileFor, saveProfile
+from vthass.emulator import EmulatedTerminal
+from vthass.trace import ReplayClock
+
+
+@pytest.mark.parametrize(
+    "identity,profile",
+    [
+        (b"1;2", "vt100"),
+        (b"1;0", "vt100"),
+        (b"12;7;1;10;16", "vt100"),
+        (b"4;6", "vt102"),
+        (b"6", "vt102"),
+        (b"62;1;2;6;8;9;15", "vt220"),
+        (b"64;1;2;6;9;15;18;21;22", "vt220"),
+        (b"65;1;9", "vt220"),
+        (b"7", None),
+        (b"", None),
+        (b"x;1", None),
+    ],
+)
+def test_profile_for(identity: bytes, profile: Optional[str]) -> None:
+    assert profileFor(identity) == profile
+
+
+def test_identify() -> None:
+    assert identify(EmulatedTerminal(identity=b"[?6c"), 0.5) == "vt102"
+    assert identify(EmulatedTerminal(identity=b"[?62;1;6c"), 0.5) == "vt220"
+
+
+def test_auto_falls_back_to_vt100() -> None:
+    assert getProfile("auto").name == "vt100"
+    assert getProfile("VT102").insertDelete
+    with pytest.raises(Exception):
+        getProfile("vt52")
+
+
+def test_cached_profile_expires(tmp_path: Path) -> None:
+    clock = ReplayClock()
+    clock.now = 1000.0
+    directory = str(tmp_path / "cache")
+    saveProfile(directory, "/dev/ttyUSB0", "vt102", clock)
+    saveProfile(directory, "/dev/ttyUSB1", "vt220", clock)
+
+    assert cachedProfile(directory, "/dev/ttyUSB0", clock=clock) == "vt102"
+    assert cachedProfile(directory, "/dev/ttyUSB1", clock=clock) == "vt220"
+    assert cachedProfile(directory, "/dev/ttyUSB2", clock=clock) is None
+
+    clock.now += MAX_AGE
+    assert cachedProfile(directory, "/dev/ttyUSB0", clock=clock) == "vt102"
+    clock.now += 1.0
+    assert cachedProfile(directory, "/dev/ttyUSB0", clock=clock) is None
+
+    # A clock that went backwards doesn't get to trust it either.
+    clock.now = 0.0
+    assert cachedProfile(directory, "/dev/ttyUSB0", clock=clock) is None
+
+    # Identifying it again starts the week over.
+    clock.now = 1000.0 + MAX_AGE * 2
+    saveProfile(directory, "/dev/ttyUSB0", "vt100", clock)
+    assert cachedProfile(directory, "/dev/ttyUSB0", clock=clock) == "vt100"
+    assert cachedProfile(directory, "/dev/ttyUSB1", clock=clock) is None
+
+
+def test_unusable_cache_is_ignored(tmp_path: Path) -> None:
+    directory = str(tmp_path)
+    assert cachedProfile(directory, "/dev/ttyUSB0") is None
+
+    # Entries from before they were dated, or naming profiles we don't have.
+    (tmp_path / "terminals.json").write_text(
+        json.dumps({"/dev/ttyUSB0": "vt102", "/dev/ttyUSB1": {"profile": "vt52", "identified": 0.0}})
+    )
+    assert cachedProfile(directory, "/dev/ttyUSB0", clock=lambda: 1.0) is None
+    assert cachedProfile(directory, "/dev/ttyUSB1", clock=lambda: 1.0) is None
+
+    (tmp_path / "terminals.json").write_text("{")
+    assert cachedProfile(directory, "/dev/ttyUSB0") is None
+    saveProfile(directory, "/dev/ttyUSB0", "vt102", lambda: 1.0)
+    assert cachedProfile(directory, "/dev/ttyUSB0", clock=lambda: 2.0) == "vt102"
@@ -0,0 +1,250 @@
+import re
+
+import pytest
+from vtpy import Terminal
+
+from vthass.config import Entity, Page
+from vthass.render import SettingAction
+
+from .fakes import Dashboard, keys, switches
+
+
+@pytest.fixture
+def dashboard() -> Dashboard:
+    states = switches(4)
+    states["sensor.power"] = ("Power", "1000", "W")
+    pages = [
+        Page(
+            "Lights",
+            [Entity(f"switch.s{i}", None, None) for i in range(4)]
+            + [Entity("<hr>", None, None), Entity("sensor.power", None, None)],
+        ),
+        Page("Other", [Entity("<label Nothing to see here>", None, None)]),
+    ]
+    dash = Dashboard(pages, states)
+    dash.renderer.draw()
+    dash.settle()
+    return dash
+
+
+def test_first_paint(dashboard: Dashboard) -> None:
+    screen = dashboard.screen
+    assert dashboard.terminal.line(1).startswith("Dash")
+    assert "Lights" in screen and "Other" in screen
+    for i in range(4):
+        assert f"Switch {i}" in screen
+    assert "Power" in screen and "1000 W" in screen
+    assert " ... " not in screen
+    assert not dashboard.renderer.loading
+
+    # The whole first screen, placeholders and all, fits in a couple of seconds at 9600 baud.
+    assert dashboard.terminal.bytesOut < 2000
+
+
+def test_idle_frames_send_nothing(dashboard: Dashboard) -> None:
+    assert dashboard.settle() == b""
+    assert dashboard.settle(30.0) == b""
+
+
+def test_sensor_update_sends_only_the_value(dashboard: Dashboard) -> None:
+    dashboard.hass.states["sensor.power"] = ("Power", "1250", "W")
+    sent = dashboard.settle()
+    assert "1250 W" in dashboard.screen
+    assert b"Power" not in sent and b"Switch" not in sent
+    assert 0 < len(sent) < 60
+
+
+def test_sensor_shrink_leaves_nothing_behind(dashboard: Dashboard) -> None:
+    dashboard.hass.states["sensor.power"] = ("Power", "5", "W")
+    dashboard.settle()
+    row = next(line for line in dashboard.terminal.lines() if "Power" in line)
+    assert "5 W" in row
+    assert "000" not in row and "W W" not in row
+
+
+def test_switch_toggle(dashboard: Dashboard) -> None:
+    dashboard.type(keys("toggle switch 1") + [b"\n"])
+    assert dashboard.hass.calls == [("api/services/switch/turn_on", {"entity_id": ["switch.s1"]})]
+    assert dashboard.inputLine == ""
+
+
+def test_failed_toggle_shows_an_error(dashboard: Dashboard) -> None:
+    dashboard.hass.failing = True
+    dashboard.type(keys("toggle switch 1") + [b"\n"])
+    dashboard.settle()
+    assert "Failed to update switches!" in dashboard.screen
+    assert dashboard.inputLine == ""
+
+
+def test_typeahead_echo(dashboard: Dashboard) -> None:
+    _, sent = dashboard.type(keys("toggle"))
+    assert dashboard.inputLine == "toggle"
+    # One batch of typing is one echo, not a redraw of the input line per key.
+    assert sent.count(b"toggle") == 1
+    assert len(sent) < 30
+
+    _, sent = dashboard.type(keys("s"))
+    assert dashboard.inputLine == "toggles"
+    assert b"toggle" not in sent
+    assert len(sent) < 20
+
+
+def test_typeahead_after_setting(dashboard: Dashboard) -> None:
+    actions, _ = dashboard.type(keys("set cols=99") + [b"\n"] + keys("exit"))
+    assert len(actions) == 1
+    assert isinstance(actions[0], SettingAction)
+    assert (actions[0].setting, actions[0].value) == ("cols", "99")
+
+    # Whatever was typed after the setting starts a fresh command, untouched.
+    actions, _ = dashboard.type([])
+    assert actions == []
+    assert dashboard.inputLine == "exit"
+
+
+def test_tab_switch(dashboard: Dashboard) -> None:
+    _, sent = dashboard.type([b">"])
+    screen = dashboard.screen
+    assert "Nothing to see here" in screen
+    assert "Switch 0" not in screen and "1000 W" not in screen
+    assert len(sent) < 1000
+
+    dashboard.type([b"<"])
+    screen = dashboard.screen
+    assert "Switch 0" in screen and "1000 W" in screen
+    assert "Nothing to see here" not in screen
+
+
+def lots(profile: str = "vt100") -> Dashboard:
+    dash = Dashboard(
+        [Page("Lots", [Entity(f"switch.s{i}", None, None) for i in range(60)])],
+        switches(60),
+        profile,
+    )
+    dash.renderer.draw()
+    dash.settle()
+    return dash
+
+
+def test_scroll() -> None:
+    stepped = lots()
+    assert "Switch 0" in stepped.screen
+    assert "Switch 59" not in stepped.screen
+
+    # Scrolling a little at a time moves what's on screen and only draws what's new.
+    costs = [len(stepped.type([Terminal.DOWN] * 2)[1]) for _ in range(20)]
+    assert "Switch 40" in stepped.screen
+    assert "Switch 0 " not in stepped.screen
+    assert max(costs) < 200
+
+    # Which ends up looking the same as going straight there.
+    jumped = lots()
+    jumped.type([Terminal.DOWN] * 40)
+    assert stepped.screen == jumped.screen
+
+
+@pytest.mark.parametrize("profile", ["vt100", "vt102"])
+def test_editing_the_input_line(profile: str) -> None:
+    dash = Dashboard([Page("Empty", [])], {}, profile)
+    dash.renderer.draw()
+    dash.type(keys("toggle lamp"))
+
+    # Back up to just after "toggle", then insert and delete in the middle of the line.
+    dash.type([Terminal.LEFT] * 5)
+    _, inserted = dash.type(keys("d"))
+    assert dash.inputLine == "toggled lamp"
+    _, deleted = dash.type([Terminal.BACKSPACE])
+    assert dash.inputLine == "toggle lamp"
+
+    if profile == "vt102":
+        # Inserting and deleting characters leaves the rest of the line where it is.
+        assert b"\x1b[1@" in inserted and b"\x1b[1P" in deleted
+        assert b"lamp" not in inserted and b"lamp" not in deleted
+        assert len(inserted) < 24 and len(deleted) < 40
+    else:
+        # Everything after the cursor gets sent again.
+        assert b" lamp" in inserted and b" lamp" in deleted
+
+
+def test_132_columns(dashboard: Dashboard) -> None:
+    before = dashboard.terminal.bytesOut
+    dashboard.terminal.set132Columns()
+    dashboard.renderer.draw()
+    assert dashboard.terminal.columns == 132
+
+    # The panel around the tabs stretches across the whole width, everything else is
+    # drawn again as it was.
+    assert len(dashboard.terminal.line(2).rstrip()) == 132
+    screen = dashboard.screen
+    for i in range(4):
+        assert f"Switch {i}" in screen
+    assert "1000 W" in screen
+    assert dashboard.terminal.bytesOut - before < 2500
+
+
+def test_missing_entities() -> None:
+    dash = Dashboard(
+        [
+            Page(
+                "Odd",
+                [
+                    Entity("switch.s0", None, None),
+                    Entity("switch.gone", None, None),
+                    Entity("vacuum.robot", None, None),
+                ],
+            )
+        ],
+        switches(1),
+    )
+    dash.renderer.draw()
+    assert dash.renderer.loading
+    dash.settle()
+    screen = dash.screen
+    assert "UNKNOWN ENTITY switch.gone" in screen
+    assert "UNSUPPORTED ENTITY vacuum.robot" in screen
+    assert not dash.renderer.loading
+
+    # It still shows up, if it ever exists.
+    dash.hass.states["switch.gone"] = ("Back Again", "on", None)
+    dash.settle(120.0)
+    assert "Back Again" in dash.screen
+    assert "UNKNOWN ENTITY" not in dash.screen
+
+
+def test_history_line_shrinks_cleanly() -> None:
+    dash = Dashboard(
+        [Page("Power", [Entity("sensor.power", None, "W", "minmax")])],
+        {"sensor.power": ("Power", "1000", "W")},
+    )
+    dash.renderer.draw()
+    dash.settle()
+    for state in ["5", "6"]:
+        dash.hass.states["sensor.power"] = ("Power", state, "W")
+        dash.settle()
+
+    # Nothing is left over from the longer line drawn before.
+    row = next(line for line in dash.terminal.lines() if " min " in line).rstrip()
+    assert re.fullmatch(r" min 5 avg [0-9.]+ max 1000", row)
+
+
+def test_scroll_back_over_tall_objects() -> None:
+    # Objects scrolled back into view land on blank rows, so all of them gets drawn
+    # again and not just whatever changed since they were last on screen.
+    dash = Dashboard(
+        [Page("Power", [Entity(f"sensor.p{i}", None, "W", "minmax") for i in range(30)])],
+        {f"sensor.p{i}": (f"Power {i}", str(i), "W") for i in range(30)},
+    )
+    dash.renderer.draw()
+    dash.settle()
+
+    def whole() -> bool:
+        lines = dash.terminal.lines()
+        return all(
+            lines[row - 1].startswith(" Power")
+            for row, line in enumerate(lines)
+            if line.startswith(" min")
+        )
+
+    for key in [Terminal.DOWN] * 15 + [Terminal.UP] * 15:
+        dash.type([key])
+        assert whole()
+    assert "Power 0 " in dash.screen
@@ -0,0 +1,80 @@
+from typing import List, Optional
+
+from vthass.api import SwitchEntity
+from vthass.render import HorizontalRuleObject, Object, SelectionIndex, SwitchObject
+
+from .fakes import FakeHomeAssistant
+
+
+def index(*names: str) -> SelectionIndex:
+    hass = FakeHomeAssistant({})
+    objects: List[Object] = [HorizontalRuleObject()]
+    for i, name in enumerate(names):
+        objects.append(SwitchObject(SwitchEntity(hass, f"switch.s{i}", name, False), None))
+    return SelectionIndex(objects)
+
+
+def name(obj: Optional[Object]) -> Optional[str]:
+    return None if obj is None else obj.name
+
+
+def test_exact_name_wins() -> None:
+    selection = index("Lamp", "Lamp Post", "Desk Lamp")
+    assert name(selection.resolve("lamp")) == "Lamp"
+    assert name(selection.resolve("LAMP POST")) == "Lamp Post"
+
+
+def test_unique_prefix_beats_ambiguous_substring() -> None:
+    # "li" is part of two names, but only one of them starts with it.
+    selection = index("Living Room", "Kitchen Light", "Porch")
+    assert name(selection.resolve("li")) == "Living Room"
+    assert name(selection.resolve("kit")) == "Kitchen Light"
+
+
+def test_unique_substring() -> None:
+    selection = index("Living Room", "Kitchen Light", "Porch")
+    assert name(selection.resolve("ght")) == "Kitchen Light"
+    assert name(selection.resolve("chen lig")) == "Kitchen Light"
+    assert name(selection.resolve("o")) is None
+    assert name(selection.resolve("garage")) is None
+    assert name(selection.resolve("")) is None
+
+
+def test_ambiguous_names_resolve_to_nothing() -> None:
+    # Neither a prefix nor a substring picks out a single switch.
+    selection = index("Kitchen Light", "Kitchen Fan", "Hall Light")
+    assert selection.resolve("kitchen") is None
+    assert selection.resolve("light") is None
+    assert [o.name for o in selection.matches("light")] == ["Kitchen Light", "Hall Light"]
+    assert [o.name for o in selection.matches("KITCHEN")] == ["Kitchen Light", "Kitchen Fan"]
+
+
+def test_rebuild_after_rename() -> None:
+    selection = index("Kitchen Light", "Kitchen Fan")
+    assert selection.resolve("fan") is not None
+
+    switch = selection.objects[2]
+    assert isinstance(switch, SwitchObject)
+    switch.entity.name = "Ceiling Fan"
+
+    # Until it's rebuilt, the index still knows it by its old name.
+    assert name(selection.resolve("kitchen f")) == "Ceiling Fan"
+    assert selection.resolve("ceiling") is None
+
+    selection.rebuild()
+    assert selection.resolve("kitchen f") is None
+    assert name(selection.resolve("ceiling")) == "Ceiling Fan"
+    assert name(selection.resolve("eil")) == "Ceiling Fan"
+    assert name(selection.resolve("kitchen")) == "Kitchen Light"
+
+
+def test_selection_skips_what_cant_be_selected() -> None:
+    selection = index("One", "Two")
+    assert selection.positions == [1, 2]
+    assert selection.selected is None and not selection.move(1)
+
+    selection.current = 0
+    selection.objects[1].selected = True
+    assert selection.move(1) and selection.selected == 2
+    assert not selection.move(1)
+    assert selection.objects[2].selected and not selection.objects[1].selected
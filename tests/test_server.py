@@ -0,0 +1,77 @@
+from typing import List, Set
+
+from vthass.api import SensorEntity, SwitchEntity
+from vthass.scheduler import PollScheduler
+from vthass.server import FeedHomeAssistant, SharedFeed
+from vthass.trace import ReplayClock
+
+from .fakes import FakeHomeAssistant
+
+
+def feed() -> SharedFeed:
+    hass = FakeHomeAssistant(
+        {
+            "switch.s0": ("Switch 0", "on", None),
+            "sensor.power": ("Power", "1000", "W"),
+        }
+    )
+    shared = SharedFeed(hass, 1.0)
+    shared.refresh()
+    return shared
+
+
+def test_only_changed_states_are_decoded_again() -> None:
+    shared = feed()
+    switch = shared.entities["switch.s0"]
+    sensor = shared.entities["sensor.power"]
+
+    heard: List[Set[str]] = []
+    shared.listeners.add(heard.append)
+    assert isinstance(shared.api, FakeHomeAssistant)
+    shared.api.states["sensor.power"] = ("Power", "1250", "W")
+    shared.refresh()
+    shared.refresh()
+
+    assert heard == [{"sensor.power"}]
+    assert shared.entities["switch.s0"] is switch
+    assert shared.entities["sensor.power"] is not sensor
+
+
+def test_sessions_get_their_own_copies() -> None:
+    shared = feed()
+    first = FeedHomeAssistant(shared).getStates(["switch.s0", "sensor.power", "switch.gone"])
+    second = FeedHomeAssistant(shared).getStates(["switch.s0"])
+    assert first is not None and second is not None
+    assert [e.entity_id for e in first] == ["switch.s0", "sensor.power"]
+
+    # Merging into one dashboard's entities leaves every other dashboard's alone.
+    switch = first[0]
+    assert isinstance(switch, SwitchEntity) and isinstance(second[0], SwitchEntity)
+    switch._merge(SwitchEntity(switch.api, "switch.s0", "Renamed", False))
+    assert second[0].name == "Switch 0" and second[0].state
+    assert shared.entities["switch.s0"].api is shared.api
+    assert isinstance(first[1], SensorEntity) and first[1].api is switch.api
+
+
+def test_only_visible_changes_wake_a_session() -> None:
+    shared = feed()
+    clock = ReplayClock()
+    scheduler = PollScheduler(1.0, 30.0, clock)
+    scheduler.track(["switch.s0", "sensor.power"])
+    scheduler.setVisible(["sensor.power"])
+    scheduler.polled(["switch.s0", "sensor.power"], [])
+    assert scheduler.due() == []
+
+    woken: List[bool] = []
+    shared.listeners.add(lambda changed: woken.append(scheduler.hurry(changed)))
+    assert isinstance(shared.api, FakeHomeAssistant)
+    shared.api.states["switch.s0"] = ("Switch 0", "off", None)
+    shared.refresh()
+    assert woken == [False]
+    assert scheduler.due() == []
+
+    # Something on screen changing gets it fetched right away.
+    shared.api.states["sensor.power"] = ("Power", "5", "W")
+    shared.refresh()
+    assert woken == [False, True]
+    assert scheduler.due() == ["sensor.power"]
@@ -0,0 +1,106 @@
+import threading
+
+from vtpy import Terminal
+
+from vthass.config import Entity, Page
+from vthass.emulator import EmulatedTerminal
+from vthass.writer import WriterTerminal
+
+from .fakes import Dashboard
+
+
+class GatedTerminal(EmulatedTerminal):
+    # Holds the writer thread up for as long as the gate is closed, the same way a
+    # terminal that sent XOFF would, so that output backs up in the writer's queue.
+    def __init__(self) -> None:
+        super().__init__()
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def _write(self, data: bytes) -> None:
+        self.gate.wait()
+        super()._write(data)
+
+
+def plug(writer: WriterTerminal) -> None:
+    # Gives the writer thread something to get stuck on, without touching the screen.
+    writer.sendCommand(Terminal.SAVE_CURSOR)
+    writer.sendCommand(Terminal.RESTORE_CURSOR)
+    writer.flush()
+
+
+def draw(writer: WriterTerminal, key: str, row: int, text: str) -> None:
+    writer.moveCursor(row, 1)
+    with writer.region(key):
+        writer.sendText(text)
+    writer.flush()
+
+
+def test_unsent_region_is_replaced() -> None:
+    terminal = GatedTerminal()
+    writer = WriterTerminal(terminal, terminal.baud)
+    terminal.gate.clear()
+    plug(writer)
+
+    draw(writer, "value", 5, "first")
+    assert writer.queued("value")
+    draw(writer, "value", 5, "second")
+    assert writer.replaced == 1
+
+    terminal.gate.set()
+    writer.drain()
+    assert not writer.queued("value")
+    assert terminal.line(5).rstrip() == "second"
+    assert b"first" not in terminal.output
+    writer.close()
+
+
+def test_barrier_keeps_older_region() -> None:
+    terminal = GatedTerminal()
+    writer = WriterTerminal(terminal, terminal.baud)
+    terminal.gate.clear()
+    plug(writer)
+
+    # Scrolling moves the first copy somewhere else, so it has to be drawn before the
+    # second one can go out.
+    draw(writer, "value", 5, "first")
+    writer.moveCursor(1, 1)
+    writer.sendCommand(b"D")
+    draw(writer, "value", 5, "second")
+    assert writer.replaced == 0
+
+    terminal.gate.set()
+    writer.drain()
+    assert b"first" in terminal.output and b"second" in terminal.output
+    writer.close()
+
+
+def test_replaced_sensor_value_leaves_nothing_behind() -> None:
+    terminal = GatedTerminal()
+    dash = Dashboard(
+        [Page("Power", [Entity("sensor.power", None, None)])],
+        {"sensor.power": ("Power", "1234.56789", "W")},
+        terminal=terminal,
+        queued=True,
+    )
+    assert dash.writer is not None
+    dash.renderer.draw()
+    dash.settle()
+    dash.writer.drain()
+    assert "1234.56789 W" in dash.screen
+
+    # The shorter value is thrown away before it ever makes it to the screen, so the
+    # one that replaces it has to cover everything the long one drew.
+    terminal.gate.clear()
+    plug(dash.writer)
+    for state in ["12.3", "9"]:
+        dash.hass.states["sensor.power"] = ("Power", state, "W")
+        dash.settle()
+    assert dash.writer.replaced >= 1
+
+    terminal.gate.set()
+    dash.writer.drain()
+    row = next(line for line in terminal.lines() if " W" in line).rstrip()
+    assert row.endswith(" 9 W")
+    assert "789" not in row
+    dash.writer.close()
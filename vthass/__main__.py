@@ -1,118 +1,255 @@
 import argparse
+import asyncio
+import cProfile
+import logging
 import sys
 import time
 import threading
-from multiprocessing import Process
-from typing import Optional
+from typing import Callable, List, Optional, Tuple
 
 from vtpy import SerialTerminal, Terminal, TerminalException
 
-from .api import HomeAssistant
-from .config import Config
-from .monitor import monitoring_thread
-from .render import Renderer, SettingAction, ExitAction
+from .api import BackgroundFetch, HomeAssistant, MultiHomeAssistant, connect
+from .capabilities import AUTO, FALLBACK, Capabilities, cachedProfile, getProfile, identify, saveProfile
+from .config import Config, ConfigWatcher, cacheDir
+from .log import startLogging, stopLogging
+from .monitor import Monitor
+from .server import TerminalServer
+from .session import session
+from .soak import soak
+from .trace import (
+    META,
+    OUTPUT,
+    RecordingHomeAssistant,
+    RecordingTerminal,
+    ReplayClock,
+    ReplayHomeAssistant,
+    ReplayTerminal,
+    TraceReader,
+    TraceWriter,
+)
+
+
+logger = logging.getLogger("vthass.main")
+
+# How often to mention that we're still waiting on the terminal.
+WAITING_INTERVAL = 60.0
 
 
 def spawnTerminal(port: str, baudrate: int, flow: bool) -> Terminal:
-    print("Attempting to contact VT-100...", end="")
-    sys.stdout.flush()
+    logger.info("Attempting to contact VT-100...")
+    started = time.monotonic()
+    mentioned = started
 
     while True:
         try:
             terminal = SerialTerminal(port, baudrate, flowControl=flow)
-            print("SUCCESS!")
+            logger.info("Contacted VT-100!")
 
             break
         except TerminalException:
             # Wait for terminal to re-awaken.
             time.sleep(1.0)
 
-            print(".", end="")
-            sys.stdout.flush()
+            if time.monotonic() - mentioned >= WAITING_INTERVAL:
+                mentioned = time.monotonic()
+                logger.info(f"Still waiting on VT-100 after {int(mentioned - started)}s...")
 
     return terminal
 
 
-def main(config: Config) -> None:
+def terminalProfile(config: Config, terminal: Terminal) -> Capabilities:
+    # Works out what the terminal can do, unless the config says. Terminals are only
+    # asked the first time they're seen on a port, and again once that answer is old
+    # enough that the terminal might have been swapped out since.
+    if config.terminal_profile.lower() != AUTO:
+        return getProfile(config.terminal_profile)
+
+    name = cachedProfile(cacheDir(), config.terminal_port)
+    if name is None:
+        name = identify(terminal)
+        if name is None:
+            logger.info(f"VT-100 didn't identify itself, assuming it is a {FALLBACK}.")
+            return getProfile(FALLBACK)
+
+        logger.info(f"VT-100 identified itself as a {name}.")
+        saveProfile(cacheDir(), config.terminal_port, name)
+    return getProfile(name)
+
+
+def main(config: Config, record: Optional[str] = None) -> None:
     if config.homeassistant_uri is None or config.homeassistant_token is None:
         raise Exception(
             "Expected configuration file to include Home Assistant URI and API Token!"
         )
 
-    exiting = False
-    while not exiting:
-        hass = HomeAssistant(config.homeassistant_uri, config.homeassistant_token)
-        terminal = spawnTerminal(config.terminal_port, config.terminal_baud, config.terminal_flow)
-        renderer = Renderer(
-            config.dashboard_name or "Home Assistant Dashboard",
-            config.layout,
-            config.display_help,
-            hass,
-            terminal,
-        )
-        renderer.draw()
+    if config.server_port is not None:
+        if record:
+            raise Exception("Recording sessions is not supported when serving dashboards over the network!")
 
         try:
-            last_poll = time.time()
-
-            while not exiting:
-                # Poll for updates from home assistant.
-                if (time.time() - last_poll) > 1.0:
-                    renderer.refresh()
-                    last_poll = time.time()
-
-                # Refresh for updates from home assistant.
-                renderer.draw()
-
-                # Grab input, de-duplicate held down up/down presses so they don't queue up.
-                # This can cause the entire message loop to desync as we pile up requests to
-                # scroll the screen, ultimately leading in rendering issues and a crash.
-                inputVal = terminal.recvInput()
-                if inputVal in {Terminal.UP, Terminal.DOWN}:
-                    while inputVal == terminal.peekInput():
-                        terminal.recvInput()
-
-                if inputVal:
-                    action = renderer.processInput(inputVal)
-                    if isinstance(action, SettingAction):
-                        if action.setting in {"cols", "columns"}:
-                            if action.value not in {"80", "132"}:
-                                renderer.displayError(
-                                    f"Unrecognized column setting {action.value}"
-                                )
-                            elif action.value == "80":
-                                if terminal.columns != 80:
-                                    terminal.set80Columns()
-                                    renderer.clearInput()
-                                    renderer.draw()
-                                else:
-                                    renderer.clearInput()
-                            elif action.value == "132":
-                                if terminal.columns != 132:
-                                    terminal.set132Columns()
-                                    renderer.clearInput()
-                                    renderer.draw()
-                                else:
-                                    renderer.clearInput()
-                        else:
-                            renderer.displayError(
-                                f"Unrecognized setting {action.setting}"
-                            )
-                    elif isinstance(action, ExitAction):
-                        print("Got request to end session!")
-                        exiting = True
-
-        except TerminalException:
-            # Terminal went away mid-transaction.
-            print("Lost terminal, will attempt a reconnect.")
+            asyncio.run(TerminalServer(config).run())
         except KeyboardInterrupt:
-            print("Got request to end session!")
-            exiting = True
+            logger.info("Got request to stop serving dashboards!")
+        return
+
+    # Catch a misspelled profile now, instead of once the terminal is connected.
+    getProfile(config.terminal_profile)
+    watcher = ConfigWatcher(config)
+    trace = TraceWriter(record) if record else None
+
+    try:
+        exiting = False
+        while not exiting:
+            config = watcher.config
+            began = time.perf_counter()
+
+            if trace:
+                hass = connect(
+                    config.homeassistant_uri or "",
+                    config.homeassistant_token or "",
+                    config.homeassistant_backends,
+                    lambda name, uri, token: RecordingHomeAssistant(uri, token, trace, name),
+                )
+            else:
+                hass = connect(
+                    config.homeassistant_uri or "",
+                    config.homeassistant_token or "",
+                    config.homeassistant_backends,
+                    lambda name, uri, token: HomeAssistant(uri, token),
+                )
+
+            # Start fetching everything while we wait on the terminal, instead of only once
+            # it's ready to be drawn on.
+            fetcher = BackgroundFetch(hass)
+            fetcher.start()
+
+            terminal = spawnTerminal(config.terminal_port, config.terminal_baud, config.terminal_flow)
+            capabilities = terminalProfile(config, terminal)
+
+            if trace:
+                # Describe the session so that it can be replayed without the original config,
+                # which the compiled layout does without any access tokens.
+                compiled = dict(config.compiled)
+                compiled["terminal_profile"] = capabilities.name
+                trace.writeJson(
+                    META,
+                    {"rows": terminal.rows, "columns": terminal.columns, "config": compiled},
+                )
+
+                recording = RecordingTerminal(terminal, trace)
+                frame: Optional[Callable[[], None]] = recording.flush
+                sessionTerminal: Terminal = recording
+            else:
+                frame = None
+                sessionTerminal = terminal
+
+            try:
+                exiting = session(
+                    config,
+                    hass,
+                    sessionTerminal,
+                    capabilities,
+                    watcher,
+                    frame=frame,
+                    threaded=True,
+                    fetcher=fetcher,
+                    began=began,
+                )
+            except KeyboardInterrupt:
+                logger.info("Got request to end session!")
+                exiting = True
+            finally:
+                # Every reconnect gets a fresh client, so don't leave this one's threads behind.
+                hass.close()
+    finally:
+        # Whatever was recorded is still worth keeping when we stop because of an error.
+        if trace:
+            trace.close()
 
     # Restore the screen before exiting.
     terminal.reset()
 
 
+def replay(path: str, profile: Optional[str] = None) -> None:
+    # Drive the real main loop from a recorded trace as fast as possible, with no
+    # terminal or Home Assistant attached, and report how each frame performed.
+    reader = TraceReader(path)
+    config = Config.fromCompiled(reader.meta()["config"])
+    clock = ReplayClock()
+    backends = {
+        name: ReplayHomeAssistant(reader, name)
+        for name in ["", *config.homeassistant_backends]
+    }
+    hass = MultiHomeAssistant(backends) if len(backends) > 1 else backends[""]
+    times = sorted(t for backend in backends.values() for t in backend.times)
+    terminal = ReplayTerminal(reader, clock)
+
+    recorded = sum(len(payload) for _, payload in reader.of(OUTPUT))
+    frames: List[Tuple[float, int]] = []
+    lastTime = time.perf_counter()
+    lastBytes = 0
+
+    def frame() -> None:
+        nonlocal lastTime, lastBytes
+
+        now = time.perf_counter()
+        frames.append((now - lastTime, len(terminal.output) - lastBytes))
+        lastTime = now
+        lastBytes = len(terminal.output)
+
+        # Jump straight to whatever happened next in the recording.
+        upcoming = [t for t in times if t > clock.now]
+        if terminal.nextInput is not None and terminal.nextInput > clock.now:
+            upcoming.append(terminal.nextInput)
+        clock.now = min(upcoming) if upcoming else max(clock.now, terminal.end)
+
+    profiler = cProfile.Profile() if profile else None
+    if profiler:
+        profiler.enable()
+
+    start = time.perf_counter()
+
+    # Fetch everything up front the same way a live session does while it waits on the terminal.
+    fetcher = BackgroundFetch(hass)
+    fetcher.start()
+    session(
+        config,
+        hass,
+        terminal,
+        getProfile(config.terminal_profile),
+        clock=clock,
+        frame=frame,
+        fetcher=fetcher,
+        began=start,
+    )
+    elapsed = time.perf_counter() - start
+    hass.close()
+
+    if profiler:
+        profiler.disable()
+        profiler.dump_stats(profile or "")
+
+    times = sorted(t for t, _ in frames) or [0.0]
+    sizes = [b for _, b in frames] or [0]
+
+    def percentile(p: float) -> float:
+        return times[min(int(len(times) * p), len(times) - 1)] * 1000.0
+
+    print(f"Replayed {reader.duration:.1f}s of recorded session in {elapsed:.3f}s.")
+    print(f"Frames: {len(frames)} total, {sum(1 for b in sizes if b)} with output.")
+    print(
+        f"Frame time: p50 {percentile(0.5):.3f}ms, p99 {percentile(0.99):.3f}ms, "
+        f"max {times[-1] * 1000.0:.3f}ms."
+    )
+    print(
+        f"Output: {len(terminal.output)} bytes replayed, {recorded} bytes recorded, "
+        f"{max(sizes)} bytes in largest frame."
+    )
+    if profile:
+        print(f"Profile written to {profile}.")
+
+
 def cli() -> None:
     parser = argparse.ArgumentParser(
         description="Dashboard frontend for Home Assistant that talks to VT-100 compatible terminals.",
@@ -124,27 +261,70 @@ def cli() -> None:
         default="config.yaml",
         help="Configuration file for dashboard. Defaults to config.yaml",
     )
+    parser.add_argument(
+        "--record",
+        metavar="TRACE",
+        type=str,
+        default=None,
+        help="Record Home Assistant responses and terminal traffic to a trace file for later replay.",
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="TRACE",
+        type=str,
+        default=None,
+        help="Replay a recorded trace against a fake terminal and report per-frame timing.",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="FILE",
+        type=str,
+        default=None,
+        help="When replaying, also write a cProfile dump of the replay to this file.",
+    )
+    parser.add_argument(
+        "--soak",
+        metavar="DAYS",
+        type=float,
+        default=None,
+        help="Run against a simulated terminal and Home Assistant for this many simulated days, failing on memory or frame time growth.",
+    )
     args = parser.parse_args()
+
+    # Replays and soak runs log through the same path as everything else, so that what
+    # they have to say doesn't get lost.
+    if args.soak is not None:
+        startLogging()
+        try:
+            passed = soak(Config(args.config), args.soak)
+        finally:
+            stopLogging()
+        sys.exit(0 if passed else 1)
+
+    if args.replay:
+        startLogging()
+        try:
+            replay(args.replay, args.profile)
+        finally:
+            stopLogging()
+        return
+
     config = Config(args.config)
-    proc: Optional[Process] = None
-
-    # Start monitor just in case we want to monitor this from the main home assistant instance.
-    if config.homeassistant_monitoring_port is not None:
-        proc = Process(
-            target=monitoring_thread,
-            args=(
-                config.homeassistant_monitoring_port,
-                "1.0.0",
-            ),
-        )
-        proc.start()
+    startLogging()
+    monitor: Optional[Monitor] = None
 
     try:
-        main(config)
+        # Start monitor just in case we want to monitor this from the main home assistant instance.
+        if config.homeassistant_monitoring_port is not None:
+            monitor = Monitor(config.homeassistant_monitoring_port, "1.0.0")
+            monitor.start()
+
+        main(config, args.record)
     finally:
-        # Kill monitor thread now that we're out.
-        if proc:
-            proc.terminate()
+        # Kill monitor thread now that we're out, and get the last of the logs written.
+        if monitor:
+            monitor.stop()
+        stopLogging()
 
     # Wait until all application threads have terminated.
     for t in threading.enumerate():
@@ -1,5 +1,32 @@
+import logging
+import random
 import requests
-from typing import Dict, List, Optional
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from urllib.parse import quote
+from typing import Any, Callable, Deque, Dict, List, Mapping, Optional, Set, Tuple, Type
+
+from .domains import Decoder, Domain, lookup, register
+
+
+logger = logging.getLogger(__name__)
+
+
+def splitBackend(entity_id: str) -> Tuple[str, str]:
+    # Entities from any Home Assistant other than the default one are written as
+    # backend:entity_id. Home Assistant itself never puts a colon in an entity ID.
+    if ":" in entity_id:
+        backend, entity_id = entity_id.split(":", 1)
+        return (backend, entity_id)
+    return ("", entity_id)
+
+
+def qualify(backend: str, entity_id: str) -> str:
+    return f"{backend}:{entity_id}" if backend else entity_id
 
 
 class Entity:
@@ -7,14 +34,18 @@ class Entity:
         self.api = api
         self.entity_id = entity_id
 
-    def _merge(self, other: "Entity") -> None:
-        pass
+    def _merge(self, other: "Entity") -> bool:
+        # Returns whether the entity's name changed as a result of the merge.
+        return False
 
     def __repr__(self) -> str:
         return f"Entity({self.entity_id!r})"
 
 
 class SwitchEntity(Entity):
+    # Anything that can be switched on and off, along with how its two states are shown.
+    LABELS = ("ON ", "OFF")
+
     def __init__(
         self, api: "HomeAssistant", entity_id: str, name: str, initial_state: bool
     ) -> None:
@@ -22,22 +53,89 @@ class SwitchEntity(Entity):
         self.name: str = name
         self.__state: Optional[bool] = initial_state
 
-    def _merge(self, other: Entity) -> None:
+    def _merge(self, other: Entity) -> bool:
         if isinstance(other, SwitchEntity):
+            renamed = self.name != other.name
             self.name = other.name
             self.__state = other.__state
+            return renamed
+        return False
 
     @property
     def state(self) -> Optional[bool]:
         return self.__state
 
-    @state.setter
-    def state(self, new_state: bool) -> None:
-        self.api.setSwitchState(self.entity_id, new_state)
-        self.__state = self.api.getSwitchState(self.entity_id)
+    @property
+    def detail(self) -> Optional[str]:
+        # Anything worth showing after the name besides whether it's on.
+        return None
 
     def __repr__(self) -> str:
-        return f"SwitchEntity({self.entity_id!r}, {self.name!r}, {self.__state!r})"
+        return f"{type(self).__name__}({self.entity_id!r}, {self.name!r}, {self.__state!r})"
+
+
+class LightEntity(SwitchEntity):
+    def __init__(
+        self,
+        api: "HomeAssistant",
+        entity_id: str,
+        name: str,
+        initial_state: bool,
+        brightness: Optional[int],
+    ) -> None:
+        super().__init__(api, entity_id, name, initial_state)
+        self.brightness = brightness
+
+    def _merge(self, other: Entity) -> bool:
+        if isinstance(other, LightEntity):
+            self.brightness = other.brightness
+        return super()._merge(other)
+
+    @property
+    def detail(self) -> Optional[str]:
+        # Home Assistant reports brightness from 0 to 255, but people think in percent.
+        if not self.state or self.brightness is None:
+            return None
+        return f"{round(self.brightness * 100 / 255)}%"
+
+
+class CoverEntity(SwitchEntity):
+    # On is open.
+    LABELS = ("OPN", "CLS")
+
+
+class LockEntity(SwitchEntity):
+    # On is locked.
+    LABELS = ("LCK", "UNL")
+
+
+class ClimateEntity(SwitchEntity):
+    # On is any mode other than off, with the mode and temperatures shown alongside.
+    def __init__(
+        self,
+        api: "HomeAssistant",
+        entity_id: str,
+        name: str,
+        mode: str,
+        current: Optional[str],
+        target: Optional[str],
+    ) -> None:
+        super().__init__(api, entity_id, name, mode != "off")
+        self.mode = mode
+        self.current = current
+        self.target = target
+
+    def _merge(self, other: Entity) -> bool:
+        if isinstance(other, ClimateEntity):
+            self.mode = other.mode
+            self.current = other.current
+            self.target = other.target
+        return super()._merge(other)
+
+    @property
+    def detail(self) -> Optional[str]:
+        temperatures = "/".join(t for t in (self.current, self.target) if t is not None)
+        return f"{self.mode} {temperatures}".strip()
 
 
 class SensorEntity(Entity):
@@ -54,11 +152,14 @@ class SensorEntity(Entity):
         self.units: Optional[str] = units
         self.__state: Optional[str] = initial_state
 
-    def _merge(self, other: Entity) -> None:
+    def _merge(self, other: Entity) -> bool:
         if isinstance(other, SensorEntity):
+            renamed = self.name != other.name
             self.name = other.name
             self.units = other.units
             self.__state = other.__state
+            return renamed
+        return False
 
     @property
     def state(self) -> Optional[str]:
@@ -68,109 +169,687 @@ class SensorEntity(Entity):
         return f"SensorEntity({self.entity_id!r}, {self.name!r}, {self.units!r}, {self.__state!r})"
 
 
+def _name(entry: Dict[str, Any]) -> str:
+    name: str = entry["attributes"].get("friendly_name", entry["entity_id"])
+    return name
+
+
+def _decodeSwitch(entity: Type[SwitchEntity], on: Set[str]) -> Decoder:
+    # Anything whose state is one of the given strings is on, and anything else is off.
+    def decode(api: "HomeAssistant", entry: Dict[str, Any]) -> Entity:
+        state = str(entry.get("state", "off")).lower() in on
+        return entity(api, entry["entity_id"], _name(entry), state)
+
+    return decode
+
+
+def _decodeLight(api: "HomeAssistant", entry: Dict[str, Any]) -> Entity:
+    brightness = entry["attributes"].get("brightness")
+    return LightEntity(
+        api,
+        entry["entity_id"],
+        _name(entry),
+        bool(str(entry.get("state", "off")).lower() == "on"),
+        int(brightness) if isinstance(brightness, (int, float)) else None,
+    )
+
+
+def _decodeClimate(api: "HomeAssistant", entry: Dict[str, Any]) -> Entity:
+    def temperature(key: str) -> Optional[str]:
+        value = entry["attributes"].get(key)
+        return None if value is None else str(value)
+
+    return ClimateEntity(
+        api,
+        entry["entity_id"],
+        _name(entry),
+        str(entry.get("state", "off")).lower(),
+        temperature("current_temperature"),
+        temperature("temperature"),
+    )
+
+
+def _decodeSensor(api: "HomeAssistant", entry: Dict[str, Any]) -> Entity:
+    return SensorEntity(
+        api,
+        entry["entity_id"],
+        _name(entry),
+        entry["attributes"].get("unit_of_measurement", None),
+        entry.get("state"),
+    )
+
+
+def _decodeBinarySensor(api: "HomeAssistant", entry: Dict[str, Any]) -> Entity:
+    return SensorEntity(
+        api,
+        entry["entity_id"],
+        _name(entry),
+        None,
+        str(entry.get("state", "unknown")).upper(),
+    )
+
+
+# The domains we know how to show out of the box. Locks have no toggle service, and
+# climate devices only have one on newer Home Assistant releases.
+register(Domain("switch", SwitchEntity, _decodeSwitch(SwitchEntity, {"on"})))
+register(Domain("input_boolean", SwitchEntity, _decodeSwitch(SwitchEntity, {"on"})))
+register(Domain("light", LightEntity, _decodeLight))
+register(
+    Domain(
+        "cover",
+        CoverEntity,
+        _decodeSwitch(CoverEntity, {"open", "opening"}),
+        on="open_cover",
+        off="close_cover",
+    )
+)
+register(
+    Domain(
+        "lock",
+        LockEntity,
+        _decodeSwitch(LockEntity, {"locked", "locking"}),
+        on="lock",
+        off="unlock",
+        toggle=None,
+    )
+)
+register(Domain("climate", ClimateEntity, _decodeClimate, toggle=None))
+register(Domain("sensor", SensorEntity, _decodeSensor))
+register(Domain("binary_sensor", SensorEntity, _decodeBinarySensor))
+
+
+class CircuitOpenException(Exception):
+    pass
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(
+        self,
+        threshold: int = 3,
+        base_delay: float = 2.0,
+        max_delay: float = 120.0,
+        jitter: float = 0.5,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.failingSince: Optional[float] = None
+        self.retryAt = 0.0
+        self.__lock = threading.Lock()
+
+    @property
+    def offlineSince(self) -> Optional[float]:
+        # Only report ourselves offline once the circuit has actually tripped, so that
+        # a single dropped request doesn't flash a status at the user.
+        if self.state == self.CLOSED:
+            return None
+        return self.failingSince
+
+    def allow(self) -> bool:
+        with self.__lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and self.clock() >= self.retryAt:
+                # Let exactly one probe request through to see if we're back.
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def success(self) -> None:
+        with self.__lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.failingSince = None
+
+    def failure(self) -> None:
+        with self.__lock:
+            now = self.clock()
+            if self.failingSince is None:
+                self.failingSince = now
+            self.failures += 1
+
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                # Exponential backoff, with jitter so that several dashboards pointed
+                # at the same instance don't all hammer it the moment it comes back.
+                attempt = max(self.failures - self.threshold, 0)
+                delay = min(self.max_delay, self.base_delay * (2 ** min(attempt, 16)))
+                delay *= random.uniform(1.0 - self.jitter, 1.0)
+
+                self.state = self.OPEN
+                self.retryAt = now + delay
+
+
+class FailureReporter:
+    def __init__(
+        self, what: str, interval: float = 60.0, clock: Callable[[], float] = time.time
+    ) -> None:
+        self.what = what
+        self.interval = interval
+        self.clock = clock
+        self.count = 0
+        self.total = 0
+        self.lastReport: Optional[float] = None
+        self.lastError = ""
+
+        # Polls and service calls each run on threads of their own.
+        self.__lock = threading.Lock()
+
+    def failure(self, error: Exception) -> None:
+        with self.__lock:
+            self.__failure(error)
+
+    def success(self) -> None:
+        with self.__lock:
+            self.__success()
+
+    def __failure(self, error: Exception) -> None:
+        now = self.clock()
+        self.count += 1
+        self.total += 1
+        self.lastError = str(error)
+
+        # Report the first failure straight away, and then only a periodic summary
+        # so that a flapping instance doesn't flood the logs.
+        if self.lastReport is None:
+            logger.warning(f"Failed to {self.what}!\n{error}")
+            self.lastReport = now
+            self.count = 0
+        elif (now - self.lastReport) >= self.interval:
+            logger.warning(
+                f"Failed to {self.what} {self.count} times in the last "
+                f"{int(now - self.lastReport)}s, last error: {self.lastError}"
+            )
+            self.lastReport = now
+            self.count = 0
+
+    def __success(self) -> None:
+        if self.total > 1:
+            logger.info(f"Able to {self.what} again after {self.total} failures.")
+        self.count = 0
+        self.total = 0
+        self.lastReport = None
+
+
 class HomeAssistant:
+    # Whether polls should run on a background thread. Replays turn this off so that
+    # results land on exactly the same frame every time.
+    BACKGROUND_FETCH = True
+
+    # Up to this many entities are fetched one request apiece, any more than that and
+    # it's cheaper to fetch every state at once.
+    SINGLE_FETCH_LIMIT = 4
+
     def __init__(self, uri: str, token: str) -> None:
         self.uri = uri + ("/" if uri[-1] != "/" else "")
         self.token = token
+        self.breaker = CircuitBreaker()
+        self.reporter = FailureReporter("contact Home Assistant")
 
-    def getEntities(self) -> Optional[List[Entity]]:
-        url = f"{self.uri}api/states"
+        # How long the last successful poll took, and which states it changed.
+        self.lastLatency: Optional[float] = None
+        self.lastChanged: Set[str] = set()
+
+    @property
+    def offlineSince(self) -> Optional[float]:
+        return self.breaker.offlineSince
+
+    def answered(self, entity_id: str) -> bool:
+        # Whether the last successful poll actually asked wherever this entity lives, so
+        # that it not being in the results means Home Assistant doesn't have it.
+        return True
+
+    def close(self) -> None:
+        # Lets go of anything held for talking to Home Assistant, once a session is done
+        # with us. A single instance doesn't hold on to anything between requests.
+        pass
+
+    def _request(self, method: str, path: str, body: Optional[Dict[str, Any]] = None) -> Any:
+        # While the circuit is open, fail fast instead of waiting out the timeout.
+        if not self.breaker.allow():
+            raise CircuitOpenException(f"Home Assistant is unreachable, not requesting {path}")
+
+        url = f"{self.uri}{path}"
         headers = {
             "Authorization": f"Bearer {self.token}",
             "content-type": "application/json",
         }
         try:
-            entities: List[Entity] = []
-
-            response = requests.get(url, headers=headers, timeout=3.0)
-            response.raise_for_status()
-
-            data = response.json()
-            for entry in data:
-                if "attributes" not in entry:
-                    pass
-
-                device = entry["attributes"].get("device_class")
-                entity_id = entry["entity_id"]
-                if device == "switch" or entity_id.startswith("switch."):
-                    name = entry["attributes"].get("friendly_name", entity_id)
-                    entities.append(
-                        SwitchEntity(
-                            self,
-                            entity_id,
-                            name,
-                            bool(entry.get("state", "off").lower() == "on"),
-                        )
-                    )
-                elif entity_id.startswith("sensor."):
-                    name = entry["attributes"].get("friendly_name", entity_id)
-                    units = entry["attributes"].get("unit_of_measurement", None)
-                    entities.append(
-                        SensorEntity(
-                            self,
-                            entity_id,
-                            name,
-                            units,
-                            entry.get("state"),
-                        )
-                    )
-                elif entity_id.startswith("binary_sensor."):
-                    name = entry["attributes"].get("friendly_name", entity_id)
-                    entities.append(
-                        SensorEntity(
-                            self,
-                            entity_id,
-                            name,
-                            None,
-                            entry.get("state").upper(),
-                        )
-                    )
-
-            return entities
+            if method == "GET":
+                response = requests.get(url, headers=headers, timeout=3.0)
+            else:
+                response = requests.post(url, headers=headers, json=body, timeout=3.0)
         except Exception as e:
-            print(f"Failed to fetch entities!\n{e}")
+            self.breaker.failure()
+            self.reporter.failure(e)
+            raise
+
+        try:
+            if response.status_code == 404:
+                # Home Assistant is fine, it just doesn't know about what we asked for.
+                data = None
+            else:
+                response.raise_for_status()
+                data = response.json()
+        except Exception as e:
+            # Only Home Assistant itself failing counts towards giving up on it. Being
+            # turned down, such as for a bad token or request, means it's up and answering.
+            if response.status_code >= 500:
+                self.breaker.failure()
+            else:
+                self.breaker.success()
+            self.reporter.failure(e)
+            raise
+
+        self.breaker.success()
+        self.reporter.success()
+        return data
+
+    def __decode(self, entry: Dict[str, Any]) -> Optional[Entity]:
+        # Anything from a domain we don't know how to show is skipped without looking
+        # any further at it.
+        domain = lookup(entry["entity_id"])
+        if domain is None:
             return None
+        return domain.decode(self, entry)
 
-    def refreshEntities(self, entities: List[Entity]) -> bool:
+    def _decodeAll(self, entries: Any) -> List[Entity]:
+        # A malformed entry is reported and skipped, instead of costing us every other
+        # entity in the same response.
+        entities: List[Entity] = []
+        for entry in entries if isinstance(entries, list) else []:
+            try:
+                entity = self.__decode(entry)
+            except Exception as e:
+                logger.warning(f"Failed to decode entity state {entry!r}!\n{e!r}")
+                continue
+            if entity is not None:
+                entities.append(entity)
+        return entities
+
+    def getEntities(self) -> Optional[List[Entity]]:
+        start = time.perf_counter()
+        try:
+            data = self._request("GET", "api/states")
+        except Exception:
+            # Failures are already counted and reported by the request itself.
+            return None
+        self.lastLatency = time.perf_counter() - start
+
+        return self._decodeAll(data)
+
+    def getStates(self, entity_ids: List[str]) -> Optional[List[Entity]]:
+        # Fetch just the listed entities, falling back to everything when that's cheaper.
+        if len(entity_ids) > self.SINGLE_FETCH_LIMIT:
+            return self.getEntities()
+
+        entries: List[Any] = []
+        start = time.perf_counter()
+        try:
+            for entity_id in entity_ids:
+                entry = self._request("GET", f"api/states/{quote(entity_id)}")
+                if entry:
+                    entries.append(entry)
+        except Exception:
+            return None
+        self.lastLatency = time.perf_counter() - start
+
+        return self._decodeAll(entries)
+
+    def mergeEntities(self, entities: List[Entity], new_states: List[Entity]) -> List[Entity]:
+        # Merges new states into existing entities, returning any entities that were renamed.
         entities_by_id: Dict[str, Entity] = {e.entity_id: e for e in entities}
+        renamed: List[Entity] = []
+        changed: Set[str] = set()
 
+        for entity in new_states:
+            if entity.entity_id in entities_by_id:
+                existing = entities_by_id[entity.entity_id]
+                before = getattr(existing, "state", None)
+                if existing._merge(entity):
+                    renamed.append(existing)
+                if getattr(existing, "state", None) != before:
+                    changed.add(existing.entity_id)
+
+        self.lastChanged = changed
+
+        return renamed
+
+    def refreshEntities(self, entities: List[Entity]) -> bool:
         new_states = self.getEntities()
         if new_states:
-            for entity in new_states:
-                if entity.entity_id in entities_by_id:
-                    entities_by_id[entity.entity_id]._merge(entity)
+            self.mergeEntities(entities, new_states)
 
         return new_states is not None
 
-    def getSwitchState(self, entity: str) -> Optional[bool]:
-        url = f"{self.uri}api/states/{entity}"
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "content-type": "application/json",
-        }
+    def getHistory(self, entities: List[str], hours: float = 24.0) -> Dict[str, List[str]]:
+        # Fetch recorded states for every requested entity in a single request.
+        if not entities:
+            return {}
+
+        start = datetime.now(timezone.utc) - timedelta(hours=hours)
+        path = (
+            f"api/history/period/{quote(start.isoformat())}"
+            f"?filter_entity_id={quote(','.join(entities))}&minimal_response&no_attributes"
+        )
         try:
-            response = requests.get(url, headers=headers, timeout=3.0)
-            response.raise_for_status()
+            data = self._request("GET", path)
+        except Exception:
+            return {}
 
-            data = response.json()
-            if data.get("entity_id", None) != entity:
-                return None
+        # Without the recorder there's no history endpoint, and so no history.
+        history: Dict[str, List[str]] = {}
+        for series in data if isinstance(data, list) else []:
+            if not series or "entity_id" not in series[0]:
+                continue
 
-            return bool(data.get("state", "off").lower() == "on")
-        except Exception as e:
-            print(f"Failed to fetch {entity} state!\n{e}")
-            return None
+            # With a minimal response, only the first entry names the entity.
+            entity_id = series[0]["entity_id"]
+            history[entity_id] = [str(entry.get("state")) for entry in series]
+        return history
 
-    def setSwitchState(self, entity: str, newstate: bool) -> None:
-        url = f"{self.uri}api/services/switch/turn_{'on' if newstate else 'off'}"
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "content-type": "application/json",
-        }
+    def callService(self, domain: str, service: str, entities: List[str]) -> Optional[List[Entity]]:
+        # Call a service for any number of entities at once, returning the states that
+        # Home Assistant reports changed as a result, or None if the call failed.
         request = {
-            "entity_id": entity,
+            "entity_id": entities,
         }
         try:
-            requests.post(url, headers=headers, json=request, timeout=3.0)
-        except Exception as e:
-            print(f"Failed to update {entity} state!\n{e}")
+            data = self._request("POST", f"api/services/{domain}/{service}", request)
+        except Exception:
+            return None
+
+        # A missing service or domain comes back as not found, which is still a failure.
+        if data is None:
+            return None
+        return self._decodeAll(data)
+
+
+class MultiHomeAssistant(HomeAssistant):
+    # Presents several Home Assistant instances as one, talking to all of them at once so
+    # that a refresh takes as long as the slowest instance rather than all of them added
+    # up. The default instance is named "" and its entities keep their plain IDs.
+
+    # How long to wait on a slow instance before going ahead with everybody else's
+    # results. Its results get picked up by a later poll once they show up.
+    SLOW = 1.0
+
+    def __init__(self, backends: Mapping[str, HomeAssistant]) -> None:
+        default = backends.get("") or next(iter(backends.values()))
+        super().__init__(default.uri, default.token)
+        self.backends: Dict[str, HomeAssistant] = dict(backends)
+        self.BACKGROUND_FETCH = all(b.BACKGROUND_FETCH for b in backends.values())
+        self.__executor = ThreadPoolExecutor(max_workers=len(backends))
+        # Service calls and history get their own threads, so they never queue up behind a
+        # poll that is stuck waiting on an unreachable instance.
+        self.__calls = ThreadPoolExecutor(max_workers=len(backends))
+        self.__pending: Dict[str, "Future[Optional[List[Entity]]]"] = {}
+        self.__answered: Set[str] = set()
+        self.__closed = False
+        self.__lock = threading.Lock()
+
+    @property
+    def offlineSince(self) -> Optional[float]:
+        offline = [b.offlineSince for b in self.backends.values() if b.offlineSince is not None]
+        return min(offline) if offline else None
+
+    def __group(self, entity_ids: List[str]) -> Dict[str, List[str]]:
+        groups: Dict[str, List[str]] = {}
+        for entity_id in entity_ids:
+            backend, unqualified = splitBackend(entity_id)
+            if backend in self.backends:
+                groups.setdefault(backend, []).append(unqualified)
+        return groups
+
+    def __adopt(self, backend: str, entities: List[Entity]) -> List[Entity]:
+        # Entities are handed out as ours, so that switching them comes back through here.
+        for entity in entities:
+            entity.entity_id = qualify(backend, entity.entity_id)
+            entity.api = self
+        return entities
+
+    def answered(self, entity_id: str) -> bool:
+        return splitBackend(entity_id)[0] in self.__answered
+
+    def close(self) -> None:
+        # Nothing waits on calls still in flight, since an unreachable instance would hold
+        # us up for its whole timeout. Anything asked of us afterwards just fails.
+        with self.__lock:
+            self.__closed = True
+            self.__executor.shutdown(wait=False)
+            self.__calls.shutdown(wait=False)
+        for backend in self.backends.values():
+            backend.close()
+
+    def __poll(self, calls: Dict[str, Callable[[], Optional[List[Entity]]]]) -> Optional[List[Entity]]:
+        start = time.perf_counter()
+        asked: Set[str] = set()
+        with self.__lock:
+            if self.__closed:
+                return None
+            # A backend that is still busy with an earlier poll doesn't get another one.
+            for backend, call in calls.items():
+                if backend not in self.__pending:
+                    self.__pending[backend] = self.__executor.submit(call)
+                    asked.add(backend)
+            pending = dict(self.__pending)
+
+        # Replays need every result on the same frame it was recorded on.
+        wait(pending.values(), timeout=self.SLOW if self.BACKGROUND_FETCH else None)
+
+        entities: List[Entity] = []
+        succeeded = False
+        # Only an answer to what we asked just now says anything about what's missing,
+        # a late one from an earlier poll was about some other set of entities.
+        self.__answered = set()
+        for backend, future in pending.items():
+            if not future.done():
+                continue
+            with self.__lock:
+                del self.__pending[backend]
+
+            result = future.result()
+            if result is not None:
+                succeeded = True
+                entities.extend(self.__adopt(backend, result))
+                if backend in asked:
+                    self.__answered.add(backend)
+
+        self.lastLatency = time.perf_counter() - start
+        return entities if succeeded else None
+
+    def getEntities(self) -> Optional[List[Entity]]:
+        return self.__poll({name: backend.getEntities for name, backend in self.backends.items()})
+
+    def getStates(self, entity_ids: List[str]) -> Optional[List[Entity]]:
+        return self.__poll(
+            {
+                name: partial(self.backends[name].getStates, ids)
+                for name, ids in self.__group(entity_ids).items()
+            }
+        )
+
+    def __each(self, what: str, calls: Dict[str, Callable[[], Any]]) -> Dict[str, Any]:
+        # Makes a one-off call to several instances at once, returning what each answered.
+        # Instances that are known to be down are skipped, and any that don't answer in
+        # time are given up on, so that one of them can't hold up the rest or the screen.
+        futures: Dict[str, "Future[Any]"] = {}
+        with self.__lock:
+            for name, call in calls.items():
+                if self.__closed:
+                    break
+                if self.backends[name].breaker.state == CircuitBreaker.OPEN:
+                    logger.warning(f"Unable to {what} on {name or 'default'} Home Assistant, it is unreachable!")
+                    continue
+                futures[name] = self.__calls.submit(call)
+
+        wait(futures.values(), timeout=self.SLOW if self.BACKGROUND_FETCH else None)
+
+        results: Dict[str, Any] = {}
+        for name, future in futures.items():
+            if future.done():
+                results[name] = future.result()
+            else:
+                logger.warning(f"Gave up waiting on {name or 'default'} Home Assistant to {what}!")
+        return results
+
+    def getHistory(self, entities: List[str], hours: float = 24.0) -> Dict[str, List[str]]:
+        results = self.__each(
+            "fetch history",
+            {
+                name: partial(self.backends[name].getHistory, ids, hours)
+                for name, ids in self.__group(entities).items()
+            },
+        )
+
+        history: Dict[str, List[str]] = {}
+        for name, result in results.items():
+            for entity_id, states in result.items():
+                history[qualify(name, entity_id)] = states
+        return history
+
+    def callService(self, domain: str, service: str, entities: List[str]) -> Optional[List[Entity]]:
+        # Whatever the instances that did answer changed is still applied. Anything a slow
+        # instance went on to change shows up with a later poll.
+        results = self.__each(
+            f"call {domain}.{service}",
+            {
+                name: partial(self.backends[name].callService, domain, service, ids)
+                for name, ids in self.__group(entities).items()
+            },
+        )
+
+        changed: List[Entity] = []
+        succeeded = False
+        for name, result in results.items():
+            if result is not None:
+                succeeded = True
+                changed.extend(self.__adopt(name, result))
+        return changed if succeeded else None
+
+
+def connect(
+    uri: str,
+    token: str,
+    backends: Dict[str, Dict[str, str]],
+    make: Callable[[str, str, str], HomeAssistant],
+) -> HomeAssistant:
+    # Builds a client for the default Home Assistant, or for every configured instance at
+    # once if there are others. Makes each client by calling make(name, uri, token).
+    default = make("", uri, token)
+    if not backends:
+        return default
+
+    clients = {"": default}
+    for name, backend in backends.items():
+        clients[name] = make(name, backend["url"], backend["token"])
+    return MultiHomeAssistant(clients)
+
+
+class BackgroundFetch:
+    def __init__(self, api: HomeAssistant) -> None:
+        self.api = api
+        self.__thread: Optional[threading.Thread] = None
+        self.__result: Optional[Tuple[Optional[List[Entity]]]] = None
+        self.__lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def start(self, entity_ids: Optional[List[str]] = None) -> None:
+        # Only ever have one fetch outstanding, a slow instance shouldn't pile up threads.
+        # Fetches everything unless told which entities we want.
+        if self.running:
+            return
+
+        if not self.api.BACKGROUND_FETCH:
+            self.__fetch(entity_ids)
+            return
+
+        self.__thread = threading.Thread(target=self.__fetch, args=(entity_ids,), daemon=True)
+        self.__thread.start()
+
+    def __fetch(self, entity_ids: Optional[List[str]]) -> None:
+        if entity_ids is None:
+            entities = self.api.getEntities()
+        else:
+            entities = self.api.getStates(entity_ids)
+        with self.__lock:
+            self.__result = (entities,)
+
+    def collect(self) -> Tuple[bool, Optional[List[Entity]]]:
+        # Returns whether a fetch completed since the last call, and its entities if it worked.
+        with self.__lock:
+            result = self.__result
+            self.__result = None
+
+        if result is None:
+            return (False, None)
+        return (True, result[0])
+
+
+class ServiceCalls:
+    # Makes service calls on a thread of their own, so that switching something while
+    # Home Assistant is slow or unreachable never holds up input. Calls go out in the
+    # order they were made, and their results are picked up on a later frame the same
+    # way polls are.
+    def __init__(self, api: HomeAssistant) -> None:
+        self.api = api
+        self.__queue: Deque[Tuple[str, str, List[str]]] = deque()
+        self.__results: List[Optional[List[Entity]]] = []
+        self.__thread: Optional[threading.Thread] = None
+        self.__lock = threading.Lock()
+
+    def call(self, domain: str, service: str, entities: List[str]) -> None:
+        if not self.api.BACKGROUND_FETCH:
+            result = self.__call(domain, service, entities)
+            with self.__lock:
+                self.__results.append(result)
+            return
+
+        with self.__lock:
+            self.__queue.append((domain, service, entities))
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, daemon=True)
+                self.__thread.start()
+
+    def __call(self, domain: str, service: str, entities: List[str]) -> Optional[List[Entity]]:
+        changed = self.api.callService(domain, service, entities)
+        if changed is None:
+            return None
+
+        # Home Assistant tells us the new states in its response, only ask again for
+        # anything it left out.
+        returned = {e.entity_id for e in changed}
+        missing = [e for e in entities if e not in returned]
+        if missing:
+            changed.extend(self.api.getStates(missing) or [])
+        return changed
+
+    def __run(self) -> None:
+        while True:
+            with self.__lock:
+                if not self.__queue:
+                    self.__thread = None
+                    return
+                domain, service, entities = self.__queue.popleft()
+
+            result = self.__call(domain, service, entities)
+            with self.__lock:
+                self.__results.append(result)
+
+    def collect(self) -> List[Optional[List[Entity]]]:
+        # Returns the results of every call finished since the last time we were asked,
+        # each either the states it changed or None if it failed.
+        with self.__lock:
+            results, self.__results = self.__results, []
+        return results
@@ -0,0 +1,149 @@
+import json
+import os
+import re
+import time
+from typing import Any, Callable, Dict, Optional
+
+from vtpy import Terminal
+
+
+class Capabilities:
+    def __init__(
+        self,
+        name: str,
+        insertDelete: bool = False,
+        scrollRegion: bool = True,
+        lineDrawing: bool = True,
+    ) -> None:
+        self.name = name
+
+        # Whether the terminal understands ICH/DCH (insert and delete character).
+        self.insertDelete = insertDelete
+
+        # Whether the terminal understands DECSTBM scroll regions along with IND/RI.
+        self.scrollRegion = scrollRegion
+
+        # Whether the terminal has the DEC special graphics character set.
+        self.lineDrawing = lineDrawing
+
+    def __repr__(self) -> str:
+        return (
+            f"Capabilities({self.name!r}, insertDelete={self.insertDelete!r}, "
+            f"scrollRegion={self.scrollRegion!r}, lineDrawing={self.lineDrawing!r})"
+        )
+
+
+PROFILES: Dict[str, Capabilities] = {
+    # An original VT-100 (and the 101) lacks the editing extensions entirely.
+    "vt100": Capabilities("vt100"),
+    # The VT-102 and most later DEC terminals and clones support character editing.
+    "vt102": Capabilities("vt102", insertDelete=True),
+    "vt220": Capabilities("vt220", insertDelete=True),
+    # Modern terminal emulators that understand ANSI editing but would rather have Unicode.
+    "ansi": Capabilities("ansi", insertDelete=True, lineDrawing=False),
+}
+
+
+# Asks for whatever profile the terminal says it is, remembering the answer per port.
+AUTO = "auto"
+
+# What we assume about a terminal that won't tell us what it is.
+FALLBACK = "vt100"
+
+# How long, in seconds, a remembered answer is trusted before the terminal is asked
+# again, in case it has been swapped for a different model since.
+MAX_AGE = 7 * 24 * 60 * 60.0
+
+# A primary device attributes response, ESC [ ? class ; options c.
+_IDENTITY = re.compile(rb"\x1b\[\?([0-9;]*)c")
+
+
+def getProfile(name: str) -> Capabilities:
+    name = name.lower()
+    profile = PROFILES.get(FALLBACK if name == AUTO else name)
+    if profile is None:
+        raise Exception(
+            f"Unrecognized terminal profile {name}, expected one of {', '.join([AUTO, *PROFILES])}!"
+        )
+    return profile
+
+
+def profileFor(identity: bytes) -> Optional[str]:
+    # Maps the parameters of a device attributes response onto one of our profiles.
+    try:
+        kind = int(identity.split(b";")[0])
+    except ValueError:
+        return None
+
+    if kind in {1, 12}:
+        # A VT-100 or VT-101, with or without options, or a VT-125 which is one underneath.
+        return "vt100"
+    if kind in {4, 6}:
+        # A VT-102 or VT-132, both of which added character editing.
+        return "vt102"
+    if kind >= 62:
+        # A VT-220 or anything later, which is also what most clones claim to be.
+        return "vt220"
+    return None
+
+
+def identify(terminal: Terminal, timeout: float = 1.0) -> Optional[str]:
+    # Asks the terminal what it is, returning the matching profile or None if it didn't
+    # answer in time or answered with something we don't recognize. Anything typed while
+    # we're waiting is thrown away.
+    terminal.sendCommand(b"[c")
+    received = b""
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        data = terminal.recvInput()
+        if not data:
+            time.sleep(0.01)
+            continue
+
+        received += data
+        match = _IDENTITY.search(received)
+        if match:
+            return profileFor(match.group(1))
+    return None
+
+
+def _cachePath(directory: str) -> str:
+    return os.path.join(directory, "terminals.json")
+
+
+def cachedProfile(
+    directory: str, port: str, maxAge: float = MAX_AGE, clock: Callable[[], float] = time.time
+) -> Optional[str]:
+    # The profile a terminal on this port identified itself as, as long as it did so
+    # recently enough.
+    try:
+        with open(_cachePath(directory), "r") as stream:
+            entry = json.load(stream).get(port)
+        name = entry["profile"]
+        identified = float(entry["identified"])
+    except Exception:
+        # Missing, unreadable or from before we kept track of age, so ask again.
+        return None
+    if not (0.0 <= clock() - identified <= maxAge):
+        return None
+    return name if name in PROFILES else None
+
+
+def saveProfile(
+    directory: str, port: str, name: str, clock: Callable[[], float] = time.time
+) -> None:
+    try:
+        with open(_cachePath(directory), "r") as stream:
+            profiles: Dict[str, Any] = json.load(stream)
+    except Exception:
+        profiles = {}
+    profiles[port] = {"profile": name, "identified": clock()}
+
+    try:
+        os.makedirs(directory, exist_ok=True)
+        with open(_cachePath(directory), "w") as stream:
+            json.dump(profiles, stream)
+    except Exception:
+        # Caching is purely an optimization, we can always ask again next time.
+        pass
@@ -1,9 +1,39 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
 import yaml
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+# Bump this whenever the compiled layout format changes, so stale caches are ignored.
+CACHE_VERSION = 14
 
 
 class Entity:
-    def __init__(self, entity_id: str, name: Optional[str], units: Optional[str]) -> None:
+    def __init__(
+        self,
+        entity_id: str,
+        name: Optional[str],
+        units: Optional[str],
+        history: Optional[str] = None,
+        history_size: int = 40,
+        precision: Optional[int] = None,
+        deadband: Optional[float] = None,
+        deadband_relative: bool = False,
+        repaint_interval: Optional[float] = None,
+    ) -> None:
+        self.history = history
+        self.history_size = history_size
+        self.precision = precision
+        self.deadband = deadband
+        self.deadband_relative = deadband_relative
+        self.repaint_interval = repaint_interval
+
         if entity_id[:3] == "<hr" and entity_id[-1:] == ">":
             self.entity_id = "<hr>"
             self.name = None
@@ -21,61 +51,392 @@ class Entity:
             self.name = name
             self.units = units
 
+    def __key(self) -> Tuple[Any, ...]:
+        return (
+            self.entity_id,
+            self.name,
+            self.units,
+            self.history,
+            self.history_size,
+            self.precision,
+            self.deadband,
+            self.deadband_relative,
+            self.repaint_interval,
+        )
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Entity):
+            return NotImplemented
+        return self.__key() == other.__key()
+
+    def __hash__(self) -> int:
+        return hash(self.__key())
+
 
 class Page:
-    def __init__(self, name: str, entities: List[Entity]) -> None:
+    def __init__(
+        self,
+        name: str,
+        entities: List[Entity],
+        groups: Optional[Dict[str, List[str]]] = None,
+    ) -> None:
         self.name = name
         self.entities = entities
+        self.groups: Dict[str, List[str]] = groups or {}
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Page):
+            return NotImplemented
+        return (
+            self.name == other.name
+            and self.entities == other.entities
+            and self.groups == other.groups
+        )
+
+    def __hash__(self) -> int:
+        return hash((self.name, tuple(self.entities)))
+
+
+def cacheDir() -> str:
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "homeassistant-vt100")
+
+
+def _tokens(yamlfile: Dict[str, Any]) -> Dict[str, str]:
+    # The access tokens for the main installation, under "", and for every other backend.
+    hass = yamlfile.get("homeassistant", {})
+    tokens: Dict[str, str] = {}
+    if hass.get("token") is not None:
+        tokens[""] = str(hass["token"])
+    for backend, options in (hass.get("backends") or {}).items():
+        if options and options.get("token") is not None:
+            tokens[str(backend)] = str(options["token"])
+    return tokens
+
+
+# Everything a running session picks up when the config changes. Anything else is only
+# read when connecting, or for some settings only when starting up.
+_LIVE = {
+    "homeassistant_poll_visible",
+    "homeassistant_poll_hidden",
+    "dashboard_name",
+    "display_help",
+    "rotate",
+    "layout",
+}
 
 
 class Config:
     def __init__(self, file: str) -> None:
-        with open(file, "r") as stream:
-            yamlfile = yaml.safe_load(stream)
-
-            # Basic config for where to get home assistant stuff
-            hass = yamlfile.get("homeassistant", {})
-            self.homeassistant_uri: Optional[str] = hass.get("url", None)
-            self.homeassistant_token: Optional[str] = hass.get("token", None)
-
-            # If present, read the monitoring port argument to put a simple HTTP
-            # monitoring page up.
-            monitoring = hass.get("monitoring", {})
-            enabled = bool(monitoring.get("enabled", False))
-            if enabled:
-                port = int(monitoring.get("port", 8080))
-            else:
-                port = None
-            self.homeassistant_monitoring_port: Optional[int] = port
-
-            # Terminal configuration
-            terminal = yamlfile.get("terminal", {})
-            self.terminal_port: str = terminal.get("port", "/dev/ttyUSB0")
-            self.terminal_baud: int = int(terminal.get("baud", "9600"))
-            self.terminal_flow: bool = terminal.get("flow", False)
-
-            # General configuration
-            general = yamlfile.get("general", {})
-            self.dashboard_name: Optional[str] = general.get("name")
-            self.display_help: bool = general.get("show_help", False)
-
-            # Layout configuration
-            self.layout: List[Page] = []
-
-            layout = yamlfile.get("layout", [])
-            for index, entry in enumerate(layout):
-                name = entry.get("name", f"Tab {index + 1}")
-                page = Page(name, [])
-
-                for entity in entry.get("entities") or []:
-                    if isinstance(entity, str):
-                        # Raw entity list.
-                        page.entities.append(Entity(entity, None, None))
-                    elif isinstance(entity, dict):
-                        # Entity description.
-                        entity_id = entity.get("entity", "__invalid__")
-                        entity_name = entity.get("name", None)
-                        entity_units = entity.get("units", None)
-                        page.entities.append(Entity(entity_id, entity_name, entity_units))
-
-                self.layout.append(page)
+        self.file = file
+
+        with open(file, "rb") as stream:
+            contents = stream.read()
+
+        # Key the compiled layout on the config contents, so that we only need to parse
+        # the YAML when something has actually changed.
+        self.hash = hashlib.sha256(
+            str(CACHE_VERSION).encode("ascii") + b"\0" + contents
+        ).hexdigest()
+
+        # Access tokens never go in the cache, so the file itself is still read for them.
+        yamlfile = yaml.safe_load(contents) or {}
+        compiled = self.__loadCache()
+        if compiled is None:
+            compiled = self.__compile(yamlfile)
+            self.__saveCache(compiled)
+
+        self.compiled = compiled
+        self.__apply(compiled, _tokens(yamlfile))
+
+    @classmethod
+    def fromCompiled(cls, compiled: Dict[str, Any]) -> "Config":
+        # Build a config from an already compiled layout, such as one stored in a trace.
+        config = cls.__new__(cls)
+        config.file = ""
+        config.hash = hashlib.sha256(json.dumps(compiled, sort_keys=True).encode("utf-8")).hexdigest()
+        config.compiled = compiled
+        config.__apply(compiled, {})
+        return config
+
+    @property
+    def __cachePrefix(self) -> str:
+        return hashlib.sha256(os.path.abspath(self.file).encode("utf-8")).hexdigest()[:16]
+
+    def __loadCache(self) -> Optional[Dict[str, Any]]:
+        path = os.path.join(cacheDir(), f"{self.__cachePrefix}-{self.hash}.json")
+        try:
+            with open(path, "r") as stream:
+                compiled: Dict[str, Any] = json.load(stream)
+                return compiled
+        except Exception:
+            return None
+
+    def __saveCache(self, compiled: Dict[str, Any]) -> None:
+        directory = cacheDir()
+        path = os.path.join(directory, f"{self.__cachePrefix}-{self.hash}.json")
+        try:
+            os.makedirs(directory, exist_ok=True)
+
+            # Throw away compiled versions of older edits to this same config.
+            for existing in os.listdir(directory):
+                if existing.startswith(f"{self.__cachePrefix}-"):
+                    os.remove(os.path.join(directory, existing))
+
+            # The layout names everything in the house, so keep it private.
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as stream:
+                json.dump(compiled, stream)
+        except Exception:
+            # Caching is purely an optimization, we can always parse again next time.
+            pass
+
+    def __compile(self, yamlfile: Dict[str, Any]) -> Dict[str, Any]:
+        # Basic config for where to get home assistant stuff
+        hass = yamlfile.get("homeassistant", {})
+
+        # If present, read the monitoring port argument to put a simple HTTP
+        # monitoring page up.
+        monitoring = hass.get("monitoring", {})
+        enabled = bool(monitoring.get("enabled", False))
+        if enabled:
+            port = int(monitoring.get("port", 8080))
+        else:
+            port = None
+
+        # Any other Home Assistant instances, whose entities are referred to in the layout
+        # as name:entity_id.
+        backends: Dict[str, Dict[str, str]] = {}
+        for backend, options in (hass.get("backends") or {}).items():
+            backend = str(backend)
+            options = options or {}
+            if not backend or ":" in backend:
+                raise Exception(f"Invalid Home Assistant backend name {backend!r}!")
+            if options.get("url") is None or options.get("token") is None:
+                raise Exception(f"Expected Home Assistant backend {backend} to include a URI and API Token!")
+            backends[backend] = {"url": str(options["url"])}
+
+        # How often to poll entities on the displayed page, and everywhere else.
+        poll = hass.get("poll", {}) or {}
+        poll_visible = float(poll.get("visible", 1.0))
+        poll_hidden = float(poll.get("hidden", 30.0))
+        if poll_visible <= 0 or poll_hidden <= 0:
+            raise Exception("Poll intervals must be greater than zero!")
+
+        # Terminal configuration
+        terminal = yamlfile.get("terminal", {})
+
+        # Optionally, serve dashboards to terminals connecting over the network instead
+        # of driving a single serial terminal.
+        server = yamlfile.get("server", {}) or {}
+        if bool(server.get("enabled", False)):
+            server_port: Optional[int] = int(server.get("port", 2323))
+        else:
+            server_port = None
+
+        # General configuration
+        general = yamlfile.get("general", {})
+
+        # Kiosk mode, rotating through the pages every so many seconds while nobody is typing.
+        rotate = float(general.get("rotate", 0.0) or 0.0)
+        if rotate < 0:
+            raise Exception("Rotate interval cannot be negative!")
+
+        # Layout configuration
+        pages: List[Dict[str, Any]] = []
+
+        layout = yamlfile.get("layout", [])
+        for index, entry in enumerate(layout):
+            name = entry.get("name", f"Tab {index + 1}")
+            entities: List[List[Any]] = []
+
+            for entity in entry.get("entities") or []:
+                if isinstance(entity, str):
+                    # Raw entity list.
+                    entities.append([entity, None, None, None, 40, None, None, False, None])
+                elif isinstance(entity, dict):
+                    # Entity description.
+                    entity_id = entity.get("entity", "__invalid__")
+                    history = entity.get("history", None)
+                    if history not in {None, "sparkline", "minmax"}:
+                        raise Exception(
+                            f"Unrecognized history option {history} for {entity_id}, expected sparkline or minmax!"
+                        )
+
+                    # Sensors can be rounded, and told to ignore small or frequent changes.
+                    precision = entity.get("precision", None)
+                    if precision is not None and int(precision) < 0:
+                        raise Exception(f"Precision for {entity_id} cannot be negative!")
+
+                    deadband = entity.get("deadband", None)
+                    relative = isinstance(deadband, str) and deadband.strip().endswith("%")
+                    if deadband is not None:
+                        deadband = float(str(deadband).strip().rstrip("%"))
+                        if deadband < 0:
+                            raise Exception(f"Deadband for {entity_id} cannot be negative!")
+
+                    repaint = entity.get("repaint_interval", None)
+                    if repaint is not None and float(repaint) < 0:
+                        raise Exception(f"Repaint interval for {entity_id} cannot be negative!")
+
+                    entities.append(
+                        [
+                            entity_id,
+                            entity.get("name", None),
+                            entity.get("units", None),
+                            history,
+                            int(entity.get("history_size", 40)),
+                            None if precision is None else int(precision),
+                            deadband,
+                            relative,
+                            None if repaint is None else float(repaint),
+                        ]
+                    )
+
+            # Named groups of switches that can be switched together in one go.
+            groups: Dict[str, List[str]] = {}
+            for group, members in (entry.get("groups") or {}).items():
+                if isinstance(members, str):
+                    members = [members]
+                groups[str(group)] = [str(m) for m in members or []]
+
+            pages.append({"name": name, "entities": entities, "groups": groups})
+
+        return {
+            "homeassistant_uri": hass.get("url", None),
+            "homeassistant_monitoring_port": port,
+            "homeassistant_backends": backends,
+            "homeassistant_poll_visible": poll_visible,
+            "homeassistant_poll_hidden": poll_hidden,
+            "terminal_port": terminal.get("port", "/dev/ttyUSB0"),
+            "terminal_baud": int(terminal.get("baud", "9600")),
+            "terminal_flow": bool(terminal.get("flow", False)),
+            "terminal_profile": str(terminal.get("profile", "auto")),
+            "terminal_queue": int(terminal.get("queue", 64)),
+            "terminal_echo_latency": max(int(terminal.get("echo_latency", 100)), 0),
+            "server_host": str(server.get("host", "127.0.0.1")),
+            "server_port": server_port,
+            "server_telnet": bool(server.get("telnet", True)),
+            "server_max_clients": int(server.get("max_clients", 32)),
+            "dashboard_name": general.get("name"),
+            "display_help": bool(general.get("show_help", False)),
+            "render_cache": int(general.get("render_cache", 256)),
+            "rotate": rotate,
+            "layout": pages,
+        }
+
+    def __apply(self, compiled: Dict[str, Any], tokens: Dict[str, str]) -> None:
+        # Tokens come from the config file itself, or are left blank for replays. Traces
+        # recorded before tokens were kept out of the compiled layout have blank ones.
+        self.homeassistant_uri: Optional[str] = compiled["homeassistant_uri"]
+        self.homeassistant_token: Optional[str] = tokens.get("", compiled.get("homeassistant_token"))
+        self.homeassistant_monitoring_port: Optional[int] = compiled[
+            "homeassistant_monitoring_port"
+        ]
+        # Traces recorded before these options existed won't have them.
+        self.homeassistant_backends: Dict[str, Dict[str, str]] = {
+            name: {"url": backend["url"], "token": tokens.get(name, backend.get("token", ""))}
+            for name, backend in compiled.get("homeassistant_backends", {}).items()
+        }
+        self.poll_visible: float = compiled.get("homeassistant_poll_visible", 1.0)
+        self.poll_hidden: float = compiled.get("homeassistant_poll_hidden", 30.0)
+
+        self.terminal_port: str = compiled["terminal_port"]
+        self.terminal_baud: int = compiled["terminal_baud"]
+        self.terminal_flow: bool = compiled["terminal_flow"]
+        self.terminal_profile: str = compiled["terminal_profile"]
+        self.terminal_queue: int = compiled.get("terminal_queue", 64)
+        self.terminal_echo_latency: int = compiled.get("terminal_echo_latency", 100)
+
+        self.server_host: str = compiled.get("server_host", "127.0.0.1")
+        self.server_port: Optional[int] = compiled.get("server_port")
+        self.server_telnet: bool = compiled.get("server_telnet", True)
+        self.server_max_clients: int = compiled.get("server_max_clients", 32)
+
+        self.dashboard_name: Optional[str] = compiled["dashboard_name"]
+        self.display_help: bool = compiled["display_help"]
+        self.render_cache: int = compiled.get("render_cache", 256)
+        self.rotate: float = compiled.get("rotate", 0.0)
+
+        self.layout: List[Page] = [
+            Page(
+                page["name"],
+                [Entity(*entity) for entity in page["entities"]],
+                page["groups"],
+            )
+            for page in compiled["layout"]
+        ]
+
+
+class ConfigWatcher:
+    # A watcher can follow another one instead of looking at the file itself, so that any
+    # number of sessions can each pick up a reload while only one of them ever stats it.
+    INTERVAL = 1.0
+
+    def __init__(self, config: Config, follow: Optional["ConfigWatcher"] = None) -> None:
+        self.config = config
+        self.__source = follow
+        self.__stamp = self.__stat() if follow is None else None
+        self.__checked = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def __stat(self) -> Optional[os.stat_result]:
+        try:
+            return os.stat(self.config.file)
+        except OSError:
+            return None
+
+    def latest(self) -> Config:
+        # The newest config, looking at the file at most once an interval no matter how
+        # many followers ask.
+        with self.__lock:
+            now = time.monotonic()
+            if now - self.__checked >= self.INTERVAL:
+                self.__checked = now
+                self.poll()
+            return self.config
+
+    def poll(self) -> Optional[Config]:
+        # Returns a freshly loaded config if the file changed since we last looked.
+        if self.__source is not None:
+            latest = self.__source.latest()
+            if latest is self.config:
+                return None
+            self.config = latest
+            return latest
+
+        stamp = self.__stat()
+        if stamp is None or (
+            self.__stamp is not None
+            and (stamp.st_mtime_ns, stamp.st_size) == (self.__stamp.st_mtime_ns, self.__stamp.st_size)
+        ):
+            return None
+        self.__stamp = stamp
+
+        try:
+            config = Config(self.config.file)
+        except Exception as e:
+            # Keep running with what we had, the user is probably mid-edit.
+            logger.warning(f"Failed to reload {self.config.file}!\n{e}")
+            return None
+
+        if config.hash == self.config.hash:
+            return None
+
+        changed = sorted(
+            key
+            for key in set(config.compiled) | set(self.config.compiled)
+            if key not in _LIVE and config.compiled.get(key) != self.config.compiled.get(key)
+        )
+        if (config.homeassistant_token, config.homeassistant_backends) != (
+            self.config.homeassistant_token,
+            self.config.homeassistant_backends,
+        ):
+            changed.append("access tokens")
+        if changed:
+            logger.warning(
+                f"Changes to {', '.join(changed)} in {config.file} need a restart to take effect!"
+            )
+
+        self.config = config
+        return config
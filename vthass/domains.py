@@ -0,0 +1,57 @@
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional, Type
+
+if TYPE_CHECKING:
+    from .api import Entity, HomeAssistant
+
+
+# Turns a state entry from Home Assistant into an entity, given the installation it
+# came from and the entry itself.
+Decoder = Callable[["HomeAssistant", Dict[str, Any]], "Entity"]
+
+
+class Domain:
+    # Everything we need to know about one Home Assistant domain, such as "light". What
+    # its states decode into and how, and for anything that can be switched, which
+    # services turn it on and off. Domains that can't toggle directly are toggled by
+    # asking for the opposite of whatever state they're in. How it gets drawn follows
+    # from its entity class, see the renderer.
+    def __init__(
+        self,
+        name: str,
+        entity: Type["Entity"],
+        decode: Decoder,
+        on: str = "turn_on",
+        off: str = "turn_off",
+        toggle: Optional[str] = "toggle",
+    ) -> None:
+        self.name = name
+        self.entity = entity
+        self.decode = decode
+        self.on = on
+        self.off = off
+        self.toggle = toggle
+
+    def service(self, action: str, state: Optional[bool]) -> str:
+        # The service that does one of turn_on, turn_off or toggle for this domain.
+        if action == "toggle":
+            if self.toggle is not None:
+                return self.toggle
+            action = "turn_off" if state else "turn_on"
+        return self.on if action == "turn_on" else self.off
+
+
+DOMAINS: Dict[str, Domain] = {}
+
+
+def register(domain: Domain) -> Domain:
+    DOMAINS[domain.name] = domain
+    return domain
+
+
+def domainOf(entity_id: str) -> str:
+    # Entity IDs are domain.object_id, possibly with a backend: in front.
+    return entity_id.split(":", 1)[-1].split(".", 1)[0]
+
+
+def lookup(entity_id: str) -> Optional[Domain]:
+    return DOMAINS.get(domainOf(entity_id))
@@ -0,0 +1,377 @@
+import codecs
+from typing import Callable, Dict, List, Optional, Tuple
+
+from vtpy import Terminal
+
+from .terminal import HeadlessTerminal
+
+
+# Character attributes, as set by SGR.
+BOLD = 1
+UNDERLINE = 2
+BLINK = 4
+REVERSE = 8
+
+# What the DEC special graphics set displays in place of the lowercase letters and a
+# handful of punctuation.
+DEC_GRAPHICS: Dict[str, str] = dict(
+    zip(
+        "_`abcdefghijklmnopqrstuvwxyz{|}~",
+        " ◆▒␉␌␍␊°±␤␋┘┐┌└┼⎺⎻─⎼⎽├┤┴┬│≤≥π≠£·",
+    )
+)
+
+
+class EmulatedTerminal(HeadlessTerminal):
+    # A terminal that interprets everything sent to it the way a VT-100 would, keeping
+    # an in-memory copy of the screen. It also keeps track of how long everything would
+    # have taken to go down a serial line at the given baud rate, including time spent
+    # waiting on the terminal to send XON again when it can't keep up.
+
+    # Roughly what a VT-100 does: a small input silo, with XOFF sent when it's half full
+    # and XON once it drains back down to a quarter.
+    BUFFER_SIZE = 128
+    XOFF_LEVEL = 64
+    XON_LEVEL = 32
+
+    def __init__(
+        self,
+        rows: int = 24,
+        columns: int = 80,
+        baud: int = 9600,
+        flow: bool = False,
+        processRate: Optional[float] = None,
+        clock: Optional[Callable[[], float]] = None,
+        identity: bytes = b"[?1;2c",
+    ) -> None:
+        super().__init__(rows, columns)
+        self.baud = baud
+        self.flow = flow
+        self.processRate = processRate
+        self.clock = clock
+        self.identity = identity
+
+        # Accounting, in bytes and in simulated seconds on the wire.
+        self.bytesOut = 0
+        self.bytesIn = 0
+        self.wireTime = 0.0
+        self.stalls = 0
+        self.stallTime = 0.0
+        self.overruns = 0
+        self.__level = 0.0
+        self.__lineFree = 0.0
+
+        # Parser state.
+        self.__decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.__state = "ground"
+        self.__params = ""
+
+        self.__resetState()
+
+    def __resetState(self) -> None:
+        self.screen: List[List[str]] = [[" "] * self.columns for _ in range(self.rows)]
+        self.attrs: List[List[int]] = [[0] * self.columns for _ in range(self.rows)]
+        self.cursor = (1, 1)
+        self.attr = 0
+        self.charset = "B"
+        self.top = 1
+        self.bottom = self.rows
+        self.wrapPending = False
+        self.savedState: Tuple[Tuple[int, int], int, str] = ((1, 1), 0, "B")
+
+    # Terminal interface, which just sends bytes and lets the emulation figure out
+    # what they did.
+
+    def sendCommand(self, cmd: bytes) -> None:
+        self._write(Terminal.ESCAPE + cmd)
+
+    def sendText(self, text: str) -> None:
+        self._write(text.encode("utf-8"))
+
+    def moveCursor(self, row: int, col: int) -> None:
+        self._write(Terminal.ESCAPE + f"[{row};{col}H".encode("ascii"))
+
+    def fetchCursor(self) -> Tuple[int, int]:
+        # Ask the same way a host would, and pick the report out of the input.
+        self.sendCommand(b"[6n")
+        for report in self.input:
+            if report.startswith(Terminal.ESCAPE + b"[") and report.endswith(b"R"):
+                self.input.remove(report)
+                self.bytesIn += len(report)
+                row, col = report[2:-1].split(b";")
+                return (int(row), int(col))
+        return self.cursor
+
+    def recvInput(self) -> Optional[bytes]:
+        data = super().recvInput()
+        if data:
+            self.bytesIn += len(data)
+        return data
+
+    def set80Columns(self) -> None:
+        self.sendCommand(b"[?3l")
+
+    def set132Columns(self) -> None:
+        self.sendCommand(b"[?3h")
+
+    def _write(self, data: bytes) -> None:
+        super()._write(data)
+        self.bytesOut += len(data)
+        self.__transmit(len(data))
+        for ch in self.__decoder.decode(data):
+            self.__feed(ch)
+
+    # Inspecting the screen.
+
+    def line(self, row: int) -> str:
+        return "".join(self.screen[row - 1])
+
+    def lines(self) -> List[str]:
+        return ["".join(r) for r in self.screen]
+
+    def attributes(self, row: int, col: int) -> int:
+        return self.attrs[row - 1][col - 1]
+
+    def dump(self) -> str:
+        return "\n".join(line.rstrip() for line in self.lines())
+
+    # Serial line simulation.
+
+    @property
+    def lineFree(self) -> float:
+        # When everything sent so far will have finished arriving, in simulated seconds.
+        return self.__lineFree
+
+    def __transmit(self, count: int) -> None:
+        rateIn = self.baud / 10.0
+        start = max(self.clock() if self.clock else 0.0, self.__lineFree)
+        now = start
+
+        # Whatever arrived earlier has been draining out of the terminal's buffer since.
+        if self.processRate is not None:
+            self.__level = max(self.__level - (now - self.__lineFree) * self.processRate, 0.0)
+
+        remaining = float(count)
+        while remaining > 0:
+            if self.processRate is None or self.processRate >= rateIn:
+                # The terminal keeps up with the line, so it's just the line rate.
+                now += remaining / rateIn
+                break
+
+            fill = rateIn - self.processRate
+            limit = self.XOFF_LEVEL if self.flow else self.BUFFER_SIZE
+            sendable = max(limit - self.__level, 0.0) / fill * rateIn
+            if remaining <= sendable:
+                elapsed = remaining / rateIn
+                self.__level += fill * elapsed
+                now += elapsed
+                break
+
+            elapsed = sendable / rateIn
+            self.__level += fill * elapsed
+            now += elapsed
+            remaining -= sendable
+
+            if self.flow:
+                # The terminal sent XOFF, so we sit here until it drains and sends XON.
+                wait = (self.__level - self.XON_LEVEL) / self.processRate
+                self.stalls += 1
+                self.stallTime += wait
+                self.__level = float(self.XON_LEVEL)
+                now += wait
+            else:
+                # Nobody is holding us back, so whatever doesn't fit is lost.
+                self.overruns += int(remaining * fill / rateIn)
+                now += remaining / rateIn
+                break
+
+        self.wireTime += now - start
+        self.__lineFree = now
+
+    # Escape sequence interpretation.
+
+    def __feed(self, ch: str) -> None:
+        if self.__state == "escape":
+            self.__escape(ch)
+        elif self.__state == "csi":
+            if "\x40" <= ch <= "\x7e":
+                self.__state = "ground"
+                self.__csi(self.__params, ch)
+            else:
+                self.__params += ch
+        elif self.__state == "charset":
+            self.__state = "ground"
+            if self.__params == "(":
+                self.charset = ch
+        elif ch == "\x1b":
+            self.__state = "escape"
+        elif ch < " " or ch == "\x7f":
+            self.__control(ch)
+        else:
+            self.__print(ch)
+
+    def __control(self, ch: str) -> None:
+        row, col = self.cursor
+        if ch == "\r":
+            self.cursor = (row, 1)
+        elif ch in "\n\x0b\x0c":
+            self.__lineFeed()
+        elif ch == "\b":
+            self.cursor = (row, max(col - 1, 1))
+        elif ch == "\t":
+            self.cursor = (row, min(((col - 1) // 8 + 1) * 8 + 1, self.columns))
+        else:
+            return
+        self.wrapPending = False
+
+    def __escape(self, ch: str) -> None:
+        self.__state = "ground"
+        if ch == "[":
+            self.__state = "csi"
+            self.__params = ""
+        elif ch in "()":
+            self.__state = "charset"
+            self.__params = ch
+        elif ch == "7":
+            self.savedState = (self.cursor, self.attr, self.charset)
+        elif ch == "8":
+            self.cursor, self.attr, self.charset = self.savedState
+            self.wrapPending = False
+        elif ch == "D":
+            self.__lineFeed()
+        elif ch == "E":
+            self.__lineFeed()
+            self.cursor = (self.cursor[0], 1)
+        elif ch == "M":
+            self.__reverseLineFeed()
+        elif ch == "c":
+            self.__resetState()
+
+    def __csi(self, params: str, final: str) -> None:
+        private = params.startswith("?")
+        values = [int(p) if p.isdigit() else 0 for p in params.lstrip("?").split(";")]
+
+        def arg(index: int, default: int) -> int:
+            value = values[index] if index < len(values) else 0
+            return value or default
+
+        row, col = self.cursor
+        if private:
+            if final in "hl" and 3 in values:
+                # DECCOLM clears the screen along with changing the width.
+                self.columns = 132 if final == "h" else 80
+                self.__resetState()
+            return
+
+        if final in "Hf":
+            self.__moveTo(arg(0, 1), arg(1, 1))
+        elif final == "A":
+            self.__moveTo(row - arg(0, 1), col)
+        elif final == "B":
+            self.__moveTo(row + arg(0, 1), col)
+        elif final == "C":
+            self.__moveTo(row, col + arg(0, 1))
+        elif final == "D":
+            self.__moveTo(row, col - arg(0, 1))
+        elif final == "K":
+            mode = values[0]
+            start = 1 if mode in {1, 2} else col
+            end = self.columns if mode in {0, 2} else col
+            self.__erase(row, start, end)
+        elif final == "J":
+            mode = values[0]
+            if mode == 0:
+                self.__erase(row, col, self.columns)
+                rows = range(row + 1, self.rows + 1)
+            elif mode == 1:
+                self.__erase(row, 1, col)
+                rows = range(1, row)
+            else:
+                rows = range(1, self.rows + 1)
+            for r in rows:
+                self.__erase(r, 1, self.columns)
+        elif final == "m":
+            for value in values:
+                if value == 0:
+                    self.attr = 0
+                elif value == 1:
+                    self.attr |= BOLD
+                elif value == 4:
+                    self.attr |= UNDERLINE
+                elif value == 5:
+                    self.attr |= BLINK
+                elif value == 7:
+                    self.attr |= REVERSE
+        elif final == "r":
+            top, bottom = arg(0, 1), arg(1, self.rows)
+            if top < bottom <= self.rows:
+                self.top, self.bottom = top, bottom
+                self.__moveTo(1, 1)
+        elif final == "@":
+            self.__shift(row, col, min(arg(0, 1), self.columns - col + 1))
+        elif final == "P":
+            self.__shift(row, col, -min(arg(0, 1), self.columns - col + 1))
+        elif final == "n":
+            if values[0] == 6:
+                self.input.append(Terminal.ESCAPE + f"[{row};{col}R".encode("ascii"))
+            elif values[0] == 5:
+                self.input.append(Terminal.ESCAPE + b"[0n")
+        elif final == "c":
+            self.input.append(Terminal.ESCAPE + self.identity)
+
+    def __moveTo(self, row: int, col: int) -> None:
+        self.cursor = (min(max(row, 1), self.rows), min(max(col, 1), self.columns))
+        self.wrapPending = False
+
+    def __erase(self, row: int, start: int, end: int) -> None:
+        for c in range(start - 1, end):
+            self.screen[row - 1][c] = " "
+            self.attrs[row - 1][c] = 0
+
+    def __shift(self, row: int, col: int, count: int) -> None:
+        # Inserts blanks at the cursor for positive counts, deletes characters for negative
+        # ones, shifting the rest of the line over either way.
+        text, attrs = self.screen[row - 1], self.attrs[row - 1]
+        if count > 0:
+            text[col - 1:] = ([" "] * count + text[col - 1:])[: self.columns - col + 1]
+            attrs[col - 1:] = ([0] * count + attrs[col - 1:])[: self.columns - col + 1]
+        elif count < 0:
+            text[col - 1:] = text[col - 1 - count:] + [" "] * -count
+            attrs[col - 1:] = attrs[col - 1 - count:] + [0] * -count
+
+    def __lineFeed(self) -> None:
+        row, col = self.cursor
+        if row == self.bottom:
+            del self.screen[self.top - 1]
+            del self.attrs[self.top - 1]
+            self.screen.insert(self.bottom - 1, [" "] * self.columns)
+            self.attrs.insert(self.bottom - 1, [0] * self.columns)
+        elif row < self.rows:
+            self.cursor = (row + 1, col)
+
+    def __reverseLineFeed(self) -> None:
+        row, col = self.cursor
+        if row == self.top:
+            del self.screen[self.bottom - 1]
+            del self.attrs[self.bottom - 1]
+            self.screen.insert(self.top - 1, [" "] * self.columns)
+            self.attrs.insert(self.top - 1, [0] * self.columns)
+        elif row > 1:
+            self.cursor = (row - 1, col)
+
+    def __print(self, ch: str) -> None:
+        if self.charset == "0":
+            ch = DEC_GRAPHICS.get(ch, ch)
+
+        if self.wrapPending:
+            self.wrapPending = False
+            self.__lineFeed()
+            self.cursor = (self.cursor[0], 1)
+
+        row, col = self.cursor
+        self.screen[row - 1][col - 1] = ch
+        self.attrs[row - 1][col - 1] = self.attr
+        if col < self.columns:
+            self.cursor = (row, col + 1)
+        else:
+            self.wrapPending = True
@@ -0,0 +1,54 @@
+from vtpy import Terminal
+
+
+# Designate the DEC special graphics set into G0, and put ASCII back afterwards.
+DEC_GRAPHICS = b"(0"
+ASCII_CHARSET = b"(B"
+
+# Line drawing is composed using the DEC special graphics letters for horizontal,
+# vertical, and the top left, top right, bottom left and bottom right corners. On
+# terminals without the DEC set these are translated to their Unicode equivalents,
+# which cost three bytes a cell instead of one.
+DEC_LINES = "qxlkmj"
+UNICODE_LINES = "─│┌┐└┘"
+
+HORIZONTAL = "q"
+VERTICAL = "x"
+TOP_LEFT = "l"
+TOP_RIGHT = "k"
+BOTTOM_LEFT = "m"
+BOTTOM_RIGHT = "j"
+
+_TO_UNICODE = str.maketrans(DEC_LINES, UNICODE_LINES)
+
+
+def sendLines(terminal: Terminal, text: str, lineDrawing: bool) -> None:
+    # Send text made up of DEC line drawing letters and spaces.
+    if lineDrawing:
+        terminal.sendCommand(DEC_GRAPHICS)
+        terminal.sendText(text)
+        terminal.sendCommand(ASCII_CHARSET)
+    else:
+        terminal.sendText(text.translate(_TO_UNICODE))
+
+
+def drawRule(terminal: Terminal, width: int, lineDrawing: bool) -> None:
+    # Draws a horizontal rule starting at the current cursor position.
+    if width > 0:
+        sendLines(terminal, HORIZONTAL * width, lineDrawing)
+
+
+def drawBox(terminal: Terminal, row: int, col: int, width: int, height: int, lineDrawing: bool) -> None:
+    # Draws the outline of a panel, leaving the inside alone.
+    if width < 2 or height < 2:
+        return
+
+    terminal.moveCursor(row, col)
+    sendLines(terminal, TOP_LEFT + HORIZONTAL * (width - 2) + TOP_RIGHT, lineDrawing)
+    for side in range(row + 1, row + height - 1):
+        terminal.moveCursor(side, col)
+        sendLines(terminal, VERTICAL, lineDrawing)
+        terminal.moveCursor(side, col + width - 1)
+        sendLines(terminal, VERTICAL, lineDrawing)
+    terminal.moveCursor(row + height - 1, col)
+    sendLines(terminal, BOTTOM_LEFT + HORIZONTAL * (width - 2) + BOTTOM_RIGHT, lineDrawing)
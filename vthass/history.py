@@ -0,0 +1,81 @@
+from array import array
+from typing import Iterator, List, Optional
+
+
+# Sparkline glyphs from lowest to highest. The DEC special graphics set has five
+# horizontal scan lines that make a cheap one byte per column sparkline, anything
+# else gets the Unicode block elements.
+DEC_SPARK = "srqpo"
+UNICODE_SPARK = "▁▂▃▄▅▆▇█"
+
+
+class History:
+    def __init__(self, size: int) -> None:
+        # Fixed-size ring of samples, so that appending never allocates.
+        self.size = max(size, 1)
+        self.values = array("d", [0.0] * self.size)
+        self.start = 0
+        self.count = 0
+        self.total = 0.0
+
+        # How many samples have ever been appended, which decides where each one is drawn.
+        self.appended = 0
+
+    def append(self, value: float) -> None:
+        if self.count < self.size:
+            self.values[(self.start + self.count) % self.size] = value
+            self.count += 1
+        else:
+            self.total -= self.values[self.start]
+            self.values[self.start] = value
+            self.start = (self.start + 1) % self.size
+        self.total += value
+        self.appended += 1
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __iter__(self) -> Iterator[float]:
+        for i in range(self.count):
+            yield self.values[(self.start + i) % self.size]
+
+    @property
+    def minimum(self) -> Optional[float]:
+        return min(self) if self.count else None
+
+    @property
+    def maximum(self) -> Optional[float]:
+        return max(self) if self.count else None
+
+    @property
+    def average(self) -> Optional[float]:
+        return (self.total / self.count) if self.count else None
+
+    def latest(self, count: int) -> List[float]:
+        count = min(count, self.count)
+        return [
+            self.values[(self.start + i) % self.size]
+            for i in range(self.count - count, self.count)
+        ]
+
+    def sparkline(self, width: int, glyphs: str) -> str:
+        # Sweep the most recent samples across width columns from the left, leaving a gap
+        # after the newest one. Each sample keeps its column until it's swept over, so that
+        # appending only changes two columns unless the scale changes along with it.
+        values = self.latest(width - 1)
+        if not values:
+            return " " * width
+
+        low = min(values)
+        high = max(values)
+        levels = len(glyphs) - 1
+
+        line = [" "] * width
+        first = self.appended - len(values)
+        for offset, value in enumerate(values):
+            if high == low:
+                glyph = glyphs[levels // 2]
+            else:
+                glyph = glyphs[int(round((value - low) / (high - low) * levels))]
+            line[(first + offset) % width] = glyph
+        return "".join(line)
@@ -0,0 +1,142 @@
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from vtpy import Terminal
+
+from .emulator import BLINK, BOLD, DEC_GRAPHICS as DEC_GLYPHS, REVERSE, UNDERLINE, EmulatedTerminal
+from .graphics import ASCII_CHARSET, DEC_GRAPHICS
+from .terminal import TerminalWrapper
+
+
+# Runs of changed cells separated by fewer unchanged cells than this are sent as one,
+# since resending a few cells is cheaper than moving the cursor past them.
+_MERGE_GAP = 8
+
+# Which DEC special graphics letter draws each glyph, so that line drawing goes back out
+# the same way it came in.
+_DEC_LETTERS: Dict[str, str] = {glyph: letter for letter, glyph in DEC_GLYPHS.items() if glyph != " "}
+
+_ATTRIBUTES: List[Tuple[int, bytes]] = [
+    (BOLD, Terminal.SET_BOLD),
+    (UNDERLINE, b"[4m"),
+    (BLINK, b"[5m"),
+    (REVERSE, Terminal.SET_REVERSE),
+]
+
+
+class _Screen(EmulatedTerminal):
+    # An emulated screen that is only ever looked at, so it doesn't hang onto output.
+    def _write(self, data: bytes) -> None:
+        super()._write(data)
+        self.output.clear()
+        self.input.clear()
+
+
+class ShadowTerminal(TerminalWrapper):
+    # Passes everything through to the real terminal while keeping an emulated copy of
+    # what it should now be showing, so that we can work out the cheapest way to get from
+    # what's on screen to something else.
+    def __init__(self, terminal: Terminal) -> None:
+        super().__init__(terminal)
+        self.screen = _Screen(self.rows, self.columns)
+
+    def _output(self, data: bytes) -> None:
+        super()._output(data)
+        if self.screen.columns != self.columns or self.screen.rows != self.rows:
+            # The terminal changed size underneath us, which clears it.
+            self.screen = _Screen(self.rows, self.columns)
+        self.screen._write(data)
+
+    def copy(self) -> EmulatedTerminal:
+        # An offscreen copy of the current screen to draw something else onto.
+        offscreen = _Screen(self.screen.rows, self.screen.columns)
+        offscreen.screen = [row[:] for row in self.screen.screen]
+        offscreen.attrs = [row[:] for row in self.screen.attrs]
+        return offscreen
+
+
+def sendDifferences(
+    terminal: Terminal,
+    before: EmulatedTerminal,
+    after: EmulatedTerminal,
+    rows: Iterable[int],
+    lineDrawing: bool,
+    stop: Optional[Callable[[], bool]] = None,
+) -> bool:
+    # Updates the given rows of a terminal showing one screen so that they show another,
+    # sending only the cells that differ. Leaves attributes normal and the ASCII set active.
+    # If asked to stop partway, returns False having only updated some of the rows, and
+    # diffing again from what's now on screen picks up where it left off.
+    finished = True
+    columns = min(before.columns, after.columns)
+    attr: Optional[int] = None
+    graphics = False
+    cursor: Optional[Tuple[int, int]] = None
+
+    for row in rows:
+        oldText, oldAttrs = before.screen[row - 1], before.attrs[row - 1]
+        newText, newAttrs = after.screen[row - 1], after.attrs[row - 1]
+        if oldText == newText and oldAttrs == newAttrs:
+            continue
+        if stop is not None and stop():
+            finished = False
+            break
+
+        # Anything after the last visible cell can be erased in one go.
+        tail = columns
+        while tail > 0 and newText[tail - 1] == " " and newAttrs[tail - 1] == 0:
+            tail -= 1
+
+        changed = [
+            c for c in range(columns) if oldText[c] != newText[c] or oldAttrs[c] != newAttrs[c]
+        ]
+        erase = bool(changed) and changed[-1] >= tail and columns - tail > _MERGE_GAP
+        if erase:
+            changed = [c for c in changed if c < tail]
+
+        runs: List[Tuple[int, int]] = []
+        for c in changed:
+            if runs and c - runs[-1][1] <= _MERGE_GAP:
+                runs[-1] = (runs[-1][0], c + 1)
+            else:
+                runs.append((c, c + 1))
+        if erase:
+            runs.append((tail, tail))
+
+        for start, end in runs:
+            if cursor != (row, start + 1):
+                terminal.moveCursor(row, start + 1)
+
+            text = ""
+            for c in range(start, end):
+                ch = newText[c]
+                dec = lineDrawing and ch in _DEC_LETTERS
+                if newAttrs[c] != attr or dec != graphics:
+                    if text:
+                        terminal.sendText(text)
+                        text = ""
+                    if newAttrs[c] != attr:
+                        terminal.sendCommand(Terminal.SET_NORMAL)
+                        for bit, command in _ATTRIBUTES:
+                            if newAttrs[c] & bit:
+                                terminal.sendCommand(command)
+                        attr = newAttrs[c]
+                    if dec != graphics:
+                        terminal.sendCommand(DEC_GRAPHICS if dec else ASCII_CHARSET)
+                        graphics = dec
+                text += _DEC_LETTERS[ch] if dec else ch
+            if text:
+                terminal.sendText(text)
+
+            if start == end:
+                # Erasing fills with the current attributes, so make sure they're normal.
+                if attr != 0:
+                    terminal.sendCommand(Terminal.SET_NORMAL)
+                    attr = 0
+                terminal.sendCommand(b"[K")
+            cursor = (row, min(end + 1, columns))
+
+    if attr not in {None, 0}:
+        terminal.sendCommand(Terminal.SET_NORMAL)
+    if graphics:
+        terminal.sendCommand(ASCII_CHARSET)
+    return finished
@@ -0,0 +1,186 @@
+import logging
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Callable, Deque, Dict, List, Optional, TextIO, Tuple
+
+
+# Everything in the package logs to a child of this.
+logger = logging.getLogger("vthass")
+
+
+class EventRing(logging.Handler):
+    # Keeps the most recent log events in memory, so that the monitoring endpoint can say
+    # what has been going on without anybody having to dig through the system logs.
+    def __init__(self, size: int = 256) -> None:
+        super().__init__()
+        self.events: Deque[Dict[str, Any]] = deque(maxlen=size)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.events.append(
+            {
+                "time": record.created,
+                "level": record.levelname,
+                "source": record.name,
+                "message": record.getMessage(),
+            }
+        )
+
+    def recent(self) -> List[Dict[str, Any]]:
+        self.acquire()
+        try:
+            return list(self.events)
+        finally:
+            self.release()
+
+
+class RepeatFilter(logging.Filter):
+    # Lets the first of any identical run of warnings or errors through, then swallows
+    # repeats until the interval is up, at which point the next one goes out along with
+    # how many were swallowed. Keeps a flapping connection from flooding the logs. Runs
+    # that stop before the interval is up are summarized by flush() instead.
+    LIMIT = 256
+
+    def __init__(self, interval: float = 60.0, clock: Callable[[], float] = time.time) -> None:
+        super().__init__()
+        self.interval = interval
+        self.clock = clock
+        self.__seen: Dict[Tuple[str, int, str], Tuple[float, int]] = {}
+        self.__lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING:
+            return True
+
+        now = self.clock()
+        message = record.getMessage()
+        key = (record.name, record.levelno, message)
+        with self.__lock:
+            seen = self.__seen.get(key)
+            if seen is not None and (now - seen[0]) < self.interval:
+                self.__seen[key] = (seen[0], seen[1] + 1)
+                return False
+
+            if seen is not None and seen[1] > 0:
+                record.msg = self.__summarize(message, seen[1], now - seen[0])
+                record.args = None
+
+            self.__seen.pop(key, None)
+            self.__seen[key] = (now, 0)
+            while len(self.__seen) > self.LIMIT:
+                del self.__seen[next(iter(self.__seen))]
+        return True
+
+    def flush(self) -> List[logging.LogRecord]:
+        # Hands back a summary for every run whose interval is up and that had repeats
+        # swallowed, so that the count goes out even if the message never comes again.
+        now = self.clock()
+        records: List[logging.LogRecord] = []
+        with self.__lock:
+            for key, (first, count) in list(self.__seen.items()):
+                if count == 0 or (now - first) < self.interval:
+                    continue
+                name, level, message = key
+                records.append(
+                    logging.makeLogRecord(
+                        {
+                            "name": name,
+                            "levelno": level,
+                            "levelname": logging.getLevelName(level),
+                            "msg": self.__summarize(message, count, now - first),
+                        }
+                    )
+                )
+                # The next one starts a new run and goes straight out.
+                del self.__seen[key]
+        return records
+
+    def __summarize(self, message: str, count: int, elapsed: float) -> str:
+        return f"{message} (repeated {count} times in the last {int(elapsed)}s)"
+
+
+class _DroppingQueueHandler(QueueHandler):
+    # Never waits on a full queue, it's better to lose a log line than a frame.
+    def __init__(self, records: "queue.Queue[logging.LogRecord]") -> None:
+        super().__init__(records)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _FlushingListener(QueueListener):
+    # Wakes up every so often while the queue is quiet to write out repeat summaries
+    # that are due, instead of holding them until the same message shows up again.
+    FLUSH = 1.0
+
+    def __init__(
+        self,
+        records: "queue.Queue[logging.LogRecord]",
+        repeats: RepeatFilter,
+        *handlers: logging.Handler,
+    ) -> None:
+        super().__init__(records, *handlers)
+        self.records = records
+        self.repeats = repeats
+
+    def dequeue(self, block: bool) -> logging.LogRecord:
+        while True:
+            try:
+                return self.records.get(block, self.FLUSH if block else None)
+            except queue.Empty:
+                if not block:
+                    raise
+            for summary in self.repeats.flush():
+                self.handle(summary)
+
+
+# Recent events, filled in once logging has been started.
+RING = EventRing()
+
+_handler: Optional[_DroppingQueueHandler] = None
+_listener: Optional[_FlushingListener] = None
+
+
+def startLogging(stream: TextIO = sys.stdout, size: int = 1024) -> None:
+    # Hands everything logged to a background thread which does the actual writing, so
+    # that a slow stdout under journald can never hold up drawing.
+    global _handler, _listener
+    if _listener is not None:
+        return
+
+    output = logging.StreamHandler(stream)
+    output.setFormatter(logging.Formatter("%(message)s"))
+
+    records: "queue.Queue[logging.LogRecord]" = queue.Queue(size)
+    repeats = RepeatFilter()
+    _handler = _DroppingQueueHandler(records)
+    _handler.addFilter(repeats)
+    _listener = _FlushingListener(records, repeats, output, RING)
+
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    _listener.start()
+
+
+def stopLogging() -> None:
+    # Writes out anything still queued and stops the background thread.
+    global _handler, _listener
+    if _listener is None or _handler is None:
+        return
+
+    logger.removeHandler(_handler)
+    _listener.stop()
+    _handler = None
+    _listener = None
+
+
+def dropped() -> int:
+    return _handler.dropped if _handler is not None else 0
@@ -1,36 +1,51 @@
 import json
-import os
+import logging
+import threading
+from typing import Any, Dict
 from flask import Flask, Response
+from werkzeug.serving import make_server
 
+from .log import RING, dropped
 
-def monitoring_thread(port: int, version: str) -> None:
-    app = Flask("monitoring thread")
 
-    @app.route("/")
-    def monitor() -> Response:
-        return Response(
-            response=json.dumps(
+logger = logging.getLogger(__name__)
+
+
+class Monitor:
+    # Answers monitoring HTTP requests on a background thread, including the most recent
+    # log events so that problems can be looked into from the main home assistant instance.
+    def __init__(self, port: int, version: str) -> None:
+        self.port = port
+        app = Flask("monitoring thread")
+
+        def respond(data: Dict[str, Any]) -> Response:
+            return Response(response=json.dumps(data), status=200, mimetype="application/json")
+
+        @app.route("/")
+        def monitor() -> Response:
+            return respond(
                 {
                     "type": "vt-100",
                     "version": version,
                 }
-            ),
-            status=200,
-            mimetype="application/json",
-        )
-
-    try:
-        print(f"Listening on port {port} for monitoring HTTP requests.")
-
-        # Kinda stupid that we can't disable this. I don't care that this is non-production,
-        # its literally a monitoring port for a local-only VT-100 controlling terminal.
-        import sys
-
-        f = open(os.devnull, "w")
-        sys.stdout = f
-        sys.stderr = f
-
-        app.run(host="0.0.0.0", port=port, debug=False, use_reloader=False)
-    except KeyboardInterrupt:
-        # Silently exit without spewing
-        pass
+            )
+
+        @app.route("/events")
+        def events() -> Response:
+            return respond({"events": RING.recent(), "dropped": dropped()})
+
+        # Kinda stupid that we can't disable this otherwise. I don't care that this is
+        # non-production, its literally a monitoring port for a local-only VT-100 controlling
+        # terminal.
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+        self.server = make_server("0.0.0.0", port, app, threaded=True)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self) -> None:
+        logger.info(f"Listening on port {self.port} for monitoring HTTP requests.")
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.thread.join()
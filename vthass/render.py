@@ -1,9 +1,28 @@
-from typing import Dict, List, Optional, Tuple
+import bisect
+import logging
+import sys
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple, Type, TypeVar, Union
 
 from vtpy import Terminal
 
-from .api import HomeAssistant, Entity, SwitchEntity, SensorEntity
-from .config import Page
+from .api import BackgroundFetch, HomeAssistant, Entity, ServiceCalls, SwitchEntity, SensorEntity
+from .capabilities import Capabilities, getProfile
+from .history import DEC_SPARK, UNICODE_SPARK, History
+from .kiosk import ShadowTerminal, sendDifferences
+from .rendercache import RenderCache, Sequence, play
+from .config import Entity as LayoutEntity, Page
+from .domains import domainOf, lookup
+from .emulator import EmulatedTerminal
+from .graphics import BOTTOM_LEFT, BOTTOM_RIGHT, HORIZONTAL, VERTICAL, drawBox, drawRule, sendLines
+from .scheduler import PollScheduler
+from .stats import Stats
+from .terminal import TerminalWrapper
+from .writer import queued, region, writerOf
+
+
+logger = logging.getLogger(__name__)
 
 
 class Action:
@@ -54,8 +73,10 @@ class Object:
     def selected(self, newval: bool) -> None:
         pass
 
-    def toggle(self) -> None:
-        pass
+    def update(self, terminal: Terminal, width: int) -> None:
+        # Redraw an object that is already on screen. Objects that can repaint only
+        # the parts that changed override this.
+        self.render(terminal, width)
 
     def render(self, terminal: Terminal, width: int) -> None:
         text = f"UNSUPPORTED ENTITY {self.entity.entity_id}"
@@ -68,25 +89,35 @@ class Object:
 
 
 class HelpObject(Object):
-    def __init__(self) -> None:
-        self.lines = [
-            "The following commands are available to use at any time:",
-            "",
-            "    prev",
-            "        Display the previous tab.",
-            "",
-            "    next",
-            "        Display the next tab.",
-            "",
-            "    toggle [SWITCH]",
-            "        Toggle a displayed switch by name.",
-            "",
-            "    help",
-            "        Display this help screen.",
-            "",
-            "    exit",
-            "        Exit out of the dashboard interface.",
-        ]
+    # Each line of help is its own object, so that a help page taller than the
+    # screen scrolls like any other page.
+    LINES = [
+        "The following commands are available to use at any time:",
+        "",
+        "    prev",
+        "        Display the previous tab.",
+        "",
+        "    next",
+        "        Display the next tab.",
+        "",
+        "    toggle [SWITCH]",
+        "        Toggle a displayed switch by name.",
+        "",
+        "    on [SWITCHES], off [SWITCHES]",
+        "        Turn on or off every displayed switch matching a name or group.",
+        "",
+        "    toggle all",
+        "        Toggle every displayed switch.",
+        "",
+        "    help",
+        "        Display this help screen.",
+        "",
+        "    exit",
+        "        Exit out of the dashboard interface.",
+    ]
+
+    def __init__(self, line: str) -> None:
+        self.line = line
 
     @property
     def name(self) -> str:
@@ -97,21 +128,15 @@ class HelpObject(Object):
         return True
 
     def render(self, terminal: Terminal, width: int) -> None:
-        row, col = terminal.fetchCursor()
-        for line in self.lines:
-            text = line[:width]
-
-            terminal.moveCursor(row, col)
-            terminal.sendText(text)
-            row += 1
+        terminal.sendText(self.line[:width])
 
     def calculate(self, terminal: Terminal, width: int) -> int:
-        return len(self.lines)
+        return 1
 
 
 class HorizontalRuleObject(Object):
-    def __init__(self) -> None:
-        pass
+    def __init__(self, lineDrawing: bool = True) -> None:
+        self.lineDrawing = lineDrawing
 
     @property
     def name(self) -> str:
@@ -122,7 +147,7 @@ class HorizontalRuleObject(Object):
         return True
 
     def render(self, terminal: Terminal, width: int) -> None:
-        terminal.sendText("\u2500" * width)
+        drawRule(terminal, width, self.lineDrawing)
 
     def calculate(self, terminal: Terminal, width: int) -> int:
         return 1
@@ -168,14 +193,58 @@ class TemplateObject(Object):
         return 1
 
 
+class PendingObject(Object):
+    # Stands in for an entity that Home Assistant hasn't told us about yet, taking up the
+    # same space the real object most likely will so that the page doesn't shift around
+    # when it arrives.
+    PLACEHOLDER = " ... "
+
+    def __init__(self, entity: Entity, layout: LayoutEntity) -> None:
+        super().__init__(entity, layout.name)
+        self.layout = layout
+        self.drawn = 0
+
+    def render(self, terminal: Terminal, width: int) -> None:
+        text = (self.name + self.PLACEHOLDER)[:width]
+        terminal.sendCommand(Terminal.SET_NORMAL)
+        terminal.sendText(text)
+        self.drawn = len(text)
+
+    def calculate(self, terminal: Terminal, width: int) -> int:
+        return 2 if self.layout.history is not None else 1
+
+
+class MissingObject(Object):
+    # Takes over from a placeholder once Home Assistant has answered without its entity.
+    # The entity is still asked about every so often, in case it turns up later.
+    def __init__(self, entity: Entity, layout: LayoutEntity) -> None:
+        super().__init__(entity, layout.name)
+        self.layout = layout
+        self.drawn = 0
+
+    def render(self, terminal: Terminal, width: int) -> None:
+        text = f"UNKNOWN ENTITY {self.entity.entity_id}"[:width]
+        terminal.sendCommand(Terminal.SET_NORMAL)
+        terminal.sendText(text)
+        self.drawn = len(text)
+
+
 class SwitchObject(Object):
-    def __init__(self, entity: SwitchEntity, overridden_name: Optional[str]) -> None:
+    def __init__(
+        self,
+        entity: SwitchEntity,
+        overridden_name: Optional[str],
+        cache: Optional[RenderCache] = None,
+    ) -> None:
         self.entity: SwitchEntity = entity
         self.__overridden_name: Optional[str] = overridden_name
+        self.__cache = cache
         self.__selected: bool = False
         self.__dirty: bool = True
         self.__lastName: str = entity.name
         self.__lastState: Optional[bool] = entity.state
+        self.__lastDetail: Optional[str] = entity.detail
+        self.__drawn = 0
 
     @property
     def name(self) -> str:
@@ -191,6 +260,7 @@ class SwitchObject(Object):
             self.__dirty
             or self.__lastName != self.name
             or self.__lastState != self.entity.state
+            or self.__lastDetail != self.entity.detail
         )
 
     @dirty.setter
@@ -198,6 +268,7 @@ class SwitchObject(Object):
         self.__dirty = newval
         self.__lastName = self.name
         self.__lastState = self.entity.state
+        self.__lastDetail = self.entity.detail
 
     @property
     def selectable(self) -> bool:
@@ -213,44 +284,99 @@ class SwitchObject(Object):
             self.__dirty = True
         self.__selected = newval
 
-    def toggle(self) -> None:
-        self.entity.state = not self.entity.state
-
-    def render(self, terminal: Terminal, width: int) -> None:
-        state = (
-            "UNK"
-            if self.entity.state is None
-            else ("ON " if self.entity.state else "OFF")
-        )
-
-        terminal.sendCommand(Terminal.SET_NORMAL)
-        terminal.sendCommand(Terminal.SET_BOLD)
-        terminal.sendText(f" {state} ")
-        terminal.sendCommand(Terminal.SET_NORMAL)
+    def __prepare(
+        self, state: Optional[bool], name: str, detail: Optional[str], width: int
+    ) -> Tuple[Sequence, Sequence]:
+        on, off = self.entity.LABELS
+        text = "UNK" if state is None else (on if state else off)
+        badge: Sequence = (Terminal.SET_NORMAL, Terminal.SET_BOLD, f" {text} ", Terminal.SET_NORMAL)
 
         width -= 5
         if width <= 0:
-            return
+            return (badge, ())
 
         selopen = "[" if self.__selected else " "
         selclose = "]" if self.__selected else " "
+        label = f"{selopen}{name}{selclose}" + (f" {detail}" if detail else "")
+        return (badge, (label[:width],))
 
-        text = (f"{selopen}{self.name}{selclose}")[:width]
-        terminal.sendText(text)
+    def render(self, terminal: Terminal, width: int) -> None:
+        state = self.entity.state
+        name = self.name
+        detail = self.entity.detail
+        if self.__cache is None:
+            badge, label = self.__prepare(state, name, detail, width)
+        else:
+            badge, label = self.__cache.fetch(
+                ("switch", self.entity.LABELS, state, name, detail, self.__selected, width),
+                lambda: self.__prepare(state, name, detail, width),
+            )
+
+        with region(terminal, ("switch", *terminal.fetchCursor())):
+            play(terminal, badge)
+        play(terminal, label)
+
+        # Blank out anything left over from a longer label, such as a name or a
+        # temperature that got shorter.
+        drawn = sum(len(op) for op in label if isinstance(op, str))
+        if drawn < self.__drawn:
+            terminal.sendText(" " * (self.__drawn - drawn))
+        self.__drawn = drawn
 
     def calculate(self, terminal: Terminal, width: int) -> int:
         return 1
 
 
 class SensorObject(Object):
-    def __init__(self, entity: SensorEntity, overridden_name: Optional[str], overridden_units: Optional[str]) -> None:
+    def __init__(
+        self,
+        entity: SensorEntity,
+        overridden_name: Optional[str],
+        overridden_units: Optional[str],
+        history: Optional[str] = None,
+        history_size: int = 40,
+        lineDrawing: bool = True,
+        precision: Optional[int] = None,
+        deadband: Optional[float] = None,
+        deadbandRelative: bool = False,
+        repaintInterval: Optional[float] = None,
+        cache: Optional[RenderCache] = None,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
         self.entity: SensorEntity = entity
         self.__overridden_name: Optional[str] = overridden_name
         self.__overridden_units: Optional[str] = overridden_units
+        self.__cache = cache
+
+        # Optional rounding, and limits on how small or how frequent a change has to be
+        # before it's worth spending serial bandwidth on.
+        self.precision = precision
+        self.deadband = deadband
+        self.deadbandRelative = deadbandRelative
+        self.repaintInterval = repaintInterval
+        self.suppressed = 0
+        self.__clock = clock
+
         self.__dirty: bool = True
+        self.__historyDirty = False
         self.__lastName: str = entity.name
-        self.__lastState: Optional[str] = entity.state
+        self.__lastState: Optional[str] = self.__format(entity.state)
+        self.__lastRaw: Optional[str] = entity.state
         self.__lastUnits: Optional[str] = entity.units
+        self.__lastPainted = 0.0
+
+        # Optional rolling history, displayed as a sparkline or min/avg/max readout.
+        self.historyMode = history
+        self.history: Optional[History] = History(history_size) if history else None
+        self.__glyphs = DEC_SPARK if lineDrawing else UNICODE_SPARK
+        self.__lineDrawing = lineDrawing
+
+        # What's currently on screen, so that updates can repaint only what changed.
+        self.__drawnName: Optional[str] = None
+        self.__drawnHeight = 0
+        self.__drawnValue = 0
+        self.__widestValue = 0
+        self.__drawnHistory = ""
 
     @property
     def name(self) -> str:
@@ -266,52 +392,488 @@ class SensorObject(Object):
 
     @property
     def dirty(self) -> bool:
-        return (
-            self.__dirty
-            or self.__lastName != self.name
-            or self.__lastState != self.entity.state
-            or self.__lastUnits != self.units
-        )
+        return self.__historyDirty or self.__valueDirty()
 
     @dirty.setter
     def dirty(self, newval: bool) -> None:
         self.__dirty = newval
+        self.__historyDirty = False
         self.__lastName = self.name
-        self.__lastState = self.entity.state
         self.__lastUnits = self.units
 
-    def render(self, terminal: Terminal, width: int) -> None:
-        row, col = terminal.fetchCursor()
+    def __valueDirty(self) -> bool:
+        return (
+            self.__dirty
+            or self.__lastName != self.name
+            or self.__lastUnits != self.units
+            or self.__valueChanged()
+        )
 
-        state = "UNK" if self.entity.state is None else self.entity.state
-        state += f" {self.units}" if self.units else ""
-        name = f" {self.name} "
+    def __accept(self) -> None:
+        # The current state is about to be drawn, so it's what later ones get compared to.
+        self.__lastState = self.__format(self.entity.state)
+        self.__lastRaw = self.entity.state
+        self.__lastPainted = self.__clock()
+
+    def __format(self, state: Optional[str]) -> Optional[str]:
+        if state is None or self.precision is None:
+            return state
+        try:
+            return f"{float(state):.{self.precision}f}"
+        except ValueError:
+            return state
+
+    def __valueChanged(self) -> bool:
+        # Compares what we would display rather than the raw state, so that jitter in
+        # digits we don't show, or inside the deadband, doesn't cost a repaint.
+        value = self.__format(self.entity.state)
+        return value != self.__lastState and not self.__withinDeadband(value) and not (
+            self.repaintInterval and self.__clock() - self.__lastPainted < self.repaintInterval
+        )
 
-        terminal.sendCommand(Terminal.SET_NORMAL)
-        terminal.sendText(name[:width])
+    def polled(self) -> None:
+        # Called whenever a poll changes our state, to count the changes we don't draw.
+        if self.entity.state != self.__lastRaw and not self.__valueChanged():
+            self.suppressed += 1
+
+    def __withinDeadband(self, value: Optional[str]) -> bool:
+        if self.deadband is None or value is None or self.__lastState is None:
+            return False
+        try:
+            new = float(value)
+            old = float(self.__lastState)
+        except ValueError:
+            return False
+
+        threshold = (abs(old) * self.deadband / 100.0) if self.deadbandRelative else self.deadband
+        return abs(new - old) < threshold
+
+    def seed(self, states: List[str]) -> None:
+        for state in states:
+            self.__record(state)
+
+    def record(self) -> None:
+        # Sample the current state into the history, once for every poll that fetched it
+        # so that the history is a time series whether or not the value moved.
+        if self.entity.state is not None:
+            self.__record(self.entity.state)
+
+    def __record(self, state: str) -> None:
+        if self.history is None:
+            return
+
+        try:
+            self.history.append(float(state))
+        except ValueError:
+            # Things like "unavailable" have no place on a graph.
+            return
+        self.__historyDirty = True
+
+    def __prepare(
+        self, name: str, state: Optional[str], units: Optional[str], width: int
+    ) -> Tuple[bool, str, str, Sequence]:
+        # Works out whether the value wraps below the name, along with the name and the
+        # value as they will be drawn at this width.
+        text = self.__format(state) or "UNK"
+        text += f" {units}" if units else ""
+        name = f" {name} "
+        wrapped = len(name) + len(text) > width
+
+        value = f" {text} "[:width if wrapped else (width - len(name))]
+        return (wrapped, name, value, (Terminal.SET_NORMAL, name[:width]))
+
+    def __layout(self, width: int, counted: bool = True) -> Tuple[bool, str, str, Sequence]:
+        # Laid out with the last state we accepted, so that a suppressed change doesn't
+        # sneak onto the screen along with a history update.
+        name = self.name
+        state = self.__lastRaw
+        units = self.units
+        if self.__cache is None:
+            return self.__prepare(name, state, units, width)
+        return self.__cache.fetch(
+            ("sensor", name, state, units, self.precision, width),
+            lambda: self.__prepare(name, state, units, width),
+            counted,
+        )
+
+    def __historyText(self, width: int) -> str:
+        if self.history is None:
+            return ""
+
+        if self.historyMode == "sparkline":
+            return " " + self.history.sparkline(min(self.history.size + 1, width - 2), self.__glyphs)
 
-        if len(name) + len(state) > width:
+        minimum = self.history.minimum
+        average = self.history.average
+        maximum = self.history.maximum
+        if minimum is None or average is None or maximum is None:
+            return " min - avg - max -"[:width]
+        return f" min {minimum:.4g} avg {average:.4g} max {maximum:.4g}"[:width]
+
+    def __sendHistory(self, terminal: Terminal, text: str) -> None:
+        if self.historyMode == "sparkline" and self.__lineDrawing:
+            sendLines(terminal, text, True)
+        else:
+            terminal.sendText(text)
+
+    def render(self, terminal: Terminal, width: int) -> None:
+        self.__accept()
+        row, col = terminal.fetchCursor()
+        wrapped, name, value, label = self.__layout(width)
+
+        play(terminal, label)
+        if wrapped:
             row += 1
             terminal.moveCursor(row, col)
-        else:
-            width -= len(name)
 
         terminal.sendCommand(Terminal.SET_BOLD)
-        terminal.sendText(f" {state} "[:width])
+        terminal.sendText(value)
         terminal.sendCommand(Terminal.SET_NORMAL)
 
+        self.__drawnName = name
+        self.__drawnHeight = (2 if wrapped else 1) + (1 if self.history is not None else 0)
+        self.__drawnValue = len(value)
+        self.__widestValue = len(value)
+        self.__drawnHistory = ""
+
+        if self.history is not None:
+            text = self.__historyText(width)
+            terminal.moveCursor(row + 1, col)
+            self.__sendHistory(terminal, text)
+            self.__drawnHistory = text
+
+    def update(self, terminal: Terminal, width: int) -> None:
+        valueDirty = self.__valueDirty()
+        if valueDirty:
+            self.__accept()
+
+        wrapped, name, value, _ = self.__layout(width)
+        if name != self.__drawnName or self.calculate(terminal, width) != self.__drawnHeight:
+            # The name moved things around, so repaint the whole thing.
+            self.render(terminal, width)
+            return
+
+        # Only the value and history changed, so leave the name where it is.
+        row, col = terminal.fetchCursor()
+        valueRow = row + (1 if wrapped else 0)
+        valueCol = col if wrapped else (col + len(name))
+        valueWidth = width if wrapped else (width - len(name))
+
+        if valueDirty:
+            # The copy this replaces may never get drawn, so blank out to the widest value
+            # that could be on screen instead of just the last one we sent. Once nothing
+            # is waiting to go out, the screen has whatever we sent last.
+            key = ("value", valueRow, valueCol)
+            if not queued(terminal, key):
+                self.__widestValue = self.__drawnValue
+            terminal.moveCursor(valueRow, valueCol)
+            with region(terminal, key):
+                terminal.sendCommand(Terminal.SET_BOLD)
+                terminal.sendText(value.ljust(min(self.__widestValue, valueWidth)))
+                terminal.sendCommand(Terminal.SET_NORMAL)
+            self.__drawnValue = len(value)
+            self.__widestValue = max(self.__widestValue, len(value))
+
+        if self.history is None:
+            return
+
+        # Anything left over from a longer line before gets blanked out.
+        drawn = self.__historyText(width)
+        text = drawn.ljust(len(self.__drawnHistory))
+        old = self.__drawnHistory.ljust(len(text))
+        self.__drawnHistory = drawn
+
+        # Send only the runs of columns that actually changed. Runs separated by only a
+        # few unchanged columns are merged, since resending those is cheaper than moving.
+        index = 0
+        while index < len(text):
+            if text[index] == old[index]:
+                index += 1
+                continue
+
+            end = index
+            while end < len(text) and any(
+                text[i] != old[i] for i in range(end, min(end + 8, len(text)))
+            ):
+                end += 1
+            terminal.moveCursor(valueRow + 1, col + index)
+            self.__sendHistory(terminal, text[index:end])
+            index = end
+
     def calculate(self, terminal: Terminal, width: int) -> int:
-        state = "UNK" if self.entity.state is None else self.entity.state
-        state += f" {self.units}" if self.units else ""
-        name = f" {self.name} "
+        # Only measuring isn't a draw, so it doesn't count towards the cache's hit rate.
+        wrapped, _, _, _ = self.__layout(width, counted=False)
+        return (2 if wrapped else 1) + (1 if self.history is not None else 0)
+
+
+E = TypeVar("E", bound=Entity)
+
+# Makes the object that draws an entity, given how the layout wants it shown.
+Builder = Callable[[E, LayoutEntity, Capabilities, RenderCache, Callable[[], float]], Object]
+
+
+def _buildSwitch(
+    entity: SwitchEntity,
+    layout: LayoutEntity,
+    capabilities: Capabilities,
+    cache: RenderCache,
+    clock: Callable[[], float],
+) -> Object:
+    return SwitchObject(entity, overridden_name=layout.name, cache=cache)
+
+
+def _buildSensor(
+    entity: SensorEntity,
+    layout: LayoutEntity,
+    capabilities: Capabilities,
+    cache: RenderCache,
+    clock: Callable[[], float],
+) -> Object:
+    return SensorObject(
+        entity,
+        overridden_name=layout.name,
+        overridden_units=layout.units,
+        history=layout.history,
+        history_size=layout.history_size,
+        lineDrawing=capabilities.lineDrawing,
+        precision=layout.precision,
+        deadband=layout.deadband,
+        deadbandRelative=layout.deadband_relative,
+        repaintInterval=layout.repaint_interval,
+        cache=cache,
+        clock=clock,
+    )
+
+
+# Which builder draws each kind of entity. Entity classes without one of their own use
+# the one for the nearest class they derive from, so everything that can be switched is
+# drawn the same way, with its own labels. Anything left over is shown as unsupported.
+_BUILDERS: Dict[Type[Entity], Builder[Any]] = {}
+
+
+def registerBuilder(entity: Type[E], build: Builder[E]) -> None:
+    _BUILDERS[entity] = build
+
+
+def builderFor(entity: Entity) -> Optional[Builder[Any]]:
+    for cls in type(entity).__mro__:
+        build = _BUILDERS.get(cls)
+        if build is not None:
+            return build
+    return None
+
+
+registerBuilder(SwitchEntity, _buildSwitch)
+registerBuilder(SensorEntity, _buildSensor)
+
+
+class SelectionIndex:
+    # Longest n-gram we index names by for substring lookups.
+    NGRAM = 3
+
+    def __init__(self, objects: List[Object]) -> None:
+        self.objects = objects
+
+        # Ordered positions of every selectable object, so that moving the selection
+        # is a constant-time step through this list rather than a scan of the page.
+        self.positions: List[int] = [i for i, o in enumerate(objects) if o.selectable]
+        self.current: Optional[int] = None
+        for slot, position in enumerate(self.positions):
+            if objects[position].selected:
+                self.current = slot
+                break
+
+        self.names: List[str] = []
+        self.exact: Dict[str, List[int]] = {}
+        self.sortedNames: List[str] = []
+        self.sortedSlots: List[int] = []
+        self.ngrams: Dict[str, Set[int]] = {}
+        self.rebuild()
+
+    def rebuild(self) -> None:
+        # Pre-lowercase every name and index it for exact, prefix and substring lookups.
+        self.names = [self.objects[p].name.lower() for p in self.positions]
+        self.exact = {}
+        self.ngrams = {}
+
+        for slot, name in enumerate(self.names):
+            self.exact.setdefault(name, []).append(slot)
+            for size in range(1, self.NGRAM + 1):
+                for start in range(len(name) - size + 1):
+                    self.ngrams.setdefault(name[start:(start + size)], set()).add(slot)
+
+        ordered = sorted((name, slot) for slot, name in enumerate(self.names))
+        self.sortedNames = [name for name, _ in ordered]
+        self.sortedSlots = [slot for _, slot in ordered]
 
-        if len(name) + len(state) > width:
-            return 2
-        else:
-            return 1
+    @property
+    def selected(self) -> Optional[int]:
+        return None if self.current is None else self.positions[self.current]
+
+    def move(self, delta: int) -> bool:
+        # Moves the selection, returning whether it actually moved anywhere.
+        if self.current is None:
+            return False
+
+        target = min(max(self.current + delta, 0), len(self.positions) - 1)
+        if target == self.current:
+            return False
+
+        self.objects[self.positions[self.current]].selected = False
+        self.objects[self.positions[target]].selected = True
+        self.current = target
+        return True
+
+    def resolve(self, name: str) -> Optional[Object]:
+        # Find a single selectable object by exact name, then by unique prefix, then
+        # by unique substring.
+        name = name.lower()
+        if not name:
+            return None
+
+        exact = self.exact.get(name)
+        if exact:
+            return self.objects[self.positions[exact[0]]]
+
+        start = bisect.bisect_left(self.sortedNames, name)
+        end = bisect.bisect_left(self.sortedNames, name + "\uffff")
+        if end - start == 1:
+            return self.objects[self.positions[self.sortedSlots[start]]]
+
+        candidates = self.__substring(name)
+        if len(candidates) == 1:
+            return self.objects[self.positions[next(iter(candidates))]]
+        return None
+
+    def matches(self, name: str) -> List[Object]:
+        # Every selectable object whose name contains name, in page order.
+        name = name.lower()
+        if not name:
+            return []
+        return [self.objects[self.positions[slot]] for slot in sorted(self.__substring(name))]
+
+    def __substring(self, name: str) -> Set[int]:
+        if len(name) <= self.NGRAM:
+            return set(self.ngrams.get(name, set()))
+
+        candidates: Optional[Set[int]] = None
+        for start in range(len(name) - self.NGRAM + 1):
+            slots = self.ngrams.get(name[start:(start + self.NGRAM)], set())
+            candidates = slots if candidates is None else (candidates & slots)
+            if not candidates:
+                return set()
+        return {c for c in (candidates or set()) if name in self.names[c]}
+
+
+class Placement:
+    def __init__(self, obj: Object, row: int, col: int, width: int, height: int) -> None:
+        self.obj = obj
+        self.row = row
+        self.col = col
+        self.width = width
+        self.height = height
+
+        # How much of the first row a placeholder that used to be here drew, which needs
+        # erasing before the real object is drawn over it.
+        self.stale = 0
+
+        # Whether it was scrolled into view onto blank rows, so that nothing it remembers
+        # drawing is still on screen.
+        self.exposed = False
+
+
+class PageLayout:
+    def __init__(self, objects: List[Object], columns: int) -> None:
+        self.objects = objects
+        self.columns = columns
+        self.cols = 2 if columns == 80 else 3
+        self.width = columns // self.cols
+        self.placements: List[Placement] = []
+        self.byObject: Dict[int, Placement] = {}
+
+        # Rows are relative to the top of the page, objects are laid out lazily as
+        # the visible window reaches them.
+        self.__next = 0
+        self.__curCol = self.cols - 1
+        self.__curRow = -1
+        self.__maxHeight = 1
+
+    @property
+    def complete(self) -> bool:
+        return self.__next >= len(self.objects)
+
+    def extend(self, terminal: Terminal, row: int) -> None:
+        # Lay out objects until we've placed at least one that starts below row.
+        while not self.complete and (
+            not self.placements or self.placements[-1].row <= row
+        ):
+            self.__place(terminal)
+
+    def find(self, terminal: Terminal, obj: Object) -> Optional[Placement]:
+        while id(obj) not in self.byObject and not self.complete:
+            self.__place(terminal)
+        return self.byObject.get(id(obj))
+
+    def bandStarts(self, terminal: Terminal, start: int, end: int) -> List[int]:
+        # Every row between start and end (inclusive) that a row of objects begins on.
+        self.extend(terminal, end)
+        starts: List[int] = []
+        for placement in self.placements:
+            if start <= placement.row <= end and (not starts or starts[-1] != placement.row):
+                starts.append(placement.row)
+        return starts
+
+    def __place(self, terminal: Terminal) -> None:
+        obj = self.objects[self.__next]
+        self.__next += 1
+
+        # Calculate width/height of this object.
+        actualWidth = self.columns if obj.full else self.width
+
+        # Calculate position for this object.
+        self.__curCol += 1
+        if self.__curCol >= self.cols or (self.__curCol != 0 and obj.full):
+            self.__curCol = 0
+            self.__curRow += self.__maxHeight
+            self.__maxHeight = 0
+
+        height = obj.calculate(terminal, actualWidth)
+        self.__maxHeight = max(height, self.__maxHeight)
+
+        placement = Placement(
+            obj, self.__curRow, (self.width * self.__curCol) + 1, actualWidth, height
+        )
+        self.placements.append(placement)
+        self.byObject[id(obj)] = placement
+
+        # Move to the end of the column if this was a full width object.
+        if obj.full:
+            self.__curCol = self.cols - 1
+
+
+class PreparedPage:
+    # A page drawn offscreen ahead of being shown, along with the layout and tab outline
+    # that go with it.
+    def __init__(
+        self, page: int, screen: EmulatedTerminal, tabGap: Optional[Tuple[int, int]]
+    ) -> None:
+        self.page = page
+        self.screen = screen
+        self.layout: Optional[PageLayout] = None
+        self.tabGap = tabGap
 
 
 class Renderer:
+    # First screen row that page contents are drawn on, below the header and tabs.
+    PAGE_TOP = 5
+
+    # How long before rotating to the next page in kiosk mode we start polling its
+    # entities at the visible rate and draw it offscreen.
+    ROTATE_LEAD = 5.0
+
+    # A budget that never runs out, for terminals that aren't held back by a line rate.
+    UNLIMITED = sys.maxsize
+
     def __init__(
         self,
         name: str,
@@ -319,11 +881,49 @@ class Renderer:
         show_help_tab: bool,
         api: HomeAssistant,
         terminal: Terminal,
+        capabilities: Optional[Capabilities] = None,
+        scheduler: Optional[PollScheduler] = None,
+        fetcher: Optional[BackgroundFetch] = None,
+        cache: Optional[RenderCache] = None,
+        rotate: float = 0.0,
+        budget: Optional[int] = None,
     ) -> None:
         self.name = name
         self.api = api
-        self.terminal = terminal
-        self.entities = api.getEntities() or []
+        self.capabilities = capabilities or getProfile("vt100")
+        self.renderCache = cache if cache is not None else RenderCache()
+        self.scheduler = scheduler or PollScheduler()
+        self.requested: Optional[List[str]] = None
+        self.relayout = False
+
+        # Kiosk mode rotates through the pages whenever nobody has touched the keyboard
+        # for this many seconds. We keep a copy of what's on screen so that each rotation
+        # only sends what differs from the page before it.
+        self.rotate = rotate
+        self.terminal: Terminal = ShadowTerminal(terminal) if rotate > 0 else terminal
+        self.lastInput = self.scheduler.clock()
+        self.lastRotate = self.lastInput
+        self.upcoming: Optional[PreparedPage] = None
+        self.__showing: Optional[PreparedPage] = None
+
+        # How many bytes a single frame may send before we stop drawing and leave the
+        # rest for later, so that anything typed gets echoed without waiting behind a
+        # full repaint. A page repaint that gets cut short picks up from the object it
+        # got to on the next frame. Drawing always stops for typed keys, whatever the
+        # budget, unless there isn't one at all.
+        self.budget = budget
+        self.__frameStart = 0
+        self.__unbudgeted = False
+        self.__repaintAt: Optional[int] = None
+        self.__clearedUntil = self.PAGE_TOP
+
+        # We don't wait on Home Assistant before drawing anything. Entities start out as
+        # placeholders and get filled in as they arrive, possibly from a fetch that our
+        # caller already started while it was waiting on the terminal.
+        self.entities: List[Entity] = []
+        self.fetcher = fetcher or BackgroundFetch(api)
+        # Switching things doesn't wait on Home Assistant either.
+        self.calls = ServiceCalls(api)
         self.help_enabled = show_help_tab
         self.lastWidth = 0
         self.lastHeight = 0
@@ -331,50 +931,376 @@ class Renderer:
         # Move cursor to where we expect it for input.
         self.terminal.moveCursor(self.terminal.rows, 1)
         self.lastError = ""
+        self.offlineError = ""
+        self.stats: Optional[Stats] = None
+        self.statsText = ""
+        self.__statsWidest = 0
+        self.tabGap: Optional[Tuple[int, int]] = None
         self.input = ""
         self.cursorPos = 1
 
+        # Keys typed after a command that our caller has to act on, held back until it has.
+        self.__typeahead: List[bytes] = []
+
         # Set up tabs.
         self.pages = pages[:]
         self.currentPage = 0
+        self.scrolls: List[int] = [0] * len(self.pages)
+        self.layout: Optional[PageLayout] = None
 
         # Set up tracking entities for each type of home assistant entity.
         self.objects: List[List[Object]] = []
         keyed_entities: Dict[str, Entity] = {e.entity_id: e for e in self.entities}
 
         for page in pages:
-            objlist: List[Object] = []
-            for entity in page.entities:
-                if entity.entity_id == "<hr>":
-                    objlist.append(HorizontalRuleObject())
-                elif entity.entity_id == "<label>":
-                    objlist.append(LabelObject(entity.name or ""))
-                elif entity.entity_id == "<template>":
-                    objlist.append(TemplateObject(entity.name or ""))
-                elif entity.entity_id in keyed_entities:
-                    backing_entity = keyed_entities[entity.entity_id]
-                    if isinstance(backing_entity, SwitchEntity):
-                        objlist.append(SwitchObject(backing_entity, overridden_name=entity.name))
-                    elif isinstance(backing_entity, SensorEntity):
-                        objlist.append(SensorObject(backing_entity, overridden_name=entity.name, overridden_units=entity.units))
-                    else:
-                        objlist.append(Object(backing_entity, overridden_name=entity.name))
+            self.objects.append(self.__buildObjects(page, keyed_entities))
+
+        if self.help_enabled:
+            self.pages.append(Page("Help", []))
+            self.objects.append([HelpObject(line) for line in HelpObject.LINES])
+            self.scrolls.append(0)
+
+        self.indexes: List[SelectionIndex] = [SelectionIndex(objs) for objs in self.objects]
+
+        # Everything is due right away, unless a fetch for it is already underway.
+        self.__schedule()
+        if fetcher is not None:
+            self.requested = [e for objs in self.objects for e in self.__entityIds(objs)]
 
-            for o in objlist:
-                if o.selectable:
-                    o.selected = True
+        # Sensor histories are seeded as the sensors arrive, then kept fed from polls.
+        self.histories: List[SensorObject] = []
+        self.__sensors: List[SensorObject] = [
+            o for objs in self.objects for o in objs if isinstance(o, SensorObject)
+        ]
+
+    def __buildObjects(self, page: Page, keyed_entities: Dict[str, Entity]) -> List[Object]:
+        objlist: List[Object] = []
+        for entity in page.entities:
+            if entity.entity_id == "<hr>":
+                objlist.append(HorizontalRuleObject(self.capabilities.lineDrawing))
+            elif entity.entity_id == "<label>":
+                objlist.append(LabelObject(entity.name or ""))
+            elif entity.entity_id == "<template>":
+                objlist.append(TemplateObject(entity.name or ""))
+            elif entity.entity_id in keyed_entities:
+                objlist.append(self.__buildObject(entity, keyed_entities[entity.entity_id]))
+            elif lookup(entity.entity_id) is None:
+                # There's no point waiting on something we wouldn't know how to show.
+                objlist.append(Object(Entity(self.api, entity.entity_id), overridden_name=entity.name))
+            else:
+                objlist.append(PendingObject(Entity(self.api, entity.entity_id), entity))
+
+        for o in objlist:
+            if o.selectable:
+                o.selected = True
+                break
+
+        return objlist
+
+    def __buildObject(self, entity: LayoutEntity, backing_entity: Entity) -> Object:
+        domain = lookup(backing_entity.entity_id)
+        build = builderFor(backing_entity)
+        if domain is None or build is None or not isinstance(backing_entity, domain.entity):
+            return Object(backing_entity, overridden_name=entity.name)
+
+        obj: Object = build(
+            backing_entity, entity, self.capabilities, self.renderCache, self.scheduler.clock
+        )
+        return obj
+
+    @property
+    def busy(self) -> bool:
+        # Whether drawing was cut short and there is more of it waiting to go out.
+        return self.__repaintAt is not None or self.__showing is not None or self.__pageDirty()
+
+    @property
+    def loading(self) -> bool:
+        # Whether any entity in the layout is still waiting on Home Assistant.
+        return any(isinstance(o, PendingObject) for objs in self.objects for o in objs)
+
+    def __fillPending(self, arrived: List[Entity]) -> None:
+        # Swaps placeholders for the real thing, now that their entities showed up.
+        keyed_entities: Dict[str, Entity] = {e.entity_id: e for e in arrived}
+
+        def build(obj: Union[PendingObject, MissingObject]) -> Optional[Object]:
+            if obj.entity.entity_id not in keyed_entities:
+                return None
+            return self.__buildObject(obj.layout, keyed_entities[obj.entity.entity_id])
+
+        self.__replace(build)
+
+    def __markMissing(self, missing: Set[str]) -> None:
+        # Stops waiting on entities that Home Assistant says it doesn't have.
+        def build(obj: Union[PendingObject, MissingObject]) -> Optional[Object]:
+            if not isinstance(obj, PendingObject) or obj.entity.entity_id not in missing:
+                return None
+            logger.warning(f"Home Assistant doesn't have {obj.entity.entity_id}!")
+            return MissingObject(obj.entity, obj.layout)
+
+        self.__replace(build)
+
+    def __replace(self, build: Callable[[Union[PendingObject, MissingObject]], Optional[Object]]) -> None:
+        # Swaps in whatever build returns for each stand-in, redrawing it in place.
+        current = self.layout
+        filled: List[SensorObject] = []
+
+        for page, objs in enumerate(self.objects):
+            changed = False
+            for position, obj in enumerate(objs):
+                if not isinstance(obj, (PendingObject, MissingObject)):
+                    continue
+                real = build(obj)
+                if real is None:
+                    continue
+
+                objs[position] = real
+                changed = True
+                if isinstance(real, SensorObject) and real.history is not None:
+                    filled.append(real)
+
+                if page != self.currentPage or current is None:
+                    continue
+                placement = current.byObject.pop(id(obj), None)
+                if placement is None:
+                    continue
+
+                # Fill in where the placeholder was if it fits, otherwise lay the page out
+                # again around it.
+                if real.calculate(self.terminal, placement.width) != placement.height:
+                    self.relayout = True
+                placement.obj = real
+                placement.stale = obj.drawn
+                current.byObject[id(real)] = placement
+
+            if changed:
+                if self.upcoming is not None and self.upcoming.page == page:
+                    # What we drew offscreen has placeholders in it, so start over.
+                    self.upcoming = None
+
+                # Placeholders are never selected, so select whatever now can be.
+                if not any(o.selected for o in objs):
+                    for o in objs:
+                        if o.selectable:
+                            o.selected = True
+                            break
+                self.indexes[page] = SelectionIndex(objs)
+
+        self.__trackHistories(self.objects)
+        self.__seedHistories(filled)
+
+    def __trackHistories(self, objects: List[List[Object]]) -> None:
+        self.__sensors = [o for objs in objects for o in objs if isinstance(o, SensorObject)]
+        self.histories = [o for o in self.__sensors if o.history is not None]
+
+    def __seedHistories(self, objects: List[SensorObject]) -> None:
+        if not objects:
+            return
+
+        seeds = self.api.getHistory(sorted({o.entity.entity_id for o in objects}))
+        for obj in objects:
+            obj.seed(seeds.get(obj.entity.entity_id, []))
+            obj.record()
+
+    def updateLayout(self, name: str, pages: List[Page], show_help_tab: bool) -> None:
+        # Swap in a reloaded layout, keeping the objects (and their selection and scroll
+        # state) for any page that didn't change so that only changed pages get rebuilt.
+        self.__continueShowing(False)
+        keyed_entities: Dict[str, Entity] = {e.entity_id: e for e in self.entities}
+        oldCount = len(self.pages) - (1 if self.help_enabled else 0)
+        available = list(range(oldCount))
+        currentName = self.pages[self.currentPage].name
+        currentObjects = self.objects[self.currentPage]
+
+        newPages: List[Page] = []
+        objects: List[List[Object]] = []
+        scrolls: List[int] = []
+        indexes: List[SelectionIndex] = []
+
+        for page in pages:
+            for old in available:
+                if self.pages[old] == page:
+                    available.remove(old)
+                    objects.append(self.objects[old])
+                    scrolls.append(self.scrolls[old])
+                    indexes.append(self.indexes[old])
                     break
+            else:
+                objs = self.__buildObjects(page, keyed_entities)
+                objects.append(objs)
+                scrolls.append(0)
+                indexes.append(SelectionIndex(objs))
+            newPages.append(page)
+
+        if show_help_tab:
+            newPages.append(Page("Help", []))
+            if self.help_enabled:
+                objects.append(self.objects[-1])
+                scrolls.append(self.scrolls[-1])
+                indexes.append(self.indexes[-1])
+            else:
+                objects.append([HelpObject(line) for line in HelpObject.LINES])
+                scrolls.append(0)
+                indexes.append(SelectionIndex(objects[-1]))
+
+        # Stay on the same tab if it still exists.
+        names = [p.name for p in newPages]
+        if currentName in names:
+            newCurrent = names.index(currentName)
+        else:
+            newCurrent = max(min(self.currentPage, len(newPages) - 1), 0)
 
-            self.objects.append(objlist)
+        tabsChanged = names != [p.name for p in self.pages] or newCurrent != self.currentPage
+        pageChanged = objects[newCurrent] is not currentObjects
+        nameChanged = name != self.name
 
-        if self.help_enabled:
-            self.pages.append(Page("Help", []))
-            self.objects.append([HelpObject()])
+        self.name = name
+        self.help_enabled = show_help_tab
+        self.pages = newPages
+        self.objects = objects
+        self.scrolls = scrolls
+        self.indexes = indexes
+        self.currentPage = newCurrent
+        self.upcoming = None
+        self.__schedule()
+
+        # Any sensor history that is new to this layout gets seeded just like at startup.
+        tracked = {id(o) for o in self.histories}
+        self.__trackHistories(self.objects)
+        self.__seedHistories([o for o in self.histories if id(o) not in tracked])
+
+        # Now, repaint only what actually changed on screen.
+        self.terminal.sendCommand(Terminal.SAVE_CURSOR)
+        if nameChanged:
+            self.terminal.moveCursor(1, 1)
+            self.terminal.sendCommand(Terminal.CLEAR_LINE)
+            self.terminal.sendCommand(Terminal.SET_NORMAL)
+            self.terminal.sendCommand(Terminal.SET_BOLD)
+            self.terminal.sendText(self.name)
+            self.terminal.sendCommand(Terminal.SET_NORMAL)
+        if tabsChanged:
+            # Blank out the old tabs without erasing the sides of the panel around them.
+            self.terminal.moveCursor(3, 2)
+            self.terminal.sendCommand(Terminal.SET_NORMAL)
+            self.terminal.sendText(" " * (self.terminal.columns - 2))
+        if tabsChanged or pageChanged:
+            self.__renderTabs(pageChanged)
+        self.terminal.sendCommand(Terminal.RESTORE_CURSOR)
+
+    @property
+    def suppressedRedraws(self) -> int:
+        # How many sensor state changes were too small or too soon to be worth drawing.
+        return sum(o.suppressed for objs in self.objects for o in objs if isinstance(o, SensorObject))
+
+    def __entityIds(self, objs: List[Object]) -> List[str]:
+        return [
+            o.entity.entity_id
+            for o in objs
+            if isinstance(o, (SwitchObject, SensorObject, PendingObject, MissingObject))
+        ]
+
+    def __schedule(self) -> None:
+        # Let the poll scheduler know what's displayed anywhere, and what's on screen.
+        self.scheduler.track(e for objs in self.objects for e in self.__entityIds(objs))
+        self.scheduler.setVisible(self.__entityIds(self.objects[self.currentPage]))
+
+    def __switchPage(self, page: int) -> None:
+        self.currentPage = page
+        self.upcoming = None
+        self.__showing = None
+
+        self.terminal.sendCommand(Terminal.SAVE_CURSOR)
+        self.__renderTabs()
+        self.terminal.sendCommand(Terminal.RESTORE_CURSOR)
+
+        # Whatever just came into view may be stale, so go get it now.
+        self.scheduler.setVisible(self.__entityIds(self.objects[page]))
+        self.refresh()
 
     def refresh(self) -> None:
-        self.api.refreshEntities(self.entities)
+        # Fetch in the background so that a slow or unreachable Home Assistant never
+        # holds up input handling. Results are merged the next time we draw. Only the
+        # entities that the scheduler says are due get fetched.
+        if self.fetcher.running or self.requested is not None:
+            return
+
+        due = self.scheduler.due()
+        if due:
+            self.requested = due
+            self.fetcher.start(due)
+
+    def __collect(self) -> None:
+        done, new_states = self.fetcher.collect()
+        if done:
+            requested = self.requested or []
+            self.requested = None
+
+            if new_states is None:
+                self.scheduler.defer(requested)
+            else:
+                self.__renamed(self.api.mergeEntities(self.entities, new_states))
+
+                # Anything we haven't seen before may be something a placeholder is
+                # waiting on.
+                known = {e.entity_id for e in self.entities}
+                arrived = [e for e in new_states if e.entity_id not in known]
+                if arrived:
+                    self.entities.extend(arrived)
+                    self.__fillPending(arrived)
+
+                returned = [e.entity_id for e in new_states]
+                fetched = set(returned)
+                for obj in self.histories:
+                    if obj.entity.entity_id in fetched:
+                        obj.record()
+                for obj in self.__sensors:
+                    if obj.entity.entity_id in self.api.lastChanged:
+                        obj.polled()
+                if self.stats:
+                    self.stats.poll(
+                        self.api.lastLatency, len(self.api.lastChanged), self.suppressedRedraws
+                    )
+
+                # Anything we asked for but didn't get back doesn't exist right now, as long
+                # as wherever it lives answered. Placeholders for those stop waiting.
+                unanswered = set(requested) - fetched
+                missing = {e for e in unanswered if self.api.answered(e)}
+                self.scheduler.polled(
+                    returned, self.api.lastChanged | {e.entity_id for e in arrived}
+                )
+                self.scheduler.missing(missing)
+                self.scheduler.defer(unanswered - missing)
+                if missing:
+                    self.__markMissing(missing)
+
+        self.__switched()
+
+        offline = self.api.offlineSince
+        if offline is not None:
+            error = f"Home Assistant offline since {time.strftime('%H:%M', time.localtime(offline))}"
+        else:
+            error = ""
+
+        if error != self.offlineError:
+            # Don't stomp on an error the user is currently looking at.
+            if self.lastError in {"", self.offlineError}:
+                self.displayError(error)
+            self.offlineError = error
+
+    def __renamed(self, entities: List[Entity]) -> None:
+        # Only pages showing a renamed entity need their name index rebuilt.
+        if not entities:
+            return
+
+        renamed = {id(e) for e in entities}
+        for objs, index in zip(self.objects, self.indexes):
+            if any(id(o.entity) in renamed for o in objs if o.selectable):
+                index.rebuild()
 
     def draw(self) -> None:
+        self.__collect()
+        if isinstance(self.terminal, TerminalWrapper):
+            self.__frameStart = self.terminal.bytesOut
+
         redraw = False
         if (
             self.lastWidth != self.terminal.columns
@@ -384,8 +1310,15 @@ class Renderer:
             self.lastHeight = self.terminal.rows
             redraw = True
 
+        # Kiosk mode may be about to replace this page, in which case don't bother
+        # updating it first.
+        rotating = None if redraw else self.__rotation()
+
         # If we need to redraw the whole screen.
         if redraw:
+            self.upcoming = None
+            self.__showing = None
+
             # If we have input, we need to remember the cursor position.
             self.terminal.sendCommand(Terminal.SAVE_CURSOR)
 
@@ -412,50 +1345,320 @@ class Renderer:
             self.terminal.sendText(self.name)
             self.terminal.sendCommand(Terminal.SET_NORMAL)
 
-            self.terminal.moveCursor(2, 1)
-            self.terminal.sendText("\u2500" * self.terminal.columns)
-            self.terminal.moveCursor(4, 1)
-            self.terminal.sendText("\u2500" * self.terminal.columns)
+            # The tabs sit in a panel spanning the width of the screen, with an outline
+            # opened up underneath whichever tab is current.
+            drawBox(self.terminal, 2, 1, self.terminal.columns, 3, self.capabilities.lineDrawing)
+            self.tabGap = None
 
             self.__renderTabs()
+            self.__renderStats(True)
 
             # Move cursor to input that we previously typed.
             self.terminal.sendCommand(Terminal.RESTORE_CURSOR)
-        else:
-            # If we have input, we need to remember the cursor position.
+        elif self.__showing is not None:
+            # Still partway through rotating to this page, so carry on from where we got
+            # to. Anything that needs laying out again waits until it's all on screen.
+            self.__continueShowing()
+            return
+        elif self.relayout:
+            # Something arrived that didn't fit where its placeholder was.
+            self.terminal.sendCommand(Terminal.SAVE_CURSOR)
+            self.layout = None
+            self.__followSelection(False)
+            self.__renderPage(True)
+            self.__renderStats(False)
+            self.terminal.sendCommand(Terminal.RESTORE_CURSOR)
+        elif rotating is None and (self.__pageDirty() or (self.stats is not None and self.stats.due)):
+            # If we have input, we need to remember the cursor position. If nothing on
+            # screen changed, don't send anything at all.
             self.terminal.sendCommand(Terminal.SAVE_CURSOR)
             self.__renderPage(False)
+            self.__renderStats(False)
+            self.terminal.sendCommand(Terminal.RESTORE_CURSOR)
+        self.relayout = False
+
+        if rotating is not None:
+            self.lastRotate = self.scheduler.clock()
+            self.__showPrepared(rotating, self.upcoming)
+
+    def __rotation(self) -> Optional[int]:
+        # Works out whether it's time to move on to the next page in kiosk mode, the same
+        # way as pressing > but wrapping around and skipping help. Waits for anything half
+        # typed to be finished, and for the keyboard to be left alone for a whole interval.
+        count = len(self.pages) - (1 if self.help_enabled else 0)
+        if self.rotate <= 0 or count < 2 or self.input or self.__showing is not None:
+            return None
+
+        now = self.scheduler.clock()
+        due = max(self.lastInput, self.lastRotate) + self.rotate
+        if now < due - min(self.ROTATE_LEAD, self.rotate / 2.0):
+            return None
+
+        page = (self.currentPage + 1) % count if self.currentPage < count else 0
+        if self.upcoming is None or self.upcoming.page != page:
+            # Get the next page's values up to date before it's shown, and draw it
+            # offscreen so that only changed values need to be drawn again later.
+            self.scheduler.setVisible(
+                self.__entityIds(self.objects[self.currentPage]) + self.__entityIds(self.objects[page])
+            )
+            self.upcoming = self.__prepare(page)
+
+        return page if now >= due else None
+
+    @contextmanager
+    def __offscreen(self, prepared: PreparedPage) -> Iterator[None]:
+        # Draws onto a prepared page instead of the screen, as if it were the current page.
+        # Nothing drawn offscreen goes out over the wire, so it isn't held to the budget.
+        saved = (self.terminal, self.currentPage, self.layout, self.tabGap)
+        repaint = (self.__repaintAt, self.__clearedUntil)
+        self.terminal = prepared.screen
+        self.currentPage = prepared.page
+        self.layout = prepared.layout
+        self.tabGap = prepared.tabGap
+        self.__unbudgeted = True
+        try:
+            yield
+        finally:
+            prepared.layout = self.layout
+            prepared.tabGap = self.tabGap
+            self.terminal, self.currentPage, self.layout, self.tabGap = saved
+            self.__repaintAt, self.__clearedUntil = repaint
+            self.__unbudgeted = False
+
+    def __prepare(self, page: int) -> Optional[PreparedPage]:
+        if not isinstance(self.terminal, ShadowTerminal):
+            return None
+
+        prepared = PreparedPage(page, self.terminal.copy(), self.tabGap)
+        with self.__offscreen(prepared):
+            self.__renderTabs()
+        return prepared
+
+    def __showPrepared(self, page: int, prepared: Optional[PreparedPage]) -> None:
+        shadow = self.terminal
+        if (
+            prepared is None
+            or not isinstance(shadow, ShadowTerminal)
+            or (prepared.screen.rows, prepared.screen.columns) != (shadow.rows, shadow.columns)
+            or (shadow.screen.rows, shadow.screen.columns) != (shadow.rows, shadow.columns)
+        ):
+            # Not something we can diff against, so draw it the usual way.
+            self.__switchPage(page)
+            return
+
+        self.currentPage = page
+        self.layout = prepared.layout
+        self.tabGap = prepared.tabGap
+        self.upcoming = None
+        self.__repaintAt = None
+        self.__showing = prepared
+        self.scheduler.setVisible(self.__entityIds(self.objects[page]))
+        self.refresh()
+        self.__continueShowing()
+
+    def __continueShowing(self, preemptible: bool = True) -> None:
+        prepared = self.__showing
+        shadow = self.terminal
+        if prepared is None or not isinstance(shadow, ShadowTerminal):
+            return
+
+        # Bring anything that changed since it was drawn up to date, then send only what
+        # differs from what's on screen now.
+        with self.__offscreen(prepared):
+            if self.__pageDirty():
+                self.__renderPage(False)
+        self.layout = prepared.layout
+        self.tabGap = prepared.tabGap
+
+        shadow.sendCommand(Terminal.SAVE_CURSOR)
+        if sendDifferences(
+            shadow,
+            shadow.copy(),
+            prepared.screen,
+            range(3, self.__pageBottom + 1),
+            self.capabilities.lineDrawing,
+            self.__preempted if preemptible else None,
+        ):
+            self.__showing = None
+        shadow.sendCommand(Terminal.RESTORE_CURSOR)
+
+    def showStats(self, stats: Optional[Stats]) -> None:
+        # Turns the performance overlay on or off, erasing it when turning it off.
+        if stats is None and self.__statsWidest:
+            self.terminal.sendCommand(Terminal.SAVE_CURSOR)
+            self.terminal.moveCursor(1, self.terminal.columns - self.__statsWidest)
+            self.terminal.sendText(" " * self.__statsWidest)
             self.terminal.sendCommand(Terminal.RESTORE_CURSOR)
 
-    def __renderTabs(self) -> None:
-        self.terminal.moveCursor(3, 1)
+        self.stats = stats
+        self.statsText = ""
+        self.__statsWidest = 0
+
+    def __renderStats(self, redraw: bool) -> None:
+        if self.stats is None or not (redraw or self.stats.due):
+            return
+        if not redraw and self.__preempted():
+            # It's still due, so it goes out next frame instead.
+            return
+
+        # Right-justified on the title row, leaving the last column alone so we never
+        # wrap. Keep it so that the cursor move plus the text fits in the overlay budget,
+        # and never cover up the dashboard name.
+        room = min(
+            Stats.BUDGET - len(f"\x1b[1;{self.terminal.columns}H"),
+            self.terminal.columns - len(self.name) - 3,
+        )
+        text = self.stats.summary(room)
+        if redraw:
+            self.statsText = ""
+            self.__statsWidest = 0
+        if text == self.statsText:
+            return
+
+        # Pad out to whatever could be there before so stale characters get erased. Like
+        # sensor values, an unsent copy may be thrown away without ever being drawn.
+        if not redraw and not queued(self.terminal, "stats"):
+            self.__statsWidest = len(self.statsText)
+        width = max(len(text), self.__statsWidest)
+        if width > 0:
+            self.terminal.moveCursor(1, self.terminal.columns - width)
+            with region(self.terminal, "stats"):
+                self.terminal.sendText(text.rjust(width))
+        self.statsText = text
+        self.__statsWidest = width
+
+    def __renderTabs(self, page: bool = True) -> None:
+        self.terminal.moveCursor(3, 2)
 
         # First, render the tab heading.
         spaced = False
-        for index, page in enumerate(self.pages):
+        col = 2
+        gap: Optional[Tuple[int, int]] = None
+        for index, tab in enumerate(self.pages):
             self.terminal.sendCommand(Terminal.SET_NORMAL)
 
             if spaced:
                 self.terminal.sendText(" ")
+                col += 1
             spaced = True
 
             self.terminal.sendCommand(Terminal.SET_REVERSE)
             if index == self.currentPage:
                 self.terminal.sendCommand(Terminal.SET_BOLD)
 
-            self.terminal.sendText(f" {page.name} ")
+            label = f" {tab.name} "
+            if index == self.currentPage:
+                gap = (col, col + len(label) - 1)
+            self.terminal.sendText(label)
+            col += len(label)
+
+        self.terminal.sendCommand(Terminal.SET_NORMAL)
+        self.__renderTabOutline(gap)
 
-        # Now, render the entries themselves, treating them all as dirty.
+        if not page:
+            return
+
+        # Now, render the entries themselves, treating them all as dirty. Start from a fresh
+        # layout since object sizes may have changed since we last laid this page out.
+        self.layout = None
+        self.__followSelection(False)
         self.__renderPage(True)
 
+    def __renderTabOutline(self, gap: Optional[Tuple[int, int]]) -> None:
+        # Opens the bottom of the tab panel under the current tab, only touching the cells
+        # around the previous and new current tab instead of redrawing the whole edge.
+        columns = self.terminal.columns
+        if gap is not None and gap[1] >= columns:
+            # Tabs ran off the edge of the panel, so don't bother with an outline.
+            gap = None
+        if gap == self.tabGap:
+            return
+
+        lineDrawing = self.capabilities.lineDrawing
+        if self.tabGap is not None:
+            start, end = self.tabGap[0] - 1, self.tabGap[1] + 1
+            edge = "".join(
+                BOTTOM_LEFT if c == 1 else (BOTTOM_RIGHT if c == columns else HORIZONTAL)
+                for c in range(start, end + 1)
+            )
+            self.terminal.moveCursor(4, start)
+            sendLines(self.terminal, edge, lineDrawing)
+
+        if gap is not None:
+            start, end = gap[0] - 1, gap[1] + 1
+            left = VERTICAL if start == 1 else BOTTOM_RIGHT
+            right = VERTICAL if end == columns else BOTTOM_LEFT
+            self.terminal.moveCursor(4, start)
+            sendLines(self.terminal, left + " " * (end - start - 1) + right, lineDrawing)
+
+        self.tabGap = gap
+
+    @property
+    def __pageBottom(self) -> int:
+        # Last screen row that page contents can be drawn on, above the error and input rows.
+        return self.terminal.rows - 3
+
+    @property
+    def __pageHeight(self) -> int:
+        return max(self.__pageBottom - self.PAGE_TOP + 1, 1)
+
+    def __getLayout(self) -> PageLayout:
+        if self.layout is None or self.layout.columns != self.terminal.columns:
+            self.layout = PageLayout(self.objects[self.currentPage], self.terminal.columns)
+        return self.layout
+
+    def __visible(self, placement: Placement, scroll: int) -> bool:
+        return placement.row >= scroll and (placement.row + placement.height) <= (
+            scroll + self.__pageHeight
+        )
+
+    def __preempted(self, started: bool = True) -> bool:
+        # Whether to stop drawing and leave the rest for the next frame, either because
+        # somebody is typing or because this frame has sent as much as it should before
+        # giving them a chance to. With a writer thread that's whatever it still has
+        # queued, otherwise it's what we've sent since the frame started. A repaint that
+        # hasn't started on anything yet this frame only stops for typed keys, so that
+        # updates elsewhere using up the budget can't hold it up forever.
+        if self.budget is None or self.__unbudgeted:
+            return False
+        if self.terminal.peekInput() is not None:
+            return True
+        if not started:
+            return False
+        writer = writerOf(self.terminal)
+        if writer is not None:
+            return writer.backlog >= self.budget
+        if isinstance(self.terminal, TerminalWrapper):
+            return (self.terminal.bytesOut - self.__frameStart) >= self.budget
+        return False
+
+    def __pageDirty(self) -> bool:
+        if self.__repaintAt is not None:
+            # Still partway through repainting the page.
+            return True
+
+        layout = self.__getLayout()
+        scroll = self.scrolls[self.currentPage]
+        height = self.__pageHeight
+        layout.extend(self.terminal, scroll + height - 1)
+
+        for placement in layout.placements:
+            if placement.row >= scroll + height:
+                break
+            if self.__visible(placement, scroll) and getattr(placement.obj, "dirty", True):
+                return True
+        return False
+
     def __renderPage(self, allDirty: bool) -> None:
-        cols = 2 if self.terminal.columns == 80 else 3
-        curCol = cols - 1
-        curRow = 4
-        maxDrawnRow = 4
+        layout = self.__getLayout()
+        scroll = self.scrolls[self.currentPage]
+        height = self.__pageHeight
 
-        maxHeight = 1
-        width = self.terminal.columns // cols
+        # Only lay out and render what fits in the visible window.
+        layout.extend(self.terminal, scroll + height - 1)
+        if allDirty:
+            self.__repaintAt = 0
+            self.__clearedUntil = self.PAGE_TOP
 
         self.terminal.sendCommand(Terminal.SET_NORMAL)
 
@@ -464,84 +1667,229 @@ class Renderer:
         # the rest of the objecs after it as if everything was dirty. However, I haven't run into
         # this bug so I'm leaving it broken.
 
-        for obj in self.objects[self.currentPage]:
-            # Calculate width/height of this object.
-            actualWidth = self.terminal.columns if obj.full else width
-
-            # Calculate position for this object.
-            curCol += 1
-            if curCol >= cols:
-                curCol = 0
-                curRow += maxHeight
-                maxHeight = 0
-                if allDirty:
-                    # TODO: Technically this is somewhat broken, because we need to clear ALL
-                    # of the lines that the tallest component in any column occupies, but we
-                    # don't currently run into this bug so I'm leaving it as future work.
-                    for clearRow in range(
-                        curRow, curRow + obj.calculate(self.terminal, actualWidth)
-                    ):
-                        self.terminal.moveCursor(clearRow, 1)
-                        self.terminal.sendCommand(Terminal.CLEAR_LINE)
-
-            if curCol != 0 and obj.full:
-                curCol = 0
-                curRow += maxHeight
-                maxHeight = 0
-                if allDirty:
-                    for clearRow in range(
-                        curRow, curRow + obj.calculate(self.terminal, actualWidth)
-                    ):
-                        self.terminal.moveCursor(clearRow, 1)
-                        self.terminal.sendCommand(Terminal.CLEAR_LINE)
-
-            # Calculate location of this object.
-            row = curRow
-            col = (width * curCol) + 1
-
-            maxHeight = max(obj.calculate(self.terminal, actualWidth), maxHeight)
-            if allDirty or obj.dirty:
-                self.terminal.moveCursor(row, col)
-                obj.render(self.terminal, actualWidth)
+        repaintAt = self.__repaintAt
+        progressed = False
+        for index, placement in enumerate(layout.placements):
+            if placement.row >= scroll + height:
+                break
+            if not self.__visible(placement, scroll):
+                continue
+
+            obj = placement.obj
+            row = self.PAGE_TOP + (placement.row - scroll)
+            repainting = repaintAt is not None and index >= repaintAt
+            if not repainting and not obj.dirty:
+                continue
+
+            if self.__preempted(progressed or not repainting):
+                # Leave the rest for the next frame so that input gets a look in first.
+                if repainting:
+                    self.__repaintAt = index
+                return
+
+            if repainting:
+                # Clear every line this object occupies that hasn't been cleared yet.
+                for clearRow in range(max(self.__clearedUntil, row), row + placement.height):
+                    self.terminal.moveCursor(clearRow, 1)
+                    self.terminal.sendCommand(Terminal.CLEAR_LINE)
+                self.__clearedUntil = max(self.__clearedUntil, row + placement.height)
+
+                self.terminal.moveCursor(row, placement.col)
+                obj.render(self.terminal, placement.width)
+                obj.dirty = False
+                placement.stale = 0
+                placement.exposed = False
+                progressed = True
+            else:
+                if placement.stale:
+                    self.terminal.moveCursor(row, placement.col)
+                    self.terminal.sendText(" " * placement.stale)
+                    placement.stale = 0
+                self.terminal.moveCursor(row, placement.col)
+                if placement.exposed:
+                    obj.render(self.terminal, placement.width)
+                    placement.exposed = False
+                else:
+                    obj.update(self.terminal, placement.width)
                 obj.dirty = False
 
-                maxDrawnRow = max(maxDrawnRow, curRow + (maxHeight - 1))
-
-            # Move to the end of the column if this was a full width object.
-            if obj.full:
-                curCol = cols - 1
-
-        if allDirty:
+        if repaintAt is not None:
             # Need to wipe each row.
-            for row in range(maxDrawnRow + 1, self.terminal.rows - 2):
+            for row in range(self.__clearedUntil, self.__pageBottom + 1):
+                if self.__preempted(progressed):
+                    # Every visible object is drawn, so only the wiping is left.
+                    self.__repaintAt = len(layout.placements)
+                    self.__clearedUntil = row
+                    return
                 self.terminal.moveCursor(row, 1)
                 self.terminal.sendCommand(Terminal.CLEAR_LINE)
+                progressed = True
+            self.__repaintAt = None
 
-    def __selection(self) -> Tuple[Optional[int], Optional[int], Optional[int]]:
-        prevobj = -1
-        curobj = -1
-        nextobj = -1
-
-        lastSeen = -1
-        for index, obj in enumerate(self.objects[self.currentPage]):
-            if obj.selectable:
-                if obj.selected:
-                    # This is the currently selected object!
-                    curobj = index
-                    prevobj = lastSeen
-                else:
-                    if curobj == -1:
-                        # If we haven't found the selected item, this could be the item before it.
-                        lastSeen = index
-                    elif nextobj == -1:
-                        # If we have found the selected item, the next item is the one we tab to next.
-                        nextobj = index
+    def __followSelection(self, output: bool = True) -> None:
+        # Scroll the current page so that the selected object is entirely visible.
+        curobj = self.indexes[self.currentPage].selected
+        if curobj is None:
+            return
 
-        return (
-            None if prevobj == -1 else prevobj,
-            None if curobj == -1 else curobj,
-            None if nextobj == -1 else nextobj,
-        )
+        layout = self.__getLayout()
+        placement = layout.find(self.terminal, self.objects[self.currentPage][curobj])
+        if placement is None:
+            return
+
+        scroll = self.scrolls[self.currentPage]
+        height = self.__pageHeight
+        if placement.row < scroll or placement.height >= height:
+            newScroll = placement.row
+        elif (placement.row + placement.height) > (scroll + height):
+            # Scroll down by as few rows of objects as we can get away with.
+            newScroll = placement.row
+            for start in layout.bandStarts(self.terminal, scroll, placement.row):
+                if (placement.row + placement.height) <= (start + height):
+                    newScroll = start
+                    break
+        else:
+            return
+
+        if output:
+            self.__scrollTo(newScroll)
+        else:
+            self.scrolls[self.currentPage] = newScroll
+
+    def __scrollBands(self, delta: int) -> None:
+        # Scroll the current page by whole rows of objects, for pages without a selection.
+        layout = self.__getLayout()
+        scroll = self.scrolls[self.currentPage]
+
+        if delta > 0:
+            layout.extend(self.terminal, scroll + self.__pageHeight)
+            starts = sorted({p.row for p in layout.placements if p.row > scroll})
+            if not starts:
+                return
+
+            # Don't scroll past the point where the last object is already in view.
+            last = layout.placements[-1]
+            if layout.complete and self.__visible(last, scroll):
+                return
+            newScroll = starts[min(delta, len(starts)) - 1]
+        else:
+            starts = sorted(
+                {p.row for p in layout.placements if p.row < scroll}, reverse=True
+            )
+            if not starts:
+                return
+            newScroll = starts[min(-delta, len(starts)) - 1]
+
+        self.__scrollTo(newScroll)
+
+    def __scrollTo(self, newScroll: int) -> None:
+        layout = self.__getLayout()
+        scroll = self.scrolls[self.currentPage]
+        delta = newScroll - scroll
+        if delta == 0:
+            return
+
+        self.scrolls[self.currentPage] = newScroll
+        height = self.__pageHeight
+        if abs(delta) >= height or not self.capabilities.scrollRegion or self.__repaintAt is not None:
+            # Nothing on screen survives the move, or what's there is only partly
+            # painted, so just repaint the page.
+            self.terminal.sendCommand(Terminal.SAVE_CURSOR)
+            self.__renderPage(True)
+            self.terminal.sendCommand(Terminal.RESTORE_CURSOR)
+            return
+
+        # Let the terminal move what's already on screen, so that moving by a row costs
+        # only the newly exposed content instead of a full repaint.
+        self.terminal.sendCommand(Terminal.SAVE_CURSOR)
+        self.terminal.sendCommand(f"[{self.PAGE_TOP};{self.__pageBottom}r".encode("ascii"))
+        if delta > 0:
+            self.terminal.moveCursor(self.__pageBottom, 1)
+            for _ in range(delta):
+                self.terminal.sendCommand(b"D")
+        else:
+            self.terminal.moveCursor(self.PAGE_TOP, 1)
+            for _ in range(-delta):
+                self.terminal.sendCommand(b"M")
+        self.terminal.sendCommand(b"[r")
+
+        layout.extend(self.terminal, newScroll + height - 1)
+        for placement in layout.placements:
+            if placement.row >= newScroll + height:
+                break
+
+            wasVisible = self.__visible(placement, scroll)
+            if self.__visible(placement, newScroll):
+                if not wasVisible:
+                    # Newly scrolled into view, paint all of it on the next draw.
+                    placement.obj.dirty = True
+                    placement.exposed = True
+            elif wasVisible and placement.row >= newScroll:
+                # Pushed partially off the bottom, blank what's left of it.
+                for row in range(
+                    self.PAGE_TOP + (placement.row - newScroll), self.__pageBottom + 1
+                ):
+                    self.terminal.moveCursor(row, 1)
+                    self.terminal.sendCommand(Terminal.CLEAR_LINE)
+            elif wasVisible and newScroll < placement.row + placement.height:
+                # Pushed partially off the top, blank what's left of it.
+                for row in range(
+                    self.PAGE_TOP,
+                    min(self.PAGE_TOP + (placement.row + placement.height - newScroll), self.__pageBottom + 1),
+                ):
+                    self.terminal.moveCursor(row, 1)
+                    self.terminal.sendCommand(Terminal.CLEAR_LINE)
+        self.terminal.sendCommand(Terminal.RESTORE_CURSOR)
+
+    def __switchGroup(self, name: str) -> Optional[List[SwitchEntity]]:
+        # Resolves "all" or a configured group name into the switches it covers.
+        if name.lower() == "all":
+            return [
+                o.entity
+                for o in self.objects[self.currentPage]
+                if o.selectable and isinstance(o.entity, SwitchEntity)
+            ]
+
+        groups = {k.lower(): v for k, v in self.pages[self.currentPage].groups.items()}
+        if name.lower() not in groups:
+            return None
+
+        keyed_entities: Dict[str, Entity] = {e.entity_id: e for e in self.entities}
+        return [
+            e
+            for e in (keyed_entities.get(i) for i in groups[name.lower()])
+            if isinstance(e, SwitchEntity)
+        ]
+
+    def __bulkSwitch(self, service: str, entities: List[SwitchEntity]) -> None:
+        # One service call per domain, carrying every entity, instead of one per switch.
+        # Domains name their services differently, and some can't toggle, in which case
+        # each one is asked for the opposite of whatever state it's in. The calls happen
+        # in the background and whatever they change shows up on a later frame.
+        byService: Dict[Tuple[str, str], List[str]] = {}
+        for entity in entities:
+            known = lookup(entity.entity_id)
+            action = service if known is None else known.service(service, entity.state)
+            byService.setdefault((domainOf(entity.entity_id), action), []).append(entity.entity_id)
+
+        for (domain, action), ids in byService.items():
+            self.calls.call(domain, action, ids)
+
+    def __switch(self, entity: SwitchEntity) -> None:
+        # Flips a single switch to the opposite of what's on screen.
+        self.__bulkSwitch("turn_off" if entity.state else "turn_on", [entity])
+
+    def __switched(self) -> None:
+        # Applies the resulting states straight from each service call's response.
+        failed = False
+        for changed in self.calls.collect():
+            if changed is None:
+                failed = True
+            else:
+                self.__renamed(self.api.mergeEntities(self.entities, changed))
+
+        if failed:
+            self.displayError("Failed to update switches!")
 
     def clearInput(self) -> None:
         # Clear error display.
@@ -559,7 +1907,8 @@ class Renderer:
         self.cursorPos = 1
 
     def clearError(self) -> None:
-        self.displayError("")
+        # Clearing a user-facing error falls back to the connection status, if any.
+        self.displayError(self.offlineError)
 
     def displayError(self, error: str) -> None:
         if error == self.lastError:
@@ -575,82 +1924,165 @@ class Renderer:
         self.terminal.sendCommand(Terminal.RESTORE_CURSOR)
         self.lastError = error
 
-    def processInput(self, inputVal: bytes) -> Optional[Action]:
-        row, _ = self.terminal.fetchCursor()
+    def __moveInputCursor(self, delta: int) -> None:
+        newPos = min(max(self.cursorPos + delta, 1), len(self.input) + 1)
+        if newPos != self.cursorPos:
+            self.cursorPos = newPos
+            self.terminal.moveCursor(self.terminal.rows, self.cursorPos)
+
+    def __moveSelection(self, delta: int) -> None:
+        if self.indexes[self.currentPage].move(delta):
+            self.__followSelection()
+        else:
+            # Already at the first or last switch, or there's nothing to select on this
+            # page, so let the rest of the page scroll into view.
+            self.__scrollBands(delta)
+
+    def __eraseInput(self, count: int) -> None:
+        # Erase up to count characters before the cursor, echoing the result once.
+        count = min(count, self.cursorPos - 1)
+        if count <= 0:
+            return
+
+        atEnd = self.cursorPos == len(self.input) + 1
+        spot = self.cursorPos - 1 - count
+        self.input = self.input[:spot] + self.input[(spot + count) :]
+        self.cursorPos -= count
+
+        row = self.terminal.rows
+        self.terminal.moveCursor(row, self.cursorPos)
+        self.terminal.sendCommand(Terminal.SET_NORMAL)
+        self.terminal.sendCommand(Terminal.SET_REVERSE)
+        if atEnd:
+            self.terminal.sendText(" " * count)
+        elif self.capabilities.insertDelete:
+            # Let the terminal shift the tail left for us, then patch up the blanks it
+            # leaves at the right margin so the input bar stays reversed.
+            self.terminal.sendCommand(f"[{count}P".encode("ascii"))
+            self.terminal.moveCursor(row, self.terminal.columns - (count - 1))
+            self.terminal.sendText(" " * count)
+        else:
+            self.terminal.sendText(self.input[spot:])
+            self.terminal.sendText(" " * count)
+        self.terminal.moveCursor(row, self.cursorPos)
+
+    def __insertInput(self, text: str) -> None:
+        # Insert as much of text at the cursor as fits, echoing the result once.
+        text = text[: max((self.terminal.columns - 1) - len(self.input), 0)]
+        if not text:
+            return
 
+        row = self.terminal.rows
+        if self.cursorPos == len(self.input) + 1:
+            # Just appending to the input.
+            self.input += text
+            self.terminal.sendCommand(Terminal.SET_NORMAL)
+            self.terminal.sendCommand(Terminal.SET_REVERSE)
+            self.terminal.sendText(text)
+        else:
+            # Adding to mid-input.
+            spot = self.cursorPos - 1
+            self.input = self.input[:spot] + text + self.input[spot:]
+
+            self.terminal.sendCommand(Terminal.SET_NORMAL)
+            self.terminal.sendCommand(Terminal.SET_REVERSE)
+            if self.capabilities.insertDelete:
+                # Open up a gap and let the terminal shift the tail right for us.
+                self.terminal.sendCommand(f"[{len(text)}@".encode("ascii"))
+                self.terminal.sendText(text)
+            else:
+                self.terminal.sendText(self.input[spot:])
+
+        self.cursorPos += len(text)
+        self.terminal.moveCursor(row, self.cursorPos)
+
+    def __isText(self, inputVal: bytes) -> bool:
+        return inputVal not in {
+            Terminal.LEFT,
+            Terminal.RIGHT,
+            Terminal.UP,
+            Terminal.DOWN,
+            Terminal.BACKSPACE,
+            Terminal.DELETE,
+            b">",
+            b"<",
+            b"\r",
+            b"\n",
+        }
+
+    def processInputs(self, inputVals: List[bytes]) -> List[Action]:
+        # Apply a whole batch of typeahead at once. Runs of the same kind of key are
+        # collapsed so that each run costs a single echo instead of one per key.
+        actions: List[Action] = []
+        inputVals = self.__typeahead + inputVals
+        self.__typeahead = []
+        if inputVals:
+            # Somebody is using the terminal, so hold off on rotating pages.
+            self.lastInput = self.scheduler.clock()
+
+        index = 0
+        while index < len(inputVals):
+            inputVal = inputVals[index]
+            if not self.__isText(inputVal):
+                # Anything other than typing may draw on the page, so finish rotating to it.
+                self.__continueShowing(False)
+
+            if inputVal in {Terminal.UP, Terminal.DOWN}:
+                delta = 0
+                while index < len(inputVals) and inputVals[index] in {Terminal.UP, Terminal.DOWN}:
+                    delta += -1 if inputVals[index] == Terminal.UP else 1
+                    index += 1
+                self.__moveSelection(delta)
+            elif inputVal in {Terminal.LEFT, Terminal.RIGHT}:
+                delta = 0
+                while index < len(inputVals) and inputVals[index] in {Terminal.LEFT, Terminal.RIGHT}:
+                    delta += -1 if inputVals[index] == Terminal.LEFT else 1
+                    index += 1
+                self.__moveInputCursor(delta)
+            elif inputVal in {Terminal.BACKSPACE, Terminal.DELETE}:
+                count = 0
+                while index < len(inputVals) and inputVals[index] in {Terminal.BACKSPACE, Terminal.DELETE}:
+                    count += 1
+                    index += 1
+                self.__eraseInput(count)
+            elif self.__isText(inputVal):
+                text = b""
+                while index < len(inputVals) and self.__isText(inputVals[index]):
+                    # If we got some unprintable character, ignore it.
+                    text += bytes(v for v in inputVals[index] if v >= 0x20)
+                    index += 1
+                self.__insertInput(text.decode("ascii", errors="ignore"))
+            else:
+                index += 1
+                action = self.processInput(inputVal)
+                if action is not None:
+                    # The command is finished with whether or not our caller likes it, so
+                    # anything typed after it starts a fresh one once the action is handled.
+                    actions.append(action)
+                    if isinstance(action, SettingAction):
+                        self.clearInput()
+                        self.__typeahead = inputVals[index:]
+                    break
+
+        return actions
+
+    def processInput(self, inputVal: bytes) -> Optional[Action]:
         if inputVal == Terminal.LEFT:
-            if self.cursorPos > 1:
-                self.cursorPos -= 1
-                self.terminal.moveCursor(row, self.cursorPos)
+            self.__moveInputCursor(-1)
         elif inputVal == Terminal.RIGHT:
-            if self.cursorPos < (len(self.input) + 1):
-                self.cursorPos += 1
-                self.terminal.moveCursor(row, self.cursorPos)
+            self.__moveInputCursor(1)
         elif inputVal == Terminal.UP:
-            prevobj, curobj, nextobj = self.__selection()
-            if prevobj is not None:
-                if curobj is not None:
-                    self.objects[self.currentPage][curobj].selected = False
-                self.objects[self.currentPage][prevobj].selected = True
+            self.__moveSelection(-1)
         elif inputVal == Terminal.DOWN:
-            prevobj, curobj, nextobj = self.__selection()
-            if nextobj is not None:
-                if curobj is not None:
-                    self.objects[self.currentPage][curobj].selected = False
-                self.objects[self.currentPage][nextobj].selected = True
+            self.__moveSelection(1)
         elif inputVal in {Terminal.BACKSPACE, Terminal.DELETE}:
-            if self.input:
-                # Just subtract from input.
-                if self.cursorPos == len(self.input) + 1:
-                    # Erasing at the end of the line.
-                    self.input = self.input[:-1]
-
-                    self.cursorPos -= 1
-                    self.terminal.moveCursor(row, self.cursorPos)
-                    self.terminal.sendCommand(Terminal.SET_NORMAL)
-                    self.terminal.sendCommand(Terminal.SET_REVERSE)
-                    self.terminal.sendText(" ")
-                    self.terminal.moveCursor(row, self.cursorPos)
-                elif self.cursorPos == 1:
-                    # Erasing at the beginning, do nothing.
-                    pass
-                elif self.cursorPos == 2:
-                    # Erasing at the beginning of the line.
-                    self.input = self.input[1:]
-
-                    self.cursorPos -= 1
-                    self.terminal.moveCursor(row, self.cursorPos)
-                    self.terminal.sendCommand(Terminal.SET_NORMAL)
-                    self.terminal.sendCommand(Terminal.SET_REVERSE)
-                    self.terminal.sendText(self.input)
-                    self.terminal.sendText(" ")
-                    self.terminal.moveCursor(row, self.cursorPos)
-                else:
-                    # Erasing in the middle of the line.
-                    spot = self.cursorPos - 2
-                    self.input = self.input[:spot] + self.input[(spot + 1) :]
-
-                    self.cursorPos -= 1
-                    self.terminal.moveCursor(row, self.cursorPos)
-                    self.terminal.sendCommand(Terminal.SET_NORMAL)
-                    self.terminal.sendCommand(Terminal.SET_REVERSE)
-                    self.terminal.sendText(self.input[spot:])
-                    self.terminal.sendText(" ")
-                    self.terminal.moveCursor(row, self.cursorPos)
+            self.__eraseInput(1)
         elif inputVal == b">":
             if self.currentPage < (len(self.pages) - 1):
-                self.currentPage += 1
-
-                self.terminal.sendCommand(Terminal.SAVE_CURSOR)
-                self.__renderTabs()
-                self.terminal.sendCommand(Terminal.RESTORE_CURSOR)
+                self.__switchPage(self.currentPage + 1)
         elif inputVal == b"<":
             if self.currentPage > 0:
-                self.currentPage -= 1
-
-                self.terminal.sendCommand(Terminal.SAVE_CURSOR)
-                self.__renderTabs()
-                self.terminal.sendCommand(Terminal.RESTORE_CURSOR)
+                self.__switchPage(self.currentPage - 1)
         elif inputVal == b"\r":
             # Ignore this.
             pass
@@ -659,9 +2091,11 @@ class Renderer:
             actual = self.input.strip()
             if not actual:
                 # This could be a selection request
-                _, cur, _ = self.__selection()
+                cur = self.indexes[self.currentPage].selected
                 if cur is not None:
-                    self.objects[self.currentPage][cur].toggle()
+                    entity = self.objects[self.currentPage][cur].entity
+                    if isinstance(entity, SwitchEntity):
+                        self.__switch(entity)
 
                 return None
 
@@ -688,91 +2122,72 @@ class Renderer:
                     self.displayError("No switch specified!")
                 else:
                     _, setting = actual.split(" ", 1)
-                    setting = setting.strip().lower()
-
-                    # See if we can find by exact match
-                    for obj in self.objects[self.currentPage]:
-                        if not obj.selectable:
-                            continue
+                    setting = setting.strip()
 
-                        if obj.name.lower() == setting:
-                            obj.toggle()
-                            self.clearError()
-                            self.clearInput()
-                            break
+                    group = self.__switchGroup(setting)
+                    if group is not None:
+                        # Toggling several switches is done in one service call.
+                        self.__bulkSwitch("toggle", group)
+                        self.clearError()
+                        self.clearInput()
+                        return None
+
+                    # See if we can find by exact match, or failing that a unique prefix
+                    # or substring of a single switch's name.
+                    obj = self.indexes[self.currentPage].resolve(setting)
+                    if obj is not None and isinstance(obj.entity, SwitchEntity):
+                        self.__switch(obj.entity)
+                        self.clearError()
+                        self.clearInput()
                     else:
-                        # We didn't, see if we can filter down to a single item by substring.
-                        objs = [
-                            o
-                            for o in self.objects[self.currentPage]
-                            if (o.selectable and (setting in o.name.lower()))
+                        self.displayError("Unrecognized switch!")
+                return None
+            elif actual in {"on", "off"} or actual.startswith("on ") or actual.startswith("off "):
+                if " " not in actual:
+                    self.displayError("No switch specified!")
+                else:
+                    service, setting = actual.split(" ", 1)
+                    setting = setting.strip()
+
+                    group = self.__switchGroup(setting)
+                    if group is None:
+                        group = [
+                            o.entity
+                            for o in self.indexes[self.currentPage].matches(setting)
+                            if isinstance(o.entity, SwitchEntity)
                         ]
-                        if len(objs) == 1:
-                            objs[0].toggle()
-                            self.clearError()
-                            self.clearInput()
-                        else:
-                            self.displayError("Unrecognized switch!")
+
+                    if group:
+                        self.__bulkSwitch(f"turn_{service}", group)
+                        self.clearError()
+                        self.clearInput()
+                    else:
+                        self.displayError("Unrecognized switch!")
                 return None
             elif actual in {"n", "next"}:
                 if self.currentPage < (len(self.pages) - 1):
-                    self.currentPage += 1
-
-                    self.terminal.sendCommand(Terminal.SAVE_CURSOR)
-                    self.__renderTabs()
-                    self.terminal.sendCommand(Terminal.RESTORE_CURSOR)
+                    self.__switchPage(self.currentPage + 1)
 
                 self.clearInput()
 
                 return None
             elif actual in {"p", "prev", "previous"}:
                 if self.currentPage > 0:
-                    self.currentPage -= 1
-
-                    self.terminal.sendCommand(Terminal.SAVE_CURSOR)
-                    self.__renderTabs()
-                    self.terminal.sendCommand(Terminal.RESTORE_CURSOR)
+                    self.__switchPage(self.currentPage - 1)
 
                 self.clearInput()
 
                 return None
             elif actual == "help" and self.help_enabled:
                 if self.currentPage != (len(self.pages) - 1):
-                    self.currentPage = len(self.pages) - 1
-
-                    self.terminal.sendCommand(Terminal.SAVE_CURSOR)
-                    self.__renderTabs()
-                    self.terminal.sendCommand(Terminal.RESTORE_CURSOR)
+                    self.__switchPage(len(self.pages) - 1)
 
                 self.clearInput()
             else:
                 self.displayError(f"Unrecognized command {actual}")
         else:
-            if len(self.input) < (self.terminal.columns - 1):
-                # If we got some unprintable character, ignore it.
-                inputVal = bytes(v for v in inputVal if v >= 0x20)
-                if inputVal:
-                    # Just add to input.
-                    char = inputVal.decode("ascii")
-
-                    if self.cursorPos == len(self.input) + 1:
-                        # Just appending to the input.
-                        self.input += char
-                        self.terminal.sendCommand(Terminal.SET_NORMAL)
-                        self.terminal.sendCommand(Terminal.SET_REVERSE)
-                        self.terminal.sendText(char)
-                        self.terminal.moveCursor(row, self.cursorPos + 1)
-                        self.cursorPos += 1
-                    else:
-                        # Adding to mid-input.
-                        spot = self.cursorPos - 1
-                        self.input = self.input[:spot] + char + self.input[spot:]
-
-                        self.terminal.sendCommand(Terminal.SET_NORMAL)
-                        self.terminal.sendCommand(Terminal.SET_REVERSE)
-                        self.terminal.sendText(self.input[spot:])
-                        self.terminal.moveCursor(row, self.cursorPos + 1)
-                        self.cursorPos += 1
+            # If we got some unprintable character, ignore it.
+            self.__insertInput(bytes(v for v in inputVal if v >= 0x20).decode("ascii", errors="ignore"))
 
         # Nothing happening here!
         return None
@@ -0,0 +1,89 @@
+import sys
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Tuple, TypeVar, Union
+
+from vtpy import Terminal
+
+
+T = TypeVar("T")
+
+# A prepared run of output, where bytes are commands and strings are text.
+Sequence = Tuple[Union[bytes, str], ...]
+
+
+def play(terminal: Terminal, sequence: Sequence) -> None:
+    for op in sequence:
+        if isinstance(op, bytes):
+            terminal.sendCommand(op)
+        else:
+            terminal.sendText(op)
+
+
+def _footprint(value: Any) -> int:
+    # Roughly how much memory a cached entry holds onto, counting shared constants like
+    # attribute commands each time since that is simpler and errs on the high side.
+    size = sys.getsizeof(value)
+    if isinstance(value, tuple):
+        size += sum(_footprint(v) for v in value)
+    return size
+
+
+class RenderCache:
+    # Remembers what dynamic objects drew for a given set of visual inputs, so that going
+    # back to something already shown, such as a switch toggled on and then off again,
+    # skips formatting and truncating it all over again. Entries are whatever the object
+    # needs to replay its output, and the least recently used ones are evicted once there
+    # are more than the given number of them. A size of zero disables caching.
+    def __init__(self, size: int = 256) -> None:
+        self.size = max(size, 0)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.memory = 0
+        self.__entries: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    @property
+    def hitRate(self) -> float:
+        total = self.hits + self.misses
+        return (self.hits / total) if total else 0.0
+
+    def fetch(self, key: Hashable, build: Callable[[], T], counted: bool = True) -> T:
+        # Lookups that aren't counted leave the hit rate alone, for when something only
+        # wants to measure what it would draw. They don't add entries either, or the draw
+        # that follows would count as a hit.
+        entry = self.__entries.get(key)
+        if entry is not None:
+            if counted:
+                self.hits += 1
+            self.__entries.move_to_end(key)
+            value: T = entry[0]
+            return value
+
+        value = build()
+        if not counted:
+            return value
+        self.misses += 1
+        if self.size == 0:
+            return value
+
+        footprint = _footprint(key) + _footprint(value)
+        self.__entries[key] = (value, footprint)
+        self.memory += footprint
+        while len(self.__entries) > self.size:
+            _, (_, evicted) = self.__entries.popitem(last=False)
+            self.memory -= evicted
+            self.evictions += 1
+        return value
+
+    def clear(self) -> None:
+        self.__entries.clear()
+        self.memory = 0
+
+    def summary(self) -> str:
+        return (
+            f"{self.hitRate * 100.0:.1f}% hit rate over {self.hits + self.misses} draws, "
+            f"{len(self)} entries using {self.memory} bytes, {self.evictions} evicted"
+        )
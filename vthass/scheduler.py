@@ -0,0 +1,126 @@
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Set
+
+
+class PollScheduler:
+    # Entities that keep not changing get polled progressively less often, up to this
+    # many times their base interval. Any change snaps them back to the base interval.
+    BACKOFF = 1.5
+    MAX_BACKOFF = 8.0
+
+    # Entities Home Assistant doesn't have are asked about a lot less often, just in case
+    # they turn up later.
+    MISSING_BACKOFF = 64.0
+
+    # Fraction of an entity's interval that it may be polled early to share a request.
+    COALESCE = 0.25
+
+    def __init__(
+        self,
+        visibleInterval: float = 1.0,
+        hiddenInterval: float = 30.0,
+        clock: Callable[[], float] = time.time,
+    ) -> None:
+        self.visibleInterval = visibleInterval
+        self.hiddenInterval = hiddenInterval
+        self.clock = clock
+        self.visible: Set[str] = set()
+        self.__backoff: Dict[str, float] = {}
+        self.__due: Dict[str, float] = {}
+
+        # Entities somebody else told us changed, waiting for the next due() to pick up.
+        self.__hurried: Set[str] = set()
+        self.__lock = threading.Lock()
+
+    def configure(self, visibleInterval: float, hiddenInterval: float) -> None:
+        self.visibleInterval = visibleInterval
+        self.hiddenInterval = hiddenInterval
+
+    def track(self, entity_ids: Iterable[str]) -> None:
+        # Sets the full list of entities we care about. New ones are due right away,
+        # ones that are no longer displayed anywhere are forgotten.
+        now = self.clock()
+        wanted = set(entity_ids)
+        for entity_id in list(self.__due):
+            if entity_id not in wanted:
+                del self.__due[entity_id]
+                del self.__backoff[entity_id]
+        for entity_id in wanted:
+            if entity_id not in self.__due:
+                self.__due[entity_id] = now
+                self.__backoff[entity_id] = 1.0
+        # Replaced rather than changed in place, since hurry() reads it from other threads.
+        self.visible = self.visible & wanted
+
+    def setVisible(self, entity_ids: Iterable[str]) -> None:
+        # Anything that just became visible is due immediately, since it may have been
+        # sitting on a slow hidden schedule.
+        now = self.clock()
+        visible = {e for e in entity_ids if e in self.__due}
+        for entity_id in visible - self.visible:
+            self.__due[entity_id] = now
+        self.visible = visible
+
+    def hurry(self, entity_ids: Iterable[str]) -> bool:
+        # Makes any of these that are on screen due right away, for when we hear that they
+        # changed without having asked. Safe to call from any thread. Returns whether any
+        # of them were on screen.
+        visible = self.visible & set(entity_ids)
+        if visible:
+            with self.__lock:
+                self.__hurried |= visible
+        return bool(visible)
+
+    def interval(self, entity_id: str) -> float:
+        base = self.visibleInterval if entity_id in self.visible else self.hiddenInterval
+        return base * self.__backoff.get(entity_id, 1.0)
+
+    def due(self) -> List[str]:
+        # Once anything is due, also grab whatever would be due shortly after it so that
+        # polls get batched up instead of trickling out one entity at a time.
+        now = self.clock()
+        with self.__lock:
+            hurried, self.__hurried = self.__hurried, set()
+        for entity_id in hurried:
+            if entity_id in self.__due:
+                self.__due[entity_id] = now
+
+        if not any(when <= now for when in self.__due.values()):
+            return []
+        return [
+            e for e, when in self.__due.items()
+            if when <= now + self.interval(e) * self.COALESCE
+        ]
+
+    def polled(self, entity_ids: Iterable[str], changed: Iterable[str]) -> None:
+        # Records that we got fresh states for these entities, and when to ask again.
+        now = self.clock()
+        changes = set(changed)
+        for entity_id in entity_ids:
+            if entity_id not in self.__due:
+                continue
+            if entity_id in changes:
+                self.__backoff[entity_id] = 1.0
+            else:
+                self.__backoff[entity_id] = min(
+                    self.__backoff[entity_id] * self.BACKOFF, self.MAX_BACKOFF
+                )
+            self.__due[entity_id] = now + self.interval(entity_id)
+
+    def defer(self, entity_ids: Iterable[str]) -> None:
+        # Push these back a full interval without counting it as a quiet poll, for when
+        # a poll failed or we already know the state from somewhere else.
+        now = self.clock()
+        for entity_id in entity_ids:
+            if entity_id in self.__due:
+                self.__due[entity_id] = now + self.interval(entity_id)
+
+    def missing(self, entity_ids: Iterable[str]) -> None:
+        # Records that Home Assistant answered without these entities in it.
+        now = self.clock()
+        for entity_id in entity_ids:
+            if entity_id not in self.__due:
+                continue
+            self.__backoff[entity_id] = min(self.__backoff[entity_id] * 2, self.MISSING_BACKOFF)
+            self.__due[entity_id] = now + self.interval(entity_id)
@@ -0,0 +1,465 @@
+import asyncio
+import copy
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from urllib.parse import unquote
+
+from vtpy import TerminalException
+
+from .api import Entity, HomeAssistant, MultiHomeAssistant, qualify
+from .capabilities import getProfile
+from .config import Config, ConfigWatcher
+from .scheduler import PollScheduler
+from .session import session
+from .terminal import HeadlessTerminal
+
+
+logger = logging.getLogger(__name__)
+
+
+# Telnet protocol bytes that we either send or need to skip over.
+IAC = 255
+DONT = 254
+DO = 253
+WONT = 252
+WILL = 251
+SB = 250
+SE = 240
+ECHO = 1
+SUPPRESS_GO_AHEAD = 3
+NAWS = 31
+
+
+class SharedFeed:
+    # A single poller that every connected dashboard reads states from, so that the
+    # number of connected terminals doesn't multiply the load on Home Assistant. States
+    # are decoded here once as they change, instead of once for every dashboard.
+    def __init__(self, api: HomeAssistant, interval: float, backend: str = "") -> None:
+        self.api = api
+        self.interval = interval
+        self.backend = backend
+        self.clients = 0
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.byId: Dict[str, Dict[str, Any]] = {}
+        self.entities: Dict[str, Entity] = {}
+
+        # Called with whatever changed, so that idle dashboards can sleep until something
+        # they're showing does.
+        self.listeners: Set[Callable[[Set[str]], None]] = set()
+        self.__stop = threading.Event()
+        self.__thread: Optional[threading.Thread] = None
+
+    def refresh(self) -> None:
+        try:
+            data = self.api._request("GET", "api/states")
+        except Exception:
+            # Failures are already counted and reported by the request itself.
+            return
+
+        byId = {
+            entry["entity_id"]: entry
+            for entry in (data if isinstance(data, list) else [])
+            if isinstance(entry, dict) and isinstance(entry.get("entity_id"), str)
+        }
+        changed = {
+            entity_id
+            for entity_id in set(byId) | set(self.byId)
+            if byId.get(entity_id) != self.byId.get(entity_id)
+        }
+        if self.loaded and not changed:
+            return
+
+        entities = dict(self.entities)
+        for entity_id in changed:
+            entities.pop(entity_id, None)
+        for entity in self.api._decodeAll([byId[e] for e in changed if e in byId]):
+            entities[entity.entity_id] = entity
+
+        with self.lock:
+            self.byId = byId
+            self.entities = entities
+            self.loaded = True
+            listeners = list(self.listeners)
+
+        qualified = {qualify(self.backend, entity_id) for entity_id in changed}
+        for listener in listeners:
+            listener(qualified)
+
+    def start(self) -> None:
+        self.refresh()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        self.__stop.set()
+
+    def __run(self) -> None:
+        while not self.__stop.wait(self.interval):
+            # Nobody is watching, so don't bother Home Assistant.
+            if self.clients:
+                self.refresh()
+
+
+class FeedHomeAssistant(HomeAssistant):
+    # Serves state reads out of a shared feed, passing everything else, such as service
+    # calls and history, through to the real instance behind it.
+    BACKGROUND_FETCH = False
+
+    def __init__(self, feed: SharedFeed) -> None:
+        super().__init__(feed.api.uri, feed.api.token)
+        self.feed = feed
+        self.breaker = feed.api.breaker
+        self.reporter = feed.api.reporter
+
+    def __share(self, entity_ids: Optional[List[str]]) -> Optional[List[Entity]]:
+        # Hands out copies of the feed's entities, since whoever gets them merges into
+        # them and switches them, and other dashboards are using the same ones. There's
+        # nothing to fetch, so asking for any number of them costs the same.
+        start = time.perf_counter()
+        with self.feed.lock:
+            if not self.feed.loaded:
+                return None
+            shared = self.feed.entities
+            if entity_ids is None:
+                chosen = list(shared.values())
+            else:
+                chosen = [shared[e] for e in entity_ids if e in shared]
+
+        entities: List[Entity] = []
+        for entity in chosen:
+            entity = copy.copy(entity)
+            entity.api = self
+            entities.append(entity)
+        self.lastLatency = time.perf_counter() - start
+        return entities
+
+    def getEntities(self) -> Optional[List[Entity]]:
+        return self.__share(None)
+
+    def getStates(self, entity_ids: List[str]) -> Optional[List[Entity]]:
+        return self.__share(entity_ids)
+
+    def _request(self, method: str, path: str, body: Optional[Dict[str, Any]] = None) -> Any:
+        if method == "GET" and path == "api/states":
+            with self.feed.lock:
+                return list(self.feed.byId.values())
+        if method == "GET" and path.startswith("api/states/"):
+            with self.feed.lock:
+                return self.feed.byId.get(unquote(path[len("api/states/"):]))
+        return self.feed.api._request(method, path, body)
+
+
+class KeyParser:
+    # Splits what a client sends into the same individual keys a serial terminal
+    # produces, handling telnet negotiation and the various ways enter gets sent.
+    def __init__(self, telnet: bool) -> None:
+        self.telnet = telnet
+        self.size: Optional[Tuple[int, int]] = None
+        self.__buffer = bytearray()
+        self.__afterCR = False
+
+    def feed(self, data: bytes) -> List[bytes]:
+        self.__buffer += data
+        buf = self.__buffer
+        keys: List[bytes] = []
+
+        pos = 0
+        while pos < len(buf):
+            byte = buf[pos]
+            afterCR = self.__afterCR
+            self.__afterCR = False
+
+            if self.telnet and byte == IAC:
+                consumed = self.__command(pos)
+                if consumed == 0:
+                    # Wait for the rest of the command.
+                    self.__afterCR = afterCR
+                    break
+                pos += consumed
+            elif byte == 0x1B:
+                consumed = self.__escape(pos)
+                if consumed == 0:
+                    self.__afterCR = afterCR
+                    break
+                keys.append(bytes(buf[pos:pos + consumed]))
+                pos += consumed
+            elif byte == 0x0D:
+                keys.append(b"\n")
+                self.__afterCR = True
+                pos += 1
+            elif byte in {0x0A, 0x00}:
+                # Telnet sends CR LF or CR NUL for enter, netcat just sends LF.
+                if not afterCR and byte == 0x0A:
+                    keys.append(b"\n")
+                pos += 1
+            else:
+                keys.append(bytes([byte]))
+                pos += 1
+
+        del buf[:pos]
+        return keys
+
+    def __command(self, pos: int) -> int:
+        # Returns how many bytes the telnet command at this position takes up, or zero
+        # if we don't have all of it yet.
+        buf = self.__buffer
+        if pos + 1 >= len(buf):
+            return 0
+
+        command = buf[pos + 1]
+        if command in {DO, DONT, WILL, WONT}:
+            return 3 if pos + 2 < len(buf) else 0
+        if command == SB:
+            end = buf.find(bytes([IAC, SE]), pos)
+            if end < 0:
+                return 0
+            option = bytes(buf[pos + 2:end]).replace(bytes([IAC, IAC]), bytes([IAC]))
+            if len(option) == 5 and option[0] == NAWS:
+                columns = (option[1] << 8) | option[2]
+                rows = (option[3] << 8) | option[4]
+                # Ignore anything too small to fit the header, page and input.
+                if columns >= 40 and rows >= 12:
+                    self.size = (rows, columns)
+            return end + 2 - pos
+        return 2
+
+    def __escape(self, pos: int) -> int:
+        buf = self.__buffer
+        if pos + 1 >= len(buf):
+            return 0
+
+        introducer = buf[pos + 1]
+        if introducer == ord("O"):
+            return 3 if pos + 2 < len(buf) else 0
+        if introducer != ord("["):
+            return 1
+
+        for end in range(pos + 2, len(buf)):
+            if 0x40 <= buf[end] <= 0x7E:
+                return end + 1 - pos
+        return 0
+
+
+class NetworkTerminal(HeadlessTerminal):
+    # A terminal on the other end of a network connection. Rendering happens on a
+    # session thread which collects output for a frame and hands it to the event loop,
+    # waiting for the client to catch up before continuing so that a slow client only
+    # ever holds up its own session. Idle sessions sleep until a key, a resize or a change
+    # to something they're showing wakes them, or failing that for long enough to keep
+    # timers going.
+    WAIT = 1.0
+
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        writer: asyncio.StreamWriter,
+        rows: int = 24,
+        columns: int = 80,
+    ) -> None:
+        super().__init__(rows, columns)
+        self.loop = loop
+        self.writer = writer
+        self.pending = bytearray()
+        self.closed = False
+        self.arrived = threading.Event()
+        self.__idle = True
+        self.__lock = threading.Lock()
+        self.__size: Optional[Tuple[int, int]] = None
+
+    def _write(self, data: bytes) -> None:
+        if self.closed:
+            raise TerminalException("Connection closed")
+        self.pending += data
+
+    def push(self, keys: List[bytes]) -> None:
+        self.input.extend(keys)
+        self.arrived.set()
+
+    def resize(self, rows: int, columns: int) -> None:
+        # Called from the event loop, so the size only changes once the session thread
+        # next asks for input instead of partway through drawing.
+        with self.__lock:
+            self.__size = (rows, columns)
+        self.arrived.set()
+
+    def wake(self) -> None:
+        self.arrived.set()
+
+    def hangup(self) -> None:
+        self.closed = True
+        self.arrived.set()
+
+    def flush(self) -> None:
+        if self.closed:
+            raise TerminalException("Connection closed")
+        if not self.pending:
+            return
+
+        # UTF-8 never contains 0xFF, so there is never a telnet IAC in here to escape.
+        data = bytes(self.pending)
+        self.pending.clear()
+        try:
+            asyncio.run_coroutine_threadsafe(self.__send(data), self.loop).result()
+        except Exception as e:
+            self.closed = True
+            raise TerminalException(f"Connection closed: {e}")
+
+    async def __send(self, data: bytes) -> None:
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def recvInput(self) -> Optional[bytes]:
+        # Block for a little while when there's nothing to do, so that idle sessions
+        # spend their time asleep instead of spinning.
+        if not self.input and self.__idle:
+            self.flush()
+            self.arrived.clear()
+            if not self.input:
+                self.arrived.wait(self.WAIT)
+
+        with self.__lock:
+            size, self.__size = self.__size, None
+        if size is not None:
+            self.rows, self.columns = size
+
+        if self.closed and not self.input:
+            raise TerminalException("Connection closed")
+
+        data = self.input.popleft() if self.input else None
+        self.__idle = data is None
+        return data
+
+
+class TerminalServer:
+    def __init__(self, config: Config) -> None:
+        self.config = config
+        self.capabilities = getProfile(config.terminal_profile)
+        # One shared feed for each Home Assistant instance we pull entities from.
+        self.feeds: Dict[str, SharedFeed] = {
+            "": SharedFeed(
+                HomeAssistant(config.homeassistant_uri or "", config.homeassistant_token or ""),
+                config.poll_visible,
+            ),
+            **{
+                name: SharedFeed(
+                    HomeAssistant(backend["url"], backend["token"]), config.poll_visible, name
+                )
+                for name, backend in config.homeassistant_backends.items()
+            },
+        }
+        # Every session follows this one, so the config file gets looked at once a second
+        # however many dashboards are connected.
+        self.watcher = ConfigWatcher(config)
+        self.clients = 0
+        self.maxClients = config.server_max_clients
+        self.executor = ThreadPoolExecutor(max_workers=self.maxClients)
+
+    async def run(self) -> None:
+        for feed in self.feeds.values():
+            feed.start()
+        server = await asyncio.start_server(
+            self.__client, self.config.server_host, self.config.server_port
+        )
+        logger.info(f"Serving dashboards on {self.config.server_host}:{self.config.server_port}")
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for feed in self.feeds.values():
+                feed.stop()
+            self.executor.shutdown(wait=False)
+
+    async def __client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        peer = writer.get_extra_info("peername")
+        if self.clients >= self.maxClients:
+            writer.write(b"Too many dashboards connected, try again later.\r\n")
+            await writer.drain()
+            writer.close()
+            return
+
+        logger.info(f"Dashboard connected from {peer}")
+        loop = asyncio.get_running_loop()
+        terminal = NetworkTerminal(loop, writer)
+        parser = KeyParser(self.config.server_telnet)
+        if self.config.server_telnet:
+            # We echo, we don't want go-aheads, and we'd like to know the window size.
+            writer.write(
+                bytes([IAC, WILL, ECHO, IAC, WILL, SUPPRESS_GO_AHEAD])
+                + bytes([IAC, DO, SUPPRESS_GO_AHEAD, IAC, DO, NAWS])
+            )
+
+        config = self.watcher.latest()
+        scheduler = PollScheduler(config.poll_visible, config.poll_hidden)
+        listener = partial(self.__changed, scheduler, terminal)
+        self.__attach(1, listener)
+        done = loop.run_in_executor(self.executor, self.__session, terminal, config, scheduler)
+        try:
+            while True:
+                data = await reader.read(1024)
+                if not data:
+                    break
+
+                keys = parser.feed(data)
+                if parser.size is not None:
+                    terminal.resize(*parser.size)
+                    parser.size = None
+                if keys:
+                    terminal.push(keys)
+        except ConnectionError:
+            pass
+        finally:
+            terminal.hangup()
+            await done
+            self.__attach(-1, listener)
+            writer.close()
+            logger.info(f"Dashboard disconnected from {peer}")
+
+    def __attach(self, count: int, listener: Callable[[Set[str]], None]) -> None:
+        self.clients += count
+        for feed in self.feeds.values():
+            with feed.lock:
+                feed.clients += count
+                if count > 0:
+                    feed.listeners.add(listener)
+                else:
+                    feed.listeners.discard(listener)
+
+    def __changed(self, scheduler: PollScheduler, terminal: NetworkTerminal, entity_ids: Set[str]) -> None:
+        # Only wake a session up if it's showing something that changed, and have it go get
+        # those right away instead of whenever it would have next polled them.
+        if scheduler.hurry(entity_ids):
+            terminal.wake()
+
+    def __hass(self) -> HomeAssistant:
+        if len(self.feeds) == 1:
+            return FeedHomeAssistant(self.feeds[""])
+        return MultiHomeAssistant({name: FeedHomeAssistant(feed) for name, feed in self.feeds.items()})
+
+    def __session(self, terminal: NetworkTerminal, config: Config, scheduler: PollScheduler) -> None:
+        hass = self.__hass()
+        try:
+            if session(
+                config,
+                hass,
+                terminal,
+                self.capabilities,
+                ConfigWatcher(config, self.watcher),
+                frame=terminal.flush,
+                paced=False,
+                scheduler=scheduler,
+            ):
+                # The user asked to leave, so put their screen back and hang up.
+                terminal.reset()
+                terminal.flush()
+        except TerminalException:
+            pass
+        finally:
+            hass.close()
+            terminal.hangup()
+            terminal.loop.call_soon_threadsafe(terminal.writer.close)
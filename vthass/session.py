@@ -0,0 +1,202 @@
+import cProfile
+import logging
+import time
+from typing import Callable, List, Optional
+
+from vtpy import Terminal, TerminalException
+
+from .api import BackgroundFetch, HomeAssistant
+from .capabilities import Capabilities
+from .config import Config, ConfigWatcher
+from .render import Renderer, SettingAction, ExitAction
+from .rendercache import RenderCache
+from .scheduler import PollScheduler
+from .stats import MeteredTerminal, Stats
+from .writer import WriterTerminal
+
+
+logger = logging.getLogger(__name__)
+
+
+def dumpProfile(profiler: cProfile.Profile) -> str:
+    # Stops the profiler and writes its results next to wherever we were started from.
+    profiler.disable()
+    path = f"homeassistant-vt100-{time.strftime('%Y%m%d-%H%M%S')}.prof"
+    profiler.dump_stats(path)
+    return path
+
+
+def session(
+    config: Config,
+    hass: HomeAssistant,
+    terminal: Terminal,
+    capabilities: Capabilities,
+    watcher: Optional[ConfigWatcher] = None,
+    clock: Callable[[], float] = time.time,
+    frame: Optional[Callable[[], None]] = None,
+    threaded: bool = False,
+    fetcher: Optional[BackgroundFetch] = None,
+    began: Optional[float] = None,
+    paced: bool = True,
+    scheduler: Optional[PollScheduler] = None,
+) -> bool:
+    # Runs the dashboard on a connected terminal until the terminal goes away or the user
+    # asks to exit, returning whether we should exit. Everything goes through a metered
+    # terminal so that the stats overlay can see what we cost the serial line, and when
+    # asked for, through a writer thread so that flow control doesn't hold up everything else.
+    # Startup is timed from whenever our caller started connecting, if it tells us.
+    # Terminals that aren't paced by a line rate, such as network clients, get no byte
+    # budget and only stop drawing to echo keys. Callers that hear about changes on their
+    # own can pass in the poll scheduler, so that they can hurry it along.
+    began = time.perf_counter() if began is None else began
+
+    if threaded and config.terminal_queue > 0:
+        terminal = WriterTerminal(terminal, config.terminal_baud, config.terminal_queue)
+    else:
+        terminal = MeteredTerminal(terminal, config.terminal_baud)
+    profiler: Optional[cProfile.Profile] = None
+    if scheduler is None:
+        scheduler = PollScheduler(config.poll_visible, config.poll_hidden, clock)
+    cache = RenderCache(config.render_cache)
+
+    # Half of the echo latency target goes to drawing, leaving room for whatever was
+    # already on its way out when a key was pressed.
+    budget: Optional[int] = None
+    if config.terminal_echo_latency > 0 and not paced:
+        budget = Renderer.UNLIMITED
+    elif config.terminal_echo_latency > 0:
+        budget = max(int(config.terminal_baud / 10 * config.terminal_echo_latency / 2000), 1)
+    renderer = Renderer(
+        config.dashboard_name or "Home Assistant Dashboard",
+        config.layout,
+        config.display_help,
+        hass,
+        terminal,
+        capabilities,
+        scheduler,
+        fetcher,
+        cache,
+        config.rotate,
+        budget,
+    )
+    renderer.draw()
+    logger.info(f"First frame drawn after {time.perf_counter() - began:.3f}s.")
+    loading = renderer.loading
+
+    try:
+        last_check = clock()
+
+        while True:
+            started = time.perf_counter()
+
+            # Poll for updates from home assistant. This only actually sends a request
+            # when some entity is due according to the scheduler.
+            renderer.refresh()
+
+            if (clock() - last_check) > 1.0:
+                last_check = clock()
+
+                # Pick up layout edits without reconnecting to anything.
+                reloaded = watcher.poll() if watcher else None
+                if reloaded is not None:
+                    config = reloaded
+                    scheduler.configure(config.poll_visible, config.poll_hidden)
+                    renderer.rotate = config.rotate
+                    renderer.updateLayout(
+                        config.dashboard_name or "Home Assistant Dashboard",
+                        config.layout,
+                        config.display_help,
+                    )
+
+            # Refresh for updates from home assistant.
+            renderer.draw()
+            if loading and not renderer.loading:
+                loading = False
+                logger.info(f"All entities loaded after {time.perf_counter() - began:.3f}s.")
+
+            # Drain all pending input and apply it as one batch, so that a paste or
+            # fast typing gets echoed once instead of interleaving with redraws. This
+            # also collapses held down up/down presses into a single net movement so
+            # they don't pile up requests to scroll the screen.
+            inputVals: List[bytes] = []
+            while True:
+                # Network terminals sleep on an empty queue, which would hold up drawing
+                # that is still to finish, so only take keys that are already waiting.
+                if not paced and renderer.busy and terminal.peekInput() is None:
+                    break
+                inputVal = terminal.recvInput()
+                if not inputVal:
+                    break
+                inputVals.append(inputVal)
+
+            for action in renderer.processInputs(inputVals):
+                if isinstance(action, SettingAction):
+                    if action.setting in {"cols", "columns"}:
+                        if action.value not in {"80", "132"}:
+                            renderer.displayError(
+                                f"Unrecognized column setting {action.value}"
+                            )
+                        elif action.value == "80":
+                            if terminal.columns != 80:
+                                terminal.set80Columns()
+                                renderer.draw()
+                        elif action.value == "132":
+                            if terminal.columns != 132:
+                                terminal.set132Columns()
+                                renderer.draw()
+                    elif action.setting == "stats":
+                        if action.value not in {"on", "off"}:
+                            renderer.displayError(
+                                f"Unrecognized stats setting {action.value}"
+                            )
+                        else:
+                            renderer.showStats(
+                                Stats(terminal, clock, cache) if action.value == "on" else None
+                            )
+                    elif action.setting == "profile":
+                        if action.value not in {"on", "off"}:
+                            renderer.displayError(
+                                f"Unrecognized profile setting {action.value}"
+                            )
+                        elif action.value == "on":
+                            if profiler is None:
+                                try:
+                                    profiler = cProfile.Profile()
+                                    profiler.enable()
+                                except ValueError:
+                                    # Something else, such as a replay, is already profiling us.
+                                    profiler = None
+                                    renderer.displayError("Another profiler is already running")
+                        elif profiler is not None:
+                            renderer.displayError(f"Profile written to {dumpProfile(profiler)}")
+                            profiler = None
+                    else:
+                        renderer.displayError(
+                            f"Unrecognized setting {action.setting}"
+                        )
+                elif isinstance(action, ExitAction):
+                    logger.info("Got request to end session!")
+                    return True
+
+            if renderer.stats:
+                renderer.stats.frame(time.perf_counter() - started)
+
+            if isinstance(terminal, WriterTerminal):
+                terminal.flush()
+
+            if frame:
+                frame()
+
+    except TerminalException:
+        # Terminal went away mid-transaction.
+        logger.info("Lost terminal, will attempt a reconnect.")
+        return False
+    finally:
+        # Let everything we drew make it out before somebody else takes over the terminal.
+        if isinstance(terminal, WriterTerminal):
+            terminal.close()
+        logger.info(f"Render cache: {cache.summary()}.")
+
+        # Don't lose a profile just because the session ended while it was running.
+        if profiler is not None:
+            logger.info(f"Profile written to {dumpProfile(profiler)}")
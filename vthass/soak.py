@@ -0,0 +1,462 @@
+import gc
+import logging
+import os
+import random
+import sys
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional, TextIO, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from vtpy import Terminal, TerminalException
+
+from .api import BackgroundFetch, CircuitBreaker, FailureReporter, HomeAssistant
+from .capabilities import getProfile
+from .config import Config
+from .emulator import EmulatedTerminal
+from .session import session
+from .trace import ReplayClock
+
+
+class SoakWorld:
+    # A simulated Home Assistant installation, with every entity in the layout constantly
+    # changing, occasionally renamed or missing, and the whole thing sometimes unreachable.
+    # Lives across reconnects the same way a real installation would.
+
+    # Average number of simulated seconds between each kind of event.
+    OUTAGE_EVERY = 6 * 3600.0
+    HANGUP_EVERY = 8 * 3600.0
+    INPUT_EVERY = 120.0
+
+    def __init__(self, config: Config, rng: random.Random, clock: ReplayClock) -> None:
+        self.rng = rng
+        self.clock = clock
+        self.states: Dict[str, Dict[str, Any]] = {}
+        self.removed: Dict[str, float] = {}
+        self.outageUntil = 0.0
+        self.nextOutage = rng.expovariate(1.0 / self.OUTAGE_EVERY)
+        self.outages = 0
+
+        for page in config.layout:
+            for entity in page.entities:
+                entity_id = entity.entity_id
+                if entity_id.startswith("<") or entity_id in self.states:
+                    continue
+
+                name = entity_id.split(".", 1)[-1].replace("_", " ").title()
+                if entity_id.startswith("switch."):
+                    self.states[entity_id] = {"state": "on", "attributes": {"friendly_name": name}}
+                else:
+                    self.states[entity_id] = {
+                        "state": f"{rng.uniform(0.0, 100.0):.2f}",
+                        "attributes": {"friendly_name": name, "unit_of_measurement": "W"},
+                    }
+
+    @property
+    def switches(self) -> List[str]:
+        return [e for e, s in self.states.items() if s["state"] in {"on", "off"}]
+
+    def __entry(self, entity_id: str) -> Dict[str, Any]:
+        return {"entity_id": entity_id, **self.states[entity_id]}
+
+    def __present(self) -> List[str]:
+        return [e for e in self.states if e not in self.removed]
+
+    def step(self, elapsed: float) -> None:
+        now = self.clock()
+        rng = self.rng
+
+        if now >= self.nextOutage:
+            self.outageUntil = now + rng.uniform(60.0, 1800.0)
+            self.nextOutage = self.outageUntil + rng.expovariate(1.0 / self.OUTAGE_EVERY)
+            self.outages += 1
+
+        for entity_id in [e for e, until in self.removed.items() if now >= until]:
+            del self.removed[entity_id]
+
+        for entity_id, state in self.states.items():
+            attributes = state["attributes"]
+            if state["state"] in {"on", "off"}:
+                # Somebody flipped it at the wall.
+                if rng.random() < elapsed / 3600.0:
+                    state["state"] = "off" if state["state"] == "on" else "on"
+            elif rng.random() < 0.5:
+                value = float(state["state"]) + rng.gauss(0.0, 2.0)
+                state["state"] = f"{value:.2f}"
+
+            if rng.random() < elapsed / (12 * 3600.0):
+                # Renames flip back and forth so that names don't grow without bound.
+                name = attributes["friendly_name"]
+                attributes["friendly_name"] = (
+                    name[: -len(" Renamed")] if name.endswith(" Renamed") else f"{name} Renamed"
+                )
+            if rng.random() < elapsed / (24 * 3600.0):
+                self.removed[entity_id] = now + rng.uniform(60.0, 900.0)
+
+    def respond(self, method: str, path: str, body: Optional[Dict[str, Any]]) -> Any:
+        if self.clock() < self.outageUntil:
+            raise Exception("Simulated outage")
+
+        if method == "GET" and path == "api/states":
+            return [self.__entry(e) for e in self.__present()]
+        if method == "GET" and path.startswith("api/states/"):
+            entity_id = unquote(path[len("api/states/"):])
+            return self.__entry(entity_id) if entity_id in self.__present() else None
+        if method == "GET" and path.startswith("api/history/period/"):
+            query = parse_qs(urlsplit(path).query)
+            wanted = ",".join(query.get("filter_entity_id", [])).split(",")
+            return [
+                [{"entity_id": e, "state": self.states[e]["state"]}]
+                + [{"state": f"{self.rng.uniform(0.0, 100.0):.2f}"} for _ in range(20)]
+                for e in wanted
+                if e in self.states
+            ]
+        if method == "POST" and path.startswith("api/services/"):
+            service = path.rsplit("/", 1)[-1]
+            ids = (body or {}).get("entity_id", [])
+            ids = ids if isinstance(ids, list) else [ids]
+            changed = [e for e in ids if e in self.__present() and e in self.switches]
+            for entity_id in changed:
+                state = self.states[entity_id]
+                if service == "toggle":
+                    state["state"] = "off" if state["state"] == "on" else "on"
+                else:
+                    state["state"] = "on" if service == "turn_on" else "off"
+            return [self.__entry(e) for e in changed]
+        raise Exception(f"Unexpected request {method} {path}")
+
+
+class SoakHomeAssistant(HomeAssistant):
+    # Talks to the simulated installation instead of the network, on the main loop so
+    # that a run with the same seed always plays out the same way.
+    BACKGROUND_FETCH = False
+
+    def __init__(self, world: SoakWorld) -> None:
+        super().__init__("http://soak/", "")
+        self.world = world
+        self.breaker = CircuitBreaker(clock=world.clock)
+        self.reporter = FailureReporter("contact Home Assistant", clock=world.clock)
+
+    def _request(self, method: str, path: str, body: Optional[Dict[str, Any]] = None) -> Any:
+        if not self.breaker.allow():
+            raise Exception(f"Home Assistant is unreachable, not requesting {path}")
+
+        try:
+            data = self.world.respond(method, path, body)
+        except Exception as e:
+            self.breaker.failure()
+            self.reporter.failure(e)
+            raise
+
+        self.breaker.success()
+        self.reporter.success()
+        return data
+
+
+class SoakTerminal(EmulatedTerminal):
+    # An emulated terminal that drops its connection at a given simulated time, and
+    # doesn't hang onto everything ever sent to it. Also times how long a typed key takes
+    # to show up on the input line, from when it was pressed to when its echo finished
+    # going down the wire. Writes take as long as the wire does, so a key pressed while
+    # a frame is going out isn't seen until the write in progress at the time is done.
+    def __init__(self, clock: ReplayClock, hangupAt: float) -> None:
+        super().__init__(clock=clock)
+        self.hangupAt = hangupAt
+        self.echoes: List[float] = []
+        self.__arriving: Optional[Tuple[List[bytes], float]] = None
+        self.__typed: Optional[Tuple[bytes, float]] = None
+
+    def type(self, keys: List[bytes], at: float) -> None:
+        self.__arriving = (keys, at)
+
+    def __arrive(self, idle: bool) -> None:
+        if self.__arriving is None:
+            return
+        keys, at = self.__arriving
+        now = max(self.lineFree, self.clock() if self.clock else 0.0)
+        if now < at and not idle:
+            return
+
+        # If we were sitting around waiting for it, it was seen as soon as it was pressed.
+        # Only the first key of each burst is timed, since the rest necessarily wait
+        # behind its echo no matter how quickly we draw.
+        self.__arriving = None
+        for key in keys:
+            if len(key) == 1 and 0x20 < key[0] < 0x7F:
+                self.__typed = (key, min(at, now))
+                break
+        self.feed(keys)
+
+    def sendText(self, text: str) -> None:
+        onInput = self.cursor[0] == self.rows
+        super().sendText(text)
+        if self.__typed is None or not onInput:
+            return
+
+        data = text.encode("utf-8")
+        key, pressed = self.__typed
+        if key in data:
+            # When the key itself arrived, not everything sent after it.
+            after = len(data) - data.index(key) - 1
+            self.echoes.append(self.lineFree - (after * 10.0 / self.baud) - pressed)
+            self.__typed = None
+
+    def _write(self, data: bytes) -> None:
+        super()._write(data)
+        self.output.clear()
+
+    def recvInput(self) -> Optional[bytes]:
+        if self.clock is not None and self.clock() >= self.hangupAt:
+            raise TerminalException("Simulated disconnect")
+        self.__arrive(True)
+        return super().recvInput()
+
+    def peekInput(self) -> Optional[bytes]:
+        self.__arrive(False)
+        return super().peekInput()
+
+
+class Sample:
+    def __init__(
+        self, at: float, traced: int, rss: int, objects: int, frames: List[float]
+    ) -> None:
+        self.at = at
+        self.traced = traced
+        self.rss = rss
+        self.objects = objects
+        self.frames = len(frames)
+
+        ordered = sorted(frames) or [0.0]
+        self.p50 = ordered[min(int(len(ordered) * 0.5), len(ordered) - 1)]
+        self.p99 = ordered[min(int(len(ordered) * 0.99), len(ordered) - 1)]
+        self.max = ordered[-1]
+
+
+def _rss() -> int:
+    # Resident set size in bytes, or zero where we can't tell.
+    try:
+        with open("/proc/self/statm", "r") as stream:
+            return int(stream.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+class Soak:
+    # Runs the real session loop for days of simulated time, as fast as it will go, and
+    # watches for memory, object counts or frame times that keep creeping up. Also checks
+    # that typed keys are echoed within the configured latency target on a simulated line.
+
+    # Simulated seconds per trip around the main loop, and between samples.
+    STEP = 5.0
+    SAMPLE = 3600.0
+
+    # Keys are pressed at some point this many simulated seconds into a trip around
+    # the main loop, usually while it's busy drawing.
+    TYPING = 0.25
+
+    # Samples from the first part of the run are ignored, since caches and histories
+    # legitimately fill up for a while after starting.
+    WARMUP = 0.25
+
+    # Growth allowed between the first and last third of the run, as a fraction and as
+    # an absolute amount, before it counts as a leak.
+    LIMITS: Dict[str, Tuple[float, float]] = {
+        "traced": (0.05, 512 * 1024),
+        "rss": (0.05, 4 * 1024 * 1024),
+        "objects": (0.05, 1000),
+        "p99": (0.5, 0.002),
+    }
+
+    def __init__(self, config: Config, days: float, seed: int = 0, out: TextIO = sys.stdout) -> None:
+        self.config = config
+        self.duration = days * 86400.0
+        self.out = out
+        self.rng = random.Random(seed)
+        self.clock = ReplayClock()
+        self.world = SoakWorld(config, self.rng, self.clock)
+        self.samples: List[Sample] = []
+        self.reconnects = 0
+        self.echoes: List[float] = []
+        self.failures: List[str] = []
+
+        self.terminal: Optional[SoakTerminal] = None
+        self.__frames: List[float] = []
+        self.__frameStart = time.perf_counter()
+        self.__nextSample = self.SAMPLE
+        self.__nextInput = 0.0
+        self.__exiting = False
+        self.__baseline: Optional[tracemalloc.Snapshot] = None
+
+    def run(self) -> bool:
+        tracemalloc.start()
+        capabilities = getProfile(self.config.terminal_profile)
+        print(
+            f"Soaking for {self.duration / 86400.0:.1f} simulated days, "
+            f"sampling every {self.SAMPLE / 3600.0:.0f} simulated hours.",
+            file=self.out,
+        )
+        print(
+            "    time   traced KiB      rss KiB   objects   frames   p50 ms   p99 ms   max ms",
+            file=self.out,
+        )
+
+        try:
+            while not self.__exiting:
+                # Reconnect the same way the real thing does, with a fresh connection to
+                # Home Assistant and the first fetch started before the terminal is up.
+                hass = SoakHomeAssistant(self.world)
+                fetcher = BackgroundFetch(hass)
+                fetcher.start()
+                self.terminal = SoakTerminal(
+                    self.clock,
+                    self.clock() + self.rng.expovariate(1.0 / SoakWorld.HANGUP_EVERY),
+                )
+
+                # The session is chatty about reconnects and outages, which is expected.
+                logging.disable(logging.CRITICAL)
+                try:
+                    exited = session(
+                        self.config, hass, self.terminal, capabilities, clock=self.clock, frame=self.__frame
+                    )
+                finally:
+                    logging.disable(logging.NOTSET)
+                    self.echoes.extend(self.terminal.echoes)
+                    hass.close()
+                if not exited:
+                    self.reconnects += 1
+        finally:
+            current = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+
+        return self.__verdict(current)
+
+    def __frame(self) -> None:
+        now = time.perf_counter()
+        self.__frames.append(now - self.__frameStart)
+
+        self.clock.now += self.STEP
+        self.world.step(self.STEP)
+        terminal = self.terminal
+        assert terminal is not None
+
+        if self.clock() >= self.duration:
+            # Clear out anything half typed first, and keep asking until it takes.
+            self.__exiting = True
+            if not terminal.input:
+                terminal.feed([Terminal.BACKSPACE] * 80 + [bytes([c]) for c in b"exit\n"])
+        elif self.clock() >= self.__nextInput:
+            self.__nextInput = self.clock() + self.rng.expovariate(1.0 / SoakWorld.INPUT_EVERY)
+            terminal.type(self.__keys(), self.clock() + self.rng.uniform(0.0, self.TYPING))
+
+        if self.clock() >= self.__nextSample:
+            self.__nextSample += self.SAMPLE
+            self.__sample()
+
+        self.__frameStart = time.perf_counter()
+
+    def __keys(self) -> List[bytes]:
+        # Something a person standing at the terminal might do.
+        rng = self.rng
+        switches = self.world.switches
+        choice = rng.randrange(8)
+
+        def typed(text: str) -> List[bytes]:
+            return [bytes([c]) for c in text.encode("ascii")]
+
+        if choice == 0:
+            return [b">"]
+        if choice == 1:
+            return [b"<"]
+        if choice == 2:
+            return [rng.choice([Terminal.UP, Terminal.DOWN]) for _ in range(rng.randint(1, 5))]
+        if choice == 3:
+            return [b"\n"]
+        if choice == 4 and switches:
+            name = self.world.states[rng.choice(switches)]["attributes"]["friendly_name"]
+            return typed(f"toggle {name[:rng.randint(2, len(name))]}\n")
+        if choice == 5 and switches:
+            return typed(f"{rng.choice(['on', 'off'])} {rng.choice('aeiou')}\n")
+        if choice == 6:
+            return typed(f"set stats={rng.choice(['on', 'off'])}\n")
+        text = "".join(rng.choice("abcdefgh ") for _ in range(rng.randint(1, 20)))
+        return typed(text) + [Terminal.BACKSPACE] * len(text)
+
+    def __sample(self) -> None:
+        gc.collect()
+        traced, _ = tracemalloc.get_traced_memory()
+        sample = Sample(self.clock(), traced, _rss(), len(gc.get_objects()), self.__frames)
+        self.__frames = []
+        self.samples.append(sample)
+
+        if self.__baseline is None and sample.at >= self.duration * self.WARMUP:
+            self.__baseline = tracemalloc.take_snapshot()
+
+        days, rest = divmod(int(sample.at), 86400)
+        print(
+            f"{days:3d}d{rest // 3600:02d}h "
+            f"{sample.traced / 1024.0:12.1f} {sample.rss / 1024.0:12.1f} {sample.objects:9d} "
+            f"{sample.frames:8d} {sample.p50 * 1000.0:8.3f} {sample.p99 * 1000.0:8.3f} "
+            f"{sample.max * 1000.0:8.3f}",
+            file=self.out,
+        )
+
+    def __verdict(self, current: tracemalloc.Snapshot) -> bool:
+        settled = [s for s in self.samples if s.at >= self.duration * self.WARMUP]
+        print(
+            f"Ran {len(self.samples)} samples with {self.reconnects} reconnects and "
+            f"{self.world.outages} Home Assistant outages.",
+            file=self.out,
+        )
+
+        target = self.config.terminal_echo_latency / 1000.0
+        if self.echoes:
+            ordered = sorted(self.echoes)
+            p50 = ordered[min(int(len(ordered) * 0.5), len(ordered) - 1)]
+            p99 = ordered[min(int(len(ordered) * 0.99), len(ordered) - 1)]
+            print(
+                f"Echoed {len(ordered)} keystrokes, p50 {p50 * 1000.0:.1f} ms, "
+                f"p99 {p99 * 1000.0:.1f} ms, max {ordered[-1] * 1000.0:.1f} ms.",
+                file=self.out,
+            )
+            if target > 0 and p99 > target:
+                self.failures.append(
+                    f"echo p99 of {p99 * 1000.0:.1f} ms is over the {target * 1000.0:.0f} ms target"
+                )
+
+        if len(settled) < 6:
+            print("Not enough samples after warming up to judge growth, run for longer.", file=self.out)
+            for failure in self.failures:
+                print(f"FAIL: {failure}", file=self.out)
+            return not self.failures
+
+        # Sustained growth means each third of the run is worse than the one before, and
+        # the last is worse than the first by more than noise would explain.
+        third = len(settled) // 3
+        for metric, (fraction, absolute) in self.LIMITS.items():
+            medians = []
+            for part in (settled[:third], settled[third:-third], settled[-third:]):
+                values = sorted(getattr(s, metric) for s in part)
+                medians.append(values[len(values) // 2])
+
+            first, middle, last = medians
+            if first <= 0:
+                continue
+            if first < middle < last and (last - first) > max(first * fraction, absolute):
+                self.failures.append(f"{metric} grew from {first} to {last}")
+
+        for failure in self.failures:
+            print(f"FAIL: {failure}", file=self.out)
+
+        if self.failures and self.__baseline is not None:
+            print("Largest allocation growth since warming up:", file=self.out)
+            grown = [s for s in current.compare_to(self.__baseline, "lineno") if s.size_diff > 0]
+            for stat in grown[:10]:
+                print(f"  {stat}", file=self.out)
+
+        if not self.failures:
+            print("PASS: memory, object counts and frame times stayed flat, and echo kept up.", file=self.out)
+        return not self.failures
+
+
+def soak(config: Config, days: float, seed: int = 0) -> bool:
+    return Soak(config, days, seed).run()
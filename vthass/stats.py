@@ -0,0 +1,150 @@
+import time
+from typing import Callable, Dict, Optional
+
+from vtpy import Terminal
+
+from .rendercache import RenderCache
+from .terminal import TerminalWrapper
+
+
+class MeteredTerminal(TerminalWrapper):
+    # Any write that takes this much longer than the line rate says it should is
+    # assumed to have been held up by the terminal sending XOFF.
+    STALL_SLACK = 0.05
+
+    # Whether output is queued rather than written directly, in which case the queue
+    # metrics below mean something.
+    QUEUED = False
+
+    def __init__(self, terminal: Terminal, baud: int) -> None:
+        super().__init__(terminal)
+        self.baud = max(baud, 1)
+        self.stalls = 0
+        self.stallTime = 0.0
+        self.peakDepth = 0
+        self.replaced = 0
+        self.__started: Optional[float] = None
+
+    def __begin(self) -> None:
+        self.__started = time.perf_counter()
+
+    def _output(self, data: bytes) -> None:
+        super()._output(data)
+        if self.__started is None:
+            return
+
+        # Ten bits on the wire for every byte, with one start and one stop bit.
+        elapsed = time.perf_counter() - self.__started
+        expected = (len(data) * 10.0) / self.baud
+        if elapsed > expected + self.STALL_SLACK:
+            self.stalls += 1
+            self.stallTime += elapsed - expected
+        self.__started = None
+
+    def sendCommand(self, cmd: bytes) -> None:
+        self.__begin()
+        super().sendCommand(cmd)
+
+    def sendText(self, text: str) -> None:
+        self.__begin()
+        super().sendText(text)
+
+    def moveCursor(self, row: int, col: int) -> None:
+        self.__begin()
+        super().moveCursor(row, col)
+
+
+class Stats:
+    # The overlay never sends more than this many bytes per update, cursor movement
+    # and attributes included, and updates at most once per interval.
+    BUDGET = 56
+    INTERVAL = 1.0
+
+    # Which fields make way first when they don't all fit.
+    DROP_ORDER = ("chg", "sup", "xoff", "p")
+
+    def __init__(
+        self,
+        terminal: MeteredTerminal,
+        clock: Callable[[], float] = time.time,
+        cache: Optional[RenderCache] = None,
+    ) -> None:
+        self.terminal = terminal
+        self.clock = clock
+        self.cache = cache
+        self.__windowStart = clock()
+        self.__windowBytes = terminal.bytesOut
+        self.__frameMax = 0.0
+        self.__polls = 0
+        self.__changes = 0
+        self.__pollLatency: Optional[float] = None
+        self.__suppressedStart: Optional[int] = None
+        self.__suppressed = 0
+        self.__stalls = 0
+        self.__replaced = terminal.replaced
+        self.__hits = cache.hits if cache else 0
+        self.__draws = (cache.hits + cache.misses) if cache else 0
+
+    def frame(self, seconds: float) -> None:
+        self.__frameMax = max(self.__frameMax, seconds)
+
+    def poll(self, latency: Optional[float], changes: int, suppressed: int = 0) -> None:
+        # Suppressed redraws come in as a running total, we show how many since we started.
+        if self.__suppressedStart is None:
+            self.__suppressedStart = suppressed
+        self.__suppressed = suppressed - self.__suppressedStart
+        self.__polls += 1
+        self.__changes += changes
+        if latency is not None:
+            self.__pollLatency = latency
+
+    @property
+    def due(self) -> bool:
+        return (self.clock() - self.__windowStart) >= self.INTERVAL
+
+    def summary(self, room: int) -> str:
+        # Summarizes everything since the last summary in at most room characters, and
+        # starts a new window.
+        now = self.clock()
+        elapsed = max(now - self.__windowStart, 0.001)
+        rate = (self.terminal.bytesOut - self.__windowBytes) / elapsed
+        stalls = self.terminal.stalls
+
+        latency = "-" if self.__pollLatency is None else f"{self.__pollLatency * 1000.0:.0f}"
+        changes = (self.__changes / self.__polls) if self.__polls else 0.0
+        fields: Dict[str, str] = {
+            "f": f"f:{self.__frameMax * 1000.0:.0f}ms",
+            "p": f"p:{latency}ms",
+            "rate": f"{rate:.0f}B/s",
+            "xoff": f"xoff:{stalls - self.__stalls}",
+            "chg": f"chg:{changes:.1f}",
+            "sup": f"sup:{self.__suppressed}",
+        }
+        if self.terminal.QUEUED:
+            # Deepest the output queue got, and how many stale updates it threw away.
+            fields["q"] = f"q:{self.terminal.peakDepth}/{self.terminal.replaced - self.__replaced}"
+            self.terminal.peakDepth = 0
+        if self.cache is not None:
+            # How many object draws were served from the render cache.
+            hits = self.cache.hits - self.__hits
+            draws = self.cache.hits + self.cache.misses - self.__draws
+            fields["rc"] = f"rc:{(hits * 100) // draws if draws else 0}%"
+            self.__hits = self.cache.hits
+            self.__draws = self.cache.hits + self.cache.misses
+
+        # Whole fields are left out when there isn't room for all of them, so that the
+        # ones at the end don't get cut off partway.
+        for name in self.DROP_ORDER:
+            if len(" ".join(fields.values())) <= room:
+                break
+            del fields[name]
+        text = " ".join(fields.values())[:max(room, 0)]
+
+        self.__windowStart = now
+        self.__windowBytes = self.terminal.bytesOut
+        self.__frameMax = 0.0
+        self.__polls = 0
+        self.__changes = 0
+        self.__stalls = stalls
+        self.__replaced = self.terminal.replaced
+        return text
@@ -0,0 +1,133 @@
+from collections import deque
+from typing import Any, Deque, List, Optional, Tuple
+
+from vtpy import Terminal
+
+
+class TerminalWrapper(Terminal):
+    # Wraps another terminal, passing everything through while giving subclasses a look
+    # at every byte that crosses the line. We deliberately don't initialize the base
+    # class, since the wrapped terminal owns the actual connection.
+    def __init__(self, terminal: Terminal) -> None:
+        self.terminal = terminal
+        self.bytesOut = 0
+        self.bytesIn = 0
+
+    def __getattr__(self, name: str) -> Any:
+        if name == "terminal":
+            raise AttributeError(name)
+        return getattr(self.terminal, name)
+
+    @property
+    def rows(self) -> int:
+        return int(self.terminal.rows)
+
+    @rows.setter
+    def rows(self, rows: int) -> None:
+        self.terminal.rows = rows
+
+    @property
+    def columns(self) -> int:
+        return int(self.terminal.columns)
+
+    @columns.setter
+    def columns(self, columns: int) -> None:
+        self.terminal.columns = columns
+
+    def _output(self, data: bytes) -> None:
+        self.bytesOut += len(data)
+
+    def _input(self, data: bytes) -> None:
+        self.bytesIn += len(data)
+
+    def sendCommand(self, cmd: bytes) -> None:
+        self.terminal.sendCommand(cmd)
+        self._output(Terminal.ESCAPE + cmd)
+
+    def sendText(self, text: str) -> None:
+        self.terminal.sendText(text)
+        self._output(text.encode("utf-8"))
+
+    def moveCursor(self, row: int, col: int) -> None:
+        self.terminal.moveCursor(row, col)
+        self._output(Terminal.ESCAPE + f"[{row};{col}H".encode("ascii"))
+
+    def fetchCursor(self) -> Tuple[int, int]:
+        row, col = self.terminal.fetchCursor()
+        return (row, col)
+
+    def recvInput(self) -> Optional[bytes]:
+        data: Optional[bytes] = self.terminal.recvInput()
+        if data:
+            self._input(data)
+        return data
+
+    def peekInput(self) -> Optional[bytes]:
+        data: Optional[bytes] = self.terminal.peekInput()
+        return data
+
+    def set80Columns(self) -> None:
+        self.terminal.set80Columns()
+
+    def set132Columns(self) -> None:
+        self.terminal.set132Columns()
+
+    def reset(self) -> None:
+        self.terminal.reset()
+
+
+class HeadlessTerminal(Terminal):
+    # A terminal with nothing attached, which collects everything sent to it and plays
+    # back queued input. Tracks just enough cursor state to answer cursor fetches the
+    # way the renderer uses them.
+    def __init__(self, rows: int = 24, columns: int = 80) -> None:
+        self.rows = rows
+        self.columns = columns
+        self.output = bytearray()
+        self.input: Deque[bytes] = deque()
+        self.cursor: Tuple[int, int] = (1, 1)
+        self.saved: Tuple[int, int] = (1, 1)
+
+    def _write(self, data: bytes) -> None:
+        self.output += data
+
+    def feed(self, keys: List[bytes]) -> None:
+        self.input.extend(keys)
+
+    def sendCommand(self, cmd: bytes) -> None:
+        if cmd == Terminal.SAVE_CURSOR:
+            self.saved = self.cursor
+        elif cmd == Terminal.RESTORE_CURSOR:
+            self.cursor = self.saved
+        elif cmd == Terminal.MOVE_CURSOR_ORIGIN:
+            self.cursor = (1, 1)
+        self._write(Terminal.ESCAPE + cmd)
+
+    def sendText(self, text: str) -> None:
+        row, col = self.cursor
+        self.cursor = (row, min(col + len(text), self.columns))
+        self._write(text.encode("utf-8"))
+
+    def moveCursor(self, row: int, col: int) -> None:
+        self.cursor = (row, col)
+        self._write(Terminal.ESCAPE + f"[{row};{col}H".encode("ascii"))
+
+    def fetchCursor(self) -> Tuple[int, int]:
+        return self.cursor
+
+    def recvInput(self) -> Optional[bytes]:
+        return self.input.popleft() if self.input else None
+
+    def peekInput(self) -> Optional[bytes]:
+        return self.input[0] if self.input else None
+
+    def set80Columns(self) -> None:
+        self.columns = 80
+        self.sendCommand(b"[?3l")
+
+    def set132Columns(self) -> None:
+        self.columns = 132
+        self.sendCommand(b"[?3h")
+
+    def reset(self) -> None:
+        self.sendCommand(b"c")
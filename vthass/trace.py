@@ -0,0 +1,210 @@
+import gzip
+import json
+import struct
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from vtpy import Terminal, TerminalException
+
+from .api import HomeAssistant
+from .terminal import HeadlessTerminal, TerminalWrapper
+
+
+MAGIC = b"VTHASS-TRACE 1\n"
+
+# Each record is a timestamp relative to the start of the trace, a kind and a length.
+HEADER = struct.Struct("<dBI")
+
+# Record kinds.
+META = 0
+INPUT = 1
+OUTPUT = 2
+HASS = 3
+
+
+class TraceWriter:
+    def __init__(self, path: str, clock: Callable[[], float] = time.time) -> None:
+        self.clock = clock
+        self.start = clock()
+        self.__lock = threading.Lock()
+        self.__file = gzip.open(path, "wb")
+        self.__file.write(MAGIC)
+
+    def write(self, kind: int, payload: bytes) -> None:
+        # Home Assistant responses are recorded from the polling thread, so serialize writes.
+        with self.__lock:
+            self.__file.write(HEADER.pack(self.clock() - self.start, kind, len(payload)))
+            self.__file.write(payload)
+
+    def writeJson(self, kind: int, payload: Dict[str, Any]) -> None:
+        self.write(kind, json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__file.close()
+
+
+class TraceReader:
+    def __init__(self, path: str) -> None:
+        self.records: List[Tuple[float, int, bytes]] = []
+
+        with gzip.open(path, "rb") as stream:
+            if stream.read(len(MAGIC)) != MAGIC:
+                raise Exception(f"{path} is not a recorded session trace!")
+
+            while True:
+                header = stream.read(HEADER.size)
+                if len(header) < HEADER.size:
+                    break
+                timestamp, kind, length = HEADER.unpack(header)
+                self.records.append((timestamp, kind, stream.read(length)))
+
+    def meta(self) -> Dict[str, Any]:
+        for _, kind, payload in self.records:
+            if kind == META:
+                meta: Dict[str, Any] = json.loads(payload)
+                return meta
+        raise Exception("Trace is missing its session description!")
+
+    def of(self, kind: int) -> List[Tuple[float, bytes]]:
+        return [(t, payload) for t, k, payload in self.records if k == kind]
+
+    @property
+    def duration(self) -> float:
+        return self.records[-1][0] if self.records else 0.0
+
+
+class RecordingTerminal(TerminalWrapper):
+    def __init__(self, terminal: Terminal, trace: TraceWriter) -> None:
+        super().__init__(terminal)
+        self.trace = trace
+        self.__pending = bytearray()
+
+        # Output may be written from a writer thread while the session flushes frames.
+        self.__lock = threading.Lock()
+
+    def _output(self, data: bytes) -> None:
+        super()._output(data)
+
+        # Output is batched into one record per frame to keep the trace compact.
+        with self.__lock:
+            self.__pending += data
+
+    def _input(self, data: bytes) -> None:
+        super()._input(data)
+        self.flush()
+        self.trace.write(INPUT, data)
+
+    def flush(self) -> None:
+        with self.__lock:
+            if self.__pending:
+                self.trace.write(OUTPUT, bytes(self.__pending))
+                self.__pending.clear()
+
+    def recvInput(self) -> Optional[bytes]:
+        data = super().recvInput()
+        if not data:
+            self.flush()
+        return data
+
+
+class RecordingHomeAssistant(HomeAssistant):
+    def __init__(self, uri: str, token: str, trace: TraceWriter, backend: str = "") -> None:
+        super().__init__(uri, token)
+        self.trace = trace
+        self.backend = backend
+
+    def _request(self, method: str, path: str, body: Optional[Dict[str, Any]] = None) -> Any:
+        record: Dict[str, Any] = {"method": method, "path": path}
+        if self.backend:
+            record["backend"] = self.backend
+
+        try:
+            data = super()._request(method, path, body)
+        except Exception as e:
+            self.trace.writeJson(HASS, {**record, "error": str(e)})
+            raise
+
+        self.trace.writeJson(HASS, {**record, "data": data})
+        return data
+
+
+def _requestKey(method: str, path: str) -> str:
+    # History requests embed the time they were made, which won't match on replay.
+    if path.startswith("api/history/period/"):
+        path = "api/history/period"
+    return f"{method} {path}"
+
+
+class ReplayClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class ReplayHomeAssistant(HomeAssistant):
+    # Fetch on the main loop, so that replays are deterministic.
+    BACKGROUND_FETCH = False
+
+    def __init__(self, trace: TraceReader, backend: str = "") -> None:
+        super().__init__("http://replay/", "")
+        self.times: List[float] = []
+        self.__responses: Dict[str, Deque[Dict[str, Any]]] = {}
+        self.__last: Dict[str, Dict[str, Any]] = {}
+
+        for timestamp, payload in trace.of(HASS):
+            response = json.loads(payload)
+            if response.get("backend", "") != backend:
+                continue
+            key = _requestKey(response["method"], response["path"])
+            self.__responses.setdefault(key, deque()).append(response)
+            self.times.append(timestamp)
+
+    def _request(self, method: str, path: str, body: Optional[Dict[str, Any]] = None) -> Any:
+        # Responses are handed back in the order they were recorded for each request,
+        # repeating the last one if the replay asks more often than the recording did.
+        key = _requestKey(method, path)
+        queue = self.__responses.get(key)
+        if queue:
+            self.__last[key] = queue.popleft()
+        response = self.__last.get(key)
+
+        if response is None or "error" in response:
+            raise Exception(
+                response["error"] if response else f"No recorded response for {key}"
+            )
+        return response["data"]
+
+
+class ReplayTerminal(HeadlessTerminal):
+    def __init__(self, trace: TraceReader, clock: ReplayClock) -> None:
+        meta = trace.meta()
+        super().__init__(int(meta.get("rows", 24)), int(meta.get("columns", 80)))
+        self.clock = clock
+        self.end = trace.duration
+        self.pending: Deque[Tuple[float, bytes]] = deque(trace.of(INPUT))
+
+    def __due(self) -> Optional[bytes]:
+        if self.pending and self.pending[0][0] <= self.clock():
+            return self.pending[0][1]
+        if not self.pending and self.clock() >= self.end:
+            # The recorded session is over, end it the same way a lost terminal would.
+            raise TerminalException("End of recorded session")
+        return None
+
+    def recvInput(self) -> Optional[bytes]:
+        data = self.__due()
+        if data is not None:
+            self.pending.popleft()
+        return data
+
+    def peekInput(self) -> Optional[bytes]:
+        return self.__due()
+
+    @property
+    def nextInput(self) -> Optional[float]:
+        return self.pending[0][0] if self.pending else None
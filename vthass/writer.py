@@ -0,0 +1,289 @@
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Deque, Hashable, Iterator, List, Optional, Tuple
+
+from vtpy import Terminal, TerminalException
+
+from .graphics import ASCII_CHARSET, DEC_GRAPHICS
+from .stats import MeteredTerminal
+from .terminal import TerminalWrapper
+
+
+# Commands that only move the cursor, change attributes or erase, none of which care what
+# is already on the screen. Anything else, such as scrolling or inserting characters,
+# shifts existing contents around.
+_NEUTRAL_COMMANDS = {Terminal.SAVE_CURSOR, Terminal.RESTORE_CURSOR, DEC_GRAPHICS, ASCII_CHARSET}
+_NEUTRAL_FINALS = b"mHfABCDKJ"
+
+
+class _Chunk:
+    def __init__(self, key: Optional[Hashable] = None) -> None:
+        self.key = key
+        self.ops: List[Tuple[str, Any]] = []
+        self.size = 0
+
+        # Whether anything in here depends on what was on the screen before it, in which
+        # case nothing queued ahead of it can be thrown away.
+        self.barrier = False
+
+    def add(self, op: str, value: Any, size: int, barrier: bool) -> None:
+        self.ops.append((op, value))
+        self.size += size
+        self.barrier = self.barrier or barrier
+
+    def extend(self, other: "_Chunk") -> None:
+        self.ops.extend(other.ops)
+        self.size += other.size
+        self.barrier = self.barrier or other.barrier
+
+
+class WriterTerminal(MeteredTerminal):
+    # Hands everything sent to it to a dedicated thread which does the actual writing, so
+    # that a terminal holding us up with XOFF doesn't also hold up reading input and polling
+    # Home Assistant. Output is queued in chunks, and chunks sent inside a region replace any
+    # queued chunk for the same region that hasn't gone out yet, so a backed up queue sends
+    # the latest value of a sensor once instead of every value it went through. The cursor
+    # is tracked locally, so that the renderer never has to wait on the queue to find out
+    # where it is.
+
+    # Open chunks are queued once they get this big, even without an explicit flush.
+    CHUNK_SIZE = 256
+    QUEUED = True
+
+    def __init__(self, terminal: Terminal, baud: int, size: int = 64) -> None:
+        super().__init__(terminal, baud)
+        self.size = max(size, 1)
+
+        # How many chunks are waiting right now, alongside the metrics we inherit. Stalls
+        # are counted on the writer thread, so they're the time it spent held up by XOFF.
+        self.depth = 0
+
+        self.cursor: Tuple[int, int] = terminal.fetchCursor()
+        self.saved = self.cursor
+
+        self.__queue: Deque[_Chunk] = deque()
+        self.__queuedBytes = 0
+        self.__open = _Chunk()
+        self.__busy = False
+        self.__stopped = False
+        self.__error: Optional[Exception] = None
+        self.__condition = threading.Condition()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    @property
+    def backlog(self) -> int:
+        # Roughly how many bytes have been sent to us that haven't made it out yet.
+        return self.__queuedBytes + self.__open.size
+
+    # Queueing output.
+
+    def __check(self) -> None:
+        if self.__error is not None:
+            raise TerminalException(str(self.__error))
+
+    def __add(self, op: str, value: Any, size: int, barrier: bool) -> None:
+        self.__check()
+        self.__open.add(op, value, size, barrier)
+        if self.__open.key is None and self.__open.size >= self.CHUNK_SIZE:
+            self.flush()
+
+    def __push(self, chunk: _Chunk) -> None:
+        with self.__condition:
+            if chunk.key is not None:
+                # Throw away an unsent copy of this region, unless something since then
+                # depends on it having been drawn.
+                for index in range(len(self.__queue) - 1, -1, -1):
+                    queued = self.__queue[index]
+                    if queued.key == chunk.key:
+                        del self.__queue[index]
+                        self.__queuedBytes -= queued.size
+                        self.replaced += 1
+
+                        # Whatever plain output was on either side of it can go back
+                        # to sharing one place in the queue.
+                        if 0 < index < len(self.__queue):
+                            before, after = self.__queue[index - 1], self.__queue[index]
+                            if before.key is None and after.key is None:
+                                before.extend(after)
+                                del self.__queue[index]
+                        break
+                    if queued.barrier:
+                        break
+
+            elif self.__queue and self.__queue[-1].key is None:
+                # Plain output just tags along with whatever plain output is still waiting,
+                # so that only regions take up room in the queue.
+                self.__queue[-1].extend(chunk)
+                self.__queuedBytes += chunk.size
+                self.__condition.notify_all()
+                return
+
+            while len(self.__queue) >= self.size and self.__error is None:
+                self.__condition.wait()
+            self.__check()
+
+            self.__queue.append(chunk)
+            self.__queuedBytes += chunk.size
+            self.depth = len(self.__queue)
+            self.peakDepth = max(self.peakDepth, self.depth)
+            self.__condition.notify_all()
+
+    def flush(self) -> None:
+        # Queues whatever has been sent since the last flush.
+        if self.__open.ops:
+            chunk = self.__open
+            self.__open = _Chunk()
+            self.__push(chunk)
+
+    @contextmanager
+    def region(self, key: Hashable) -> Iterator[None]:
+        # Everything sent inside must completely cover whatever an older copy of the region
+        # drew, and start and end with normal attributes. Since either copy could end up
+        # being thrown away, neither it nor whatever follows it can count on the cursor
+        # being where the other left it, so both start by moving there explicitly.
+        self.flush()
+        self.__open = _Chunk(key)
+        self.moveCursor(*self.cursor)
+        try:
+            yield
+        finally:
+            chunk = self.__open
+            self.__open = _Chunk()
+            self.__push(chunk)
+            self.moveCursor(*self.cursor)
+
+    def queued(self, key: Hashable) -> bool:
+        # Whether an unsent copy of this region is still waiting, and so might yet be
+        # thrown away in favor of a newer one.
+        with self.__condition:
+            return any(chunk.key == key for chunk in self.__queue)
+
+    def drain(self) -> None:
+        # Waits until everything queued so far has actually been written.
+        self.flush()
+        with self.__condition:
+            while (self.__queue or self.__busy) and self.__error is None:
+                self.__condition.wait()
+        self.__check()
+
+    def close(self) -> None:
+        try:
+            self.drain()
+        except TerminalException:
+            pass
+
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify_all()
+
+    # Terminal interface.
+
+    def sendCommand(self, cmd: bytes) -> None:
+        if cmd == Terminal.SAVE_CURSOR:
+            self.saved = self.cursor
+        elif cmd == Terminal.RESTORE_CURSOR:
+            self.cursor = self.saved
+        elif cmd == Terminal.MOVE_CURSOR_ORIGIN:
+            self.cursor = (1, 1)
+
+        neutral = cmd in _NEUTRAL_COMMANDS or (
+            cmd[:1] == b"[" and cmd[1:2] != b"?" and cmd[-1:] in _NEUTRAL_FINALS
+        )
+        self.__add("command", cmd, len(cmd) + 1, not neutral)
+
+    def sendText(self, text: str) -> None:
+        row, col = self.cursor
+        self.cursor = (row, min(col + len(text), self.columns))
+        self.__add("text", text, len(text), "\n" in text)
+
+    def moveCursor(self, row: int, col: int) -> None:
+        self.cursor = (row, col)
+        self.__add("move", (row, col), 8, False)
+
+    def fetchCursor(self) -> Tuple[int, int]:
+        return self.cursor
+
+    def recvInput(self) -> Optional[bytes]:
+        self.__check()
+        return super().recvInput()
+
+    def set80Columns(self) -> None:
+        # These change the terminal's size out from under the renderer, so they can't
+        # be left sitting in the queue.
+        self.drain()
+        super().set80Columns()
+
+    def set132Columns(self) -> None:
+        self.drain()
+        super().set132Columns()
+
+    def reset(self) -> None:
+        self.drain()
+        super().reset()
+        self.cursor = (1, 1)
+
+    # The writer thread.
+
+    def __run(self) -> None:
+        while True:
+            with self.__condition:
+                while not self.__queue and not self.__stopped:
+                    self.__condition.wait()
+                if self.__stopped:
+                    return
+
+                chunk = self.__queue.popleft()
+                self.depth = len(self.__queue)
+                self.__busy = True
+                self.__condition.notify_all()
+
+            try:
+                for op, value in chunk.ops:
+                    if op == "command":
+                        super().sendCommand(value)
+                    elif op == "text":
+                        super().sendText(value)
+                    else:
+                        super().moveCursor(*value)
+            except Exception as e:
+                # Hand the failure over to whoever sends next, the same way a direct
+                # write would have failed.
+                with self.__condition:
+                    self.__error = e
+                    self.__busy = False
+                    self.__condition.notify_all()
+                return
+
+            with self.__condition:
+                self.__queuedBytes -= chunk.size
+                self.__busy = False
+                self.__condition.notify_all()
+
+
+def writerOf(terminal: Terminal) -> Optional[WriterTerminal]:
+    # Finds the writer thread underneath any other wrappers, if there is one. Other
+    # wrappers pass everything they're sent on, so the writer still sees all of it.
+    while isinstance(terminal, TerminalWrapper) and not isinstance(terminal, WriterTerminal):
+        terminal = terminal.terminal
+    return terminal if isinstance(terminal, WriterTerminal) else None
+
+
+@contextmanager
+def region(terminal: Terminal, key: Hashable) -> Iterator[None]:
+    # Marks a self-contained screen update that may replace an older, unsent one for the
+    # same key. Terminals that write directly just send it as normal.
+    writer = writerOf(terminal)
+    if writer is not None:
+        with writer.region(key):
+            yield
+    else:
+        yield
+
+
+def queued(terminal: Terminal, key: Hashable) -> bool:
+    # Whether an older copy of this region might never make it to the screen. Terminals
+    # that write directly never have one.
+    writer = writerOf(terminal)
+    return writer is not None and writer.queued(key)